@@ -1,5 +1,6 @@
 
 from . import highlights
+from . import pipeline
 from . import session
 from . import routes
 
@@ -39,7 +40,9 @@ logging.getLogger('multipart.multipart').setLevel(logging.ERROR)
 async def lifespan(app: FastAPI):
     utils.setup()
     session.database.wait_for_connection()
+    pipeline.start()
     yield
+    pipeline.stop()
 
 api = FastAPI(
     title='Deck',
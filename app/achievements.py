@@ -1,14 +1,17 @@
-
-from concurrent.futures import Future, TimeoutError
-from datetime import datetime, timedelta
-from typing import List, Callable, Tuple
+from typing import List, Callable, Dict, Iterable, Tuple
+from concurrent.futures import wait
+from functools import cached_property
 from sqlalchemy.orm import Session
+from sqlalchemy import inspect
+from bisect import bisect_right
+from copy import copy
 
-from app.common.database.objects import DBScore, DBBeatmap
-from app.common.database.repositories import scores
-from app.common.constants import ScoreStatus, Grade
+from app.common.database.objects import DBScore, DBStats
+from app.common.database.repositories import notifications
+from app.common.constants import ScoreStatus, Grade, NotificationType
 from app.common.cache import leaderboards
 from app.common.constants import Mods
+from app import scoreboards, packs, counters
 
 import config
 import app
@@ -17,81 +20,226 @@ import app
 # https://www.reddit.com/r/osugame/comments/4fnkgo/osu_achievementsmedals_thread/
 # https://osu.ppy.sh/community/forums/topics/494188?n=1
 
+class Context:
+    """Data of a submission, which is shared between all conditions & loaded on first use"""
+
+    def __init__(self, score: DBScore, session: Session, counted: bool = True) -> None:
+        self.score = score
+        self.session = session
+        # Scores are counted once their submission was committed
+        self.counted = counted
+
+    @cached_property
+    def stats(self) -> DBStats:
+        return next(
+            stats for stats in self.score.user.stats
+            if stats.mode == self.score.mode
+        )
+
+    @cached_property
+    def global_rank(self) -> int:
+        return leaderboards.global_rank(
+            self.score.user_id,
+            self.score.mode
+        )
+
+    @cached_property
+    def recent_grades(self) -> List[Tuple[int, str]]:
+        recent_grades = counters.recent_grades(
+            self.score.user_id,
+            self.score.mode
+        )
+
+        if not self.counted:
+            recent_grades.insert(0, (self.score.beatmap_id, self.score.grade))
+
+        return recent_grades[:counters.GRADES_LENGTH]
+
+    @cached_property
+    def plays(self) -> int:
+        plays = counters.plays(
+            self.score.user_id,
+            self.score.beatmap_id,
+            self.score.mode
+        )
+
+        return plays + int(not self.counted)
+
+    def value(self, field: str) -> int:
+        """Resolve a trigger field like "score.max_combo" or "stats.playcount" """
+        source, attribute = field.split('.')
+
+        objects = {
+            'score': lambda: self.score,
+            'beatmap': lambda: self.score.beatmap,
+            'stats': lambda: self.stats
+        }
+
+        return getattr(objects[source](), attribute)
+
 class Achievement:
-    def __init__(self, name: str, category: str, filename: str, condition: Callable) -> None:
+    def __init__(
+        self,
+        name: str,
+        category: str,
+        filename: str,
+        condition: Callable,
+        mode: int | None = None,
+        minimum: Tuple[str, int] | None = None,
+        beatmapsets: Iterable[int] | None = None
+    ) -> None:
         self.name = name
         self.category = category
         self.filename = filename
         self.condition = condition
+        self.mode = mode
+        self.minimum = minimum
+        self.beatmapsets = set(beatmapsets or ())
 
     def __repr__(self) -> str:
         return f'[{self.category}] {self.name}'
 
-    def check(self, score) -> bool:
-        return self.condition(score)
+    def check(self, score: DBScore, context: Context) -> bool:
+        return self.condition(score, context)
+
+class AchievementIndex:
+    """Looks up the achievements, that a score could possibly unlock"""
+
+    def __init__(self) -> None:
+        # Mode -> achievements without any trigger
+        self.generic: Dict[int | None, List[Achievement]] = {}
+        # Beatmapset id -> achievements of beatmap packs
+        self.beatmapsets: Dict[int, List[Achievement]] = {}
+        # (Field, mode) -> achievements sorted by their minimum value
+        self.minimums: Dict[Tuple[str, int | None], List[Achievement]] = {}
+
+    def add(self, achievement: Achievement) -> None:
+        if achievement.minimum:
+            field, _ = achievement.minimum
+            entries = self.minimums.setdefault((field, achievement.mode), [])
+            entries.append(achievement)
+            entries.sort(key=lambda a: a.minimum[1])
+            return
+
+        if achievement.beatmapsets:
+            for set_id in achievement.beatmapsets:
+                self.beatmapsets.setdefault(set_id, []).append(achievement)
+            return
+
+        self.generic.setdefault(achievement.mode, []).append(achievement)
+
+    def candidates(self, score: DBScore, context: Context) -> List[Achievement]:
+        candidates = [
+            *self.generic.get(None, []),
+            *self.generic.get(score.mode, []),
+            *self.beatmapsets.get(score.beatmap.set_id, [])
+        ]
 
-achievements: List[Achievement] = []
+        for (field, mode), entries in self.minimums.items():
+            if mode not in (None, score.mode):
+                continue
+
+            value = context.value(field)
+            count = bisect_right([a.minimum[1] for a in entries], value)
+            candidates.extend(entries[:count])
 
-def register(name: str, category: str, filename: str) -> Callable:
-    """Register a achievement"""
+        return candidates
+
+achievements: List[Achievement] = []
+index = AchievementIndex()
+
+def register(
+    name: str,
+    category: str,
+    filename: str,
+    mode: int | None = None,
+    minimum: Tuple[str, int] | None = None,
+    beatmapsets: Iterable[int] | None = None
+) -> Callable:
+    """Register a achievement, which will only be checked for scores that match its triggers"""
 
     def wrapper(condition: Callable):
         a = Achievement(
-            name, category, filename, condition
+            name, category, filename, condition,
+            mode, minimum, beatmapsets
         )
         achievements.append(a)
+        index.add(a)
 
         return a
 
     return wrapper
 
-def check_pack(score: DBScore, beatmapset_ids: List[int]) -> bool:
-    if score.beatmap.set_id not in beatmapset_ids:
+def check_pack(context: Context, pack: packs.Pack) -> bool:
+    score = context.score
+
+    if score.beatmap.set_id not in pack.positions:
         # Score was not set inside this pack
         return False
 
-    with app.session.database.managed_session() as session:
-        for set_id in beatmapset_ids:
-            result = session.query(DBScore) \
-                .join(DBBeatmap) \
-                .filter(DBBeatmap.set_id == set_id) \
-                .filter(DBScore.user_id == score.user_id) \
-                .filter(DBScore.status_pp == 3) \
-                .filter(DBScore.hidden == False) \
-                .first()
-
-            if not result:
-                # User has not completed this beatmap
-                return False
-
-    return True
+    return packs.is_completed(
+        score.user_id,
+        pack,
+        context.session,
+        # The current score is not part of the progress yet
+        score.beatmap.set_id if score.status_pp == ScoreStatus.Best else None
+    )
 
-@register(name='500 Combo  (any song)', category='Skill', filename='combo500.png')
-def combo500(score: DBScore) -> bool:
+def register_pack(name: str, filename: str, beatmapset_ids: List[int]) -> Achievement:
+    """Register a beatmap pack achievement, which requires a personal best on every beatmapset"""
+    pack = packs.register(filename, beatmapset_ids)
+
+    return register(
+        name, 'Beatmap Packs', filename,
+        beatmapsets=beatmapset_ids
+    )(lambda score, context: check_pack(context, pack))
+
+@register(
+    name='500 Combo  (any song)',
+    category='Skill',
+    filename='combo500.png',
+    minimum=('score.max_combo', 500)
+)
+def combo500(score: DBScore, context: Context) -> bool:
     """Get a 500 combo on any map """
     if score.max_combo >= 500:
         return True
 
     return False
 
-@register(name='750 Combo  (any song)', category='Skill', filename='combo750.png')
-def combo750(score: DBScore) -> bool:
+@register(
+    name='750 Combo  (any song)',
+    category='Skill',
+    filename='combo750.png',
+    minimum=('score.max_combo', 750)
+)
+def combo750(score: DBScore, context: Context) -> bool:
     """Get a 750 combo on any map"""
     if score.max_combo >= 750:
         return True
 
     return False
 
-@register(name='1000 Combo  (any song)', category='Skill', filename='combo1000.png')
-def combo1000(score: DBScore) -> bool:
+@register(
+    name='1000 Combo  (any song)',
+    category='Skill',
+    filename='combo1000.png',
+    minimum=('score.max_combo', 1000)
+)
+def combo1000(score: DBScore, context: Context) -> bool:
     """Get a 1000 combo on any map"""
     if score.max_combo >= 1000:
         return True
 
     return False
 
-@register(name='2000 Combo  (any song)', category='Skill', filename='combo2000.png')
-def combo2000(score: DBScore) -> bool:
+@register(
+    name='2000 Combo  (any song)',
+    category='Skill',
+    filename='combo2000.png',
+    minimum=('score.max_combo', 2000)
+)
+def combo2000(score: DBScore, context: Context) -> bool:
     """Get a 2000 combo on any map"""
     if score.max_combo >= 2000:
         return True
@@ -99,7 +247,7 @@ def combo2000(score: DBScore) -> bool:
     return False
 
 @register(name="Don't let the bunny distract you!", category='Hush-Hush', filename='bunny.png')
-def bunny(score: DBScore) -> bool:
+def bunny(score: DBScore, context: Context) -> bool:
     """Get a 371 out of 371 combo in the normal or a 447 out of 447 combo in the hard of the beatmap "Chatmonchy - Make Up! Make Up!" by peppy"""
     if score.beatmap.filename.startswith('Chatmonchy - Make Up! Make Up! (peppy)'):
         if score.perfect:
@@ -108,55 +256,40 @@ def bunny(score: DBScore) -> bool:
     return False
 
 @register(name="S-Ranker", category='Hush-Hush', filename='s-ranker.png')
-def sranker(score: DBScore) -> bool:
+def sranker(score: DBScore, context: Context) -> bool:
     """Get an S rank on 5 different beatmaps in a row"""
-    latest_scores = scores.fetch_recent(
-        score.user_id,
-        score.mode,
-        limit=5
-    )
+    if Grade[score.grade] > Grade.S:
+        return False
 
-    beatmaps = {score.beatmap_id for score in latest_scores}
+    beatmaps = {beatmap_id for beatmap_id, _ in context.recent_grades}
 
     if len(beatmaps) != 5:
         # Can't be on same beatmap
         return False
 
-    for score in latest_scores:
-        if Grade[score.grade] > Grade.S:
+    for _, grade in context.recent_grades:
+        if Grade[grade] > Grade.S:
             return False
 
     return True
 
 @register(name="Most Improved", category='Hush-Hush', filename='improved.png')
-def improved(score: DBScore) -> bool:
+def improved(score: DBScore, context: Context) -> bool:
     """Set a D Rank then A rank (or higher), in the last day"""
     if score.status_pp != ScoreStatus.Best:
         return False
 
-    with app.session.database.managed_session() as session:
-        # Check if player has set a D Rank in the last 24 hours
-        result = session.query(DBScore) \
-            .filter(
-                DBScore.submitted_at > (
-                    datetime.now() - timedelta(days=1)
-                )
-            ) \
-            .filter(DBScore.beatmap_id == score.beatmap_id) \
-            .filter(DBScore.user_id == score.user_id) \
-            .filter(DBScore.grade == 'D') \
-            .first()
-
-    if not result:
-        return False
-
-    if Grade[score.grade] <= Grade.A:
-        return True
+    if Grade[score.grade] > Grade.A:
+        return False
 
-    return False
+    # Check if player has set a D Rank in the last 24 hours
+    if not counters.has_recent_drank(score.user_id, score.beatmap_id):
+        return False
+
+    return True
 
 @register(name='Non-stop Dancer', category='Hush-Hush', filename='dancer.png')
-def dancer(score: DBScore) -> bool:
+def dancer(score: DBScore, context: Context) -> bool:
     """Pass Yoko Ishida - paraparaMAX I without No Fail"""
     if (
         score.beatmap.filename == 'Yoko Ishida - paraparaMAX I (chan) [marathon].osu'
@@ -167,7 +300,7 @@ def dancer(score: DBScore) -> bool:
     return False
 
 @register(name='Consolation Prize', category='Hush-Hush', filename='consolationprize.png')
-def prize(score: DBScore) -> bool:
+def prize(score: DBScore, context: Context) -> bool:
     """Pass the any difficulty of any ranked mapset with below 75% accuracy without no-fail and/or easy mods"""
     if Grade[score.grade] != Grade.D:
         return False
@@ -180,7 +313,7 @@ def prize(score: DBScore) -> bool:
     return True
 
 @register(name='Challenge Accepted', category='Hush-Hush', filename='challengeaccepted.png')
-def approved(score: DBScore) -> bool:
+def approved(score: DBScore, context: Context) -> bool:
     """Complete an Approved map"""
     if score.beatmap.approved:
         return True
@@ -188,7 +321,7 @@ def approved(score: DBScore) -> bool:
     return False
 
 @register(name='Stumbler', category='Hush-Hush', filename='stumbler.png')
-def stumbler(score: DBScore) -> bool:
+def stumbler(score: DBScore, context: Context) -> bool:
     """Full Combo a map with less than 85% accuracy"""
     if not score.perfect:
         return False
@@ -199,7 +332,7 @@ def stumbler(score: DBScore) -> bool:
     return True
 
 @register(name='Jackpot', category='Hush-Hush', filename='jackpot.png')
-def jackpot(score: DBScore) -> bool:
+def jackpot(score: DBScore, context: Context) -> bool:
     """Complete a map with a score of at least 6 recurring numbers (ie. 222,222 or 6,666,666)"""
     tscore = str(score.total_score)
     num_list = [*tscore]
@@ -211,37 +344,43 @@ def jackpot(score: DBScore) -> bool:
     return False
 
 @register(name='Quick Draw', category='Hush-Hush', filename='quickdraw.png')
-def quickdraw(score: DBScore) -> bool:
+def quickdraw(score: DBScore, context: Context) -> bool:
     """Be the first person to pass a ranked or qualified map"""
     if not score.beatmap.is_ranked:
         return False
 
-    all_scores = scores.fetch_range_scores(score.beatmap_id, score.mode)
+    # The scoreboard only contains scores that were already submitted
+    score_count = scoreboards.count(
+        score.beatmap_id,
+        score.mode,
+        context.session
+    )
 
-    if len(all_scores) > 1:
-        return False
+    # Previous passes of the player itself don't count
+    has_passed = scoreboards.rank(
+        score.beatmap_id,
+        score.mode,
+        score.user_id,
+        context.session
+    ) > 0
 
-    return True
+    return score_count - int(has_passed) <= 0
 
 @register(name='Obsessed', category='Hush-Hush', filename='obsessed.png')
-def obsessed(score: DBScore) -> bool:
+def obsessed(score: DBScore, context: Context) -> bool:
     """Play the same map over 100 times in a day, retries included"""
-    with app.session.database.managed_session() as session:
-        score_count = session.query(DBScore) \
-            .filter(DBScore.beatmap_id == score.beatmap_id) \
-            .filter(DBScore.user_id == score.user_id) \
-            .filter(DBScore.mode == score.mode) \
-            .filter(DBScore.submitted_at > datetime.now() - timedelta(days=1)) \
-            .limit(100) \
-            .count()
-
-    if score_count < 100:
+    if context.plays < 100:
         return False
 
     return True
 
-@register(name='Nonstop', category='Hush-Hush', filename='nonstop.png')
-def nonstop(score: DBScore) -> bool:
+@register(
+    name='Nonstop',
+    category='Hush-Hush',
+    filename='nonstop.png',
+    minimum=('beatmap.total_length', 600)
+)
+def nonstop(score: DBScore, context: Context) -> bool:
     """Get a Max Combo on a map with over 10 minutes of drain time"""
     if score.max_combo < score.beatmap.max_combo:
         return False
@@ -251,8 +390,13 @@ def nonstop(score: DBScore) -> bool:
 
     return True
 
-@register(name='Jack of All Trades', category='Hush-Hush', filename='jack.png')
-def allmodes(score: DBScore) -> bool:
+@register(
+    name='Jack of All Trades',
+    category='Hush-Hush',
+    filename='jack.png',
+    minimum=('stats.playcount', 5000)
+)
+def allmodes(score: DBScore, context: Context) -> bool:
     """Reach a play count of at least 5,000 in all osu!Standard, osu!Taiko, osu!CtB and osu!Mania"""
 
     playcounts = [stats.playcount for stats in score.user.stats]
@@ -263,8 +407,14 @@ def allmodes(score: DBScore) -> bool:
 
     return True
 
-@register(name='A meganekko approaches', category='Hush-Hush', filename='meganekko.png')
-def nekko(score: DBScore) -> bool:
+@register(
+    name='A meganekko approaches',
+    category='Hush-Hush',
+    filename='meganekko.png',
+    mode=3,
+    minimum=('score.max_combo', 100)
+)
+def nekko(score: DBScore, context: Context) -> bool:
     """Meet Maria, the osu!mania mascot. Finish an osu!mania map with at least a 100 combo"""
     if score.mode != 3:
         return False
@@ -274,170 +424,248 @@ def nekko(score: DBScore) -> bool:
 
     return True
 
-@register(name='5,000 Plays (osu! mode)', category='Dedication', filename='plays1.png')
-def osuplays_1(score: DBScore) -> bool:
+@register(
+    name='5,000 Plays (osu! mode)',
+    category='Dedication',
+    filename='plays1.png',
+    mode=0,
+    minimum=('stats.playcount', 5000)
+)
+def osuplays_1(score: DBScore, context: Context) -> bool:
     """Get a Play Count of 5,000 in osu!Standard"""
     if score.mode != 0:
         return False
 
-    s = score.user.stats[0]
+    s = context.stats
 
     if s.playcount < 5000:
         return False
 
     return True
 
-@register(name='15,000 Plays (osu! mode)', category='Dedication', filename='plays2.png')
-def osuplays_2(score: DBScore) -> bool:
+@register(
+    name='15,000 Plays (osu! mode)',
+    category='Dedication',
+    filename='plays2.png',
+    mode=0,
+    minimum=('stats.playcount', 15000)
+)
+def osuplays_2(score: DBScore, context: Context) -> bool:
     """Get a Play Count of 15,000 in osu!Standard"""
     if score.mode != 0:
         return False
 
-    s = score.user.stats[0]
+    s = context.stats
 
     if s.playcount < 15000:
         return False
 
     return True
 
-@register(name='25,000 Plays (osu! mode)', category='Dedication', filename='plays3.png')
-def osuplays_3(score: DBScore) -> bool:
+@register(
+    name='25,000 Plays (osu! mode)',
+    category='Dedication',
+    filename='plays3.png',
+    mode=0,
+    minimum=('stats.playcount', 25000)
+)
+def osuplays_3(score: DBScore, context: Context) -> bool:
     """Get a Play Count of 25,000 in osu!Standard"""
     if score.mode != 0:
         return False
 
-    s = score.user.stats[0]
+    s = context.stats
 
     if s.playcount < 25000:
         return False
 
     return True
 
-@register(name='50,000 Plays (osu! mode)', category='Dedication', filename='plays4.png')
-def osuplays_4(score: DBScore) -> bool:
+@register(
+    name='50,000 Plays (osu! mode)',
+    category='Dedication',
+    filename='plays4.png',
+    mode=0,
+    minimum=('stats.playcount', 50000)
+)
+def osuplays_4(score: DBScore, context: Context) -> bool:
     """Get a Play Count of 50,000 in osu!Standard"""
     if score.mode != 0:
         return False
 
-    s = score.user.stats[0]
+    s = context.stats
 
     if s.playcount < 50000:
         return False
 
     return True
 
-@register(name='30,000 Drum Hits', category='Dedication', filename='taiko1.png')
-def taikohits_1(score: DBScore) -> bool:
+@register(
+    name='30,000 Drum Hits',
+    category='Dedication',
+    filename='taiko1.png',
+    mode=1,
+    minimum=('stats.total_hits', 30000)
+)
+def taikohits_1(score: DBScore, context: Context) -> bool:
     """Hit 30,000 notes in osu!Taiko"""
 
     if score.mode != 1:
         return False
 
-    s = score.user.stats[1]
+    s = context.stats
 
     if s.total_hits < 30000:
         return False
 
     return True
 
-@register(name='300,000 Drum Hits', category='Dedication', filename='taiko2.png')
-def taikohits_2(score: DBScore) -> bool:
+@register(
+    name='300,000 Drum Hits',
+    category='Dedication',
+    filename='taiko2.png',
+    mode=1,
+    minimum=('stats.total_hits', 300000)
+)
+def taikohits_2(score: DBScore, context: Context) -> bool:
     """Hit 300,000 notes in osu!Taiko"""
     if score.mode != 1:
         return False
 
-    s = score.user.stats[1]
+    s = context.stats
 
     if s.total_hits < 300000:
         return False
 
     return True
 
-@register(name='3,000,000 Drum Hits', category='Dedication', filename='taiko3.png')
-def taikohits_3(score: DBScore) -> bool:
+@register(
+    name='3,000,000 Drum Hits',
+    category='Dedication',
+    filename='taiko3.png',
+    mode=1,
+    minimum=('stats.total_hits', 3000000)
+)
+def taikohits_3(score: DBScore, context: Context) -> bool:
     """Hit 3,000,000 notes in osu!Taiko"""
     if score.mode != 1:
         return False
 
-    s = score.user.stats[1]
+    s = context.stats
 
     if s.total_hits < 3000000:
         return False
 
     return True
 
-@register(name='Catch 20,000 fruits', category='Dedication', filename='fruitsalad.png')
-def fruitshits_1(score: DBScore) -> bool:
+@register(
+    name='Catch 20,000 fruits',
+    category='Dedication',
+    filename='fruitsalad.png',
+    mode=2,
+    minimum=('stats.total_hits', 20000)
+)
+def fruitshits_1(score: DBScore, context: Context) -> bool:
     """Catch 20,000 fruits in osu!CtB"""
     if score.mode != 2:
         return False
 
-    s = score.user.stats[2]
+    s = context.stats
 
     if s.total_hits < 20000:
         return False
 
     return True
 
-@register(name='Catch 200,000 fruits', category='Dedication', filename='fruitplatter.png')
-def fruitshits_2(score: DBScore) -> bool:
+@register(
+    name='Catch 200,000 fruits',
+    category='Dedication',
+    filename='fruitplatter.png',
+    mode=2,
+    minimum=('stats.total_hits', 200000)
+)
+def fruitshits_2(score: DBScore, context: Context) -> bool:
     """Catch 200,000 fruits in osu!CtB"""
     if score.mode != 2:
         return False
 
-    s = score.user.stats[2]
+    s = context.stats
 
     if s.total_hits < 200000:
         return False
 
     return True
 
-@register(name='Catch 2,000,000 fruits', category='Dedication', filename='fruitod.png')
-def fruitshits_3(score: DBScore) -> bool:
+@register(
+    name='Catch 2,000,000 fruits',
+    category='Dedication',
+    filename='fruitod.png',
+    mode=2,
+    minimum=('stats.total_hits', 2000000)
+)
+def fruitshits_3(score: DBScore, context: Context) -> bool:
     """Catch 2,000,000 fruits in osu!CtB"""
     if score.mode != 2:
         return False
 
-    s = score.user.stats[2]
+    s = context.stats
 
     if s.total_hits < 2000000:
         return False
 
     return True
 
-@register(name='40,000 Keys', category='Dedication', filename='maniahits1.png')
-def maniahits_1(score: DBScore) -> bool:
+@register(
+    name='40,000 Keys',
+    category='Dedication',
+    filename='maniahits1.png',
+    mode=3,
+    minimum=('stats.total_hits', 40000)
+)
+def maniahits_1(score: DBScore, context: Context) -> bool:
     """Hit 40,000 keys in osu!mania"""
-    if score.mode != 2:
+    if score.mode != 3:
         return False
 
-    s = score.user.stats[3]
+    s = context.stats
 
     if s.total_hits < 40000:
         return False
 
     return True
 
-@register(name='400,000 Keys', category='Dedication', filename='maniahits2.png')
-def maniahits_2(score: DBScore) -> bool:
+@register(
+    name='400,000 Keys',
+    category='Dedication',
+    filename='maniahits2.png',
+    mode=3,
+    minimum=('stats.total_hits', 400000)
+)
+def maniahits_2(score: DBScore, context: Context) -> bool:
     """Hit 400,000 keys in osu!mania"""
-    if score.mode != 2:
+    if score.mode != 3:
         return False
 
-    s = score.user.stats[3]
+    s = context.stats
 
     if s.total_hits < 400000:
         return False
 
     return True
 
-@register(name='4,000,000 Keys', category='Dedication', filename='maniahits3.png')
-def maniahits_3(score: DBScore) -> bool:
+@register(
+    name='4,000,000 Keys',
+    category='Dedication',
+    filename='maniahits3.png',
+    mode=3,
+    minimum=('stats.total_hits', 4000000)
+)
+def maniahits_3(score: DBScore, context: Context) -> bool:
     """Hit 4,000,000 keys in osu!mania"""
-    if score.mode != 2:
+    if score.mode != 3:
         return False
 
-    s = score.user.stats[3]
+    s = context.stats
 
     if s.total_hits < 4000000:
         return False
@@ -445,9 +673,9 @@ def maniahits_3(score: DBScore) -> bool:
     return True
 
 @register(name='I can see the top', category='Skill', filename='high-ranker-1.png')
-def ranking_1(score: DBScore) -> bool:
+def ranking_1(score: DBScore, context: Context) -> bool:
     """Reach a profile rank of at least 500 in any osu! mode"""
-    rank = leaderboards.global_rank(score.user_id, score.mode)
+    rank = context.global_rank
 
     # NOTE: Used to be 50,000
     if rank > 500:
@@ -456,9 +684,9 @@ def ranking_1(score: DBScore) -> bool:
     return True
 
 @register(name='The gradual rise', category='Skill', filename='high-ranker-2.png')
-def ranking_2(score: DBScore) -> bool:
+def ranking_2(score: DBScore, context: Context) -> bool:
     """Reach a profile rank of at least 100 in any osu! mode"""
-    rank = leaderboards.global_rank(score.user_id, score.mode)
+    rank = context.global_rank
 
     # NOTE: Used to be 10,000
     if rank > 100:
@@ -467,9 +695,9 @@ def ranking_2(score: DBScore) -> bool:
     return True
 
 @register(name='Scaling up', category='Skill', filename='high-ranker-3.png')
-def ranking_3(score: DBScore) -> bool:
+def ranking_3(score: DBScore, context: Context) -> bool:
     """Reach a profile rank of at least 50 in any osu! mode"""
-    rank = leaderboards.global_rank(score.user_id, score.mode)
+    rank = context.global_rank
 
     # NOTE: Used to be 5,000
     if rank > 50:
@@ -478,9 +706,9 @@ def ranking_3(score: DBScore) -> bool:
     return True
 
 @register(name='Approaching the summit', category='Skill', filename='high-ranker-4.png')
-def ranking_3(score: DBScore) -> bool:
+def ranking_3(score: DBScore, context: Context) -> bool:
     """Reach a profile rank of at least 15 in any osu! mode"""
-    rank = leaderboards.global_rank(score.user_id, score.mode)
+    rank = context.global_rank
 
     # NOTE: Used to be 1,000
     if rank > 10:
@@ -488,390 +716,219 @@ def ranking_3(score: DBScore) -> bool:
 
     return True
 
-@register(name='Video Game Pack vol.1', category='Beatmap Packs', filename='gamer1.png')
-def video_game_1(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            1635,
-            1211,
-            1231,
-            1281,
-            1092,
-            312,
-            633,
-            688,
-            704,
-            154,
-            125,
-            92,
-            25
-        ]
-    )
+register_pack('Video Game Pack vol.1', 'gamer1.png', [
+    1635, 1211, 1231, 1281, 1092, 312, 633,
+    688, 704, 154, 125, 92, 25
+])
+
+register_pack('Video Game Pack vol.2', 'gamer2.png', [
+    1044, 1123, 1367, 1525, 1818, 2008, 2128,
+    2147, 2404, 2420, 243, 2619, 628
+])
+
+register_pack('Video Game Pack vol.3', 'gamer3.png', [
+    1890, 2085, 2490, 2983, 3150, 3221, 3384,
+    3511, 3613, 4033, 4299, 4305, 4629
+])
+
+register_pack('Video Game Pack vol.4', 'gamer4.png', [
+    10104, 10880, 13489, 14205, 14458, 16669, 17373,
+    21836, 23073, 7077, 9580, 9668, 9854
+])
+
+register_pack('Anime Pack vol.1', 'anime1.png', [
+    1005, 1377, 1414, 1464, 147, 1806, 301,
+    35, 442, 511, 584, 842, 897
+])
+
+register_pack('Anime Pack vol.2', 'anime2.png', [
+    150, 162, 205, 212, 2207, 2267, 2329,
+    2425, 302, 496, 521, 86, 956
+])
+
+register_pack('Anime Pack vol.3', 'anime3.png', [
+    2618, 3030, 4851, 4994, 5010, 5235, 5410,
+    5480, 5963, 6037, 6257, 6535, 6557
+])
+
+register_pack('Anime Pack vol.4', 'anime4.png', [
+    12982, 13036, 13673, 14256, 14694, 16252, 21197,
+    516, 5438, 6301, 8422, 8829, 9556
+])
+
+register_pack('Internet! Pack vol.1', 'lulz1.png', [
+    66, 132, 140, 235, 303, 339, 455,
+    664, 812, 977, 1018, 1287
+])
+
+register_pack('Internet! Pack vol.2', 'lulz2.png', [
+    203, 917, 1573, 1628, 1785, 2103, 2569,
+    3196, 3219, 3545, 3621, 4535, 5014
+])
+
+register_pack('Internet! Pack vol.3', 'lulz3.png', [
+    1839, 3337, 3367, 3688, 5703, 5709, 5823,
+    6526, 6626, 7506, 7507, 8034, 8690
+])
+
+register_pack('Internet! Pack vol.4', 'lulz4.png', [
+    11443, 12033, 12155, 13885, 14391, 14579, 14672,
+    15157, 15628, 15942, 17145, 17217, 17724
+])
+
+register_pack('Rhythm Game Pack vol.1', 'rhythm1.png', [
+    1452, 1450, 1078, 1201, 1300, 1317, 1338,
+    210, 296, 540, 564, 74, 96
+])
+
+register_pack('Rhythm Game Pack vol.2', 'rhythm2.png', [
+    1207, 1567, 2534, 3302, 3435, 3499, 4887,
+    5087, 5177, 5275, 5321, 5349, 5577
+])
+
+register_pack('Rhythm Game Pack vol.3', 'rhythm3.png', [
+    1206, 4357, 4617, 4772, 4954, 5180, 5672,
+    5696, 6598, 7094, 7237, 7612, 7983
+])
+
+register_pack('Rhythm Game Pack vol.4', 'rhythm4.png', [
+    10842, 11135, 11488, 12052, 12190, 12710, 13249,
+    14572, 14778, 15241, 18492, 19809, 22401
+])
 
-@register(name='Video Game Pack vol.2', category='Beatmap Packs', filename='gamer2.png')
-def video_game_2(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            1044,
-            1123,
-            1367,
-            1525,
-            1818,
-            2008,
-            2128,
-            2147,
-            2404,
-            2420,
-            243,
-            2619,
-            628
-        ]
-    )
-
-@register(name='Video Game Pack vol.3', category='Beatmap Packs', filename='gamer3.png')
-def video_game_3(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            1890,
-            2085,
-            2490,
-            2983,
-            3150,
-            3221,
-            3384,
-            3511,
-            3613,
-            4033,
-            4299,
-            4305,
-            4629
-        ]
-    )
+def get_by_name(name: str):
+    for achievement in achievements:
+        if achievement.name == name:
+            return achievement
+    return None
 
-@register(name='Video Game Pack vol.4', category='Beatmap Packs', filename='gamer4.png')
-def video_game_4(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            10104,
-            10880,
-            13489,
-            14205,
-            14458,
-            16669,
-            17373,
-            21836,
-            23073,
-            7077,
-            9580,
-            9668,
-            9854
-        ]
-    )
+def get_by_filename(filename: str) -> Achievement | None:
+    for achievement in achievements:
+        if achievement.filename == filename:
+            return achievement
+    return None
 
-@register(name='Anime Pack vol.1', category='Beatmap Packs', filename='anime1.png')
-def anime_1(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            1005,
-            1377,
-            1414,
-            1464,
-            147,
-            1806,
-            301,
-            35,
-            442,
-            511,
-            584,
-            842,
-            897
-        ]
-    )
+def check_one(achievement: Achievement, score: DBScore, context: Context) -> bool:
+    try:
+        return achievement.check(score, context)
+    except Exception as e:
+        app.session.logger.error(
+            f'Achievement check for "{achievement.name}" failed: {e}',
+            exc_info=e
+        )
+        return False
 
-@register(name='Anime Pack vol.2', category='Beatmap Packs', filename='anime2.png')
-def anime_2(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            150,
-            162,
-            205,
-            212,
-            2207,
-            2267,
-            2329,
-            2425,
-            302,
-            496,
-            521,
-            86,
-            956
-        ]
-    )
+def check_isolated(achievement: Achievement, score: DBScore, context: Context) -> bool:
+    """Runs inside the achievement executor, with a session of its own"""
+    with app.session.database.managed_session() as session:
+        isolated = copy(context)
+        isolated.session = session
+        return check_one(achievement, score, isolated)
+
+def check(
+    score: DBScore,
+    session: Session,
+    ignore_list: List[str] = [],
+    candidates: List[Achievement] | None = None,
+    budget: float | None = None,
+    counted: bool = True
+) -> Tuple[List[Achievement], List[Achievement]]:
+    """Check for new achievements, and return the ones that were unlocked & the ones that did not finish
+
+    With a time budget, the checks run inside the achievement executor. Checks
+    that did not finish inside the budget keep running in the background, but
+    their results are ignored & they are returned to be re-run by the pipeline.
+    """
+    app.session.logger.debug('Checking for new achievements...')
 
-@register(name='Anime Pack vol.3', category='Beatmap Packs', filename='anime3.png')
-def anime_3(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            2618,
-            3030,
-            4851,
-            4994,
-            5010,
-            5235,
-            5410,
-            5480,
-            5963,
-            6037,
-            6257,
-            6535,
-            6557
-        ]
-    )
+    context = Context(score, session, counted)
 
-@register(name='Anime Pack vol.4', category='Beatmap Packs', filename='anime4.png')
-def anime_4(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            12982,
-            13036,
-            13673,
-            14256,
-            14694,
-            16252,
-            21197,
-            516,
-            5438,
-            6301,
-            8422,
-            8829,
-            9556
-        ]
-    )
+    if candidates is None:
+        candidates = index.candidates(score, context)
 
-@register(name='Internet! Pack vol.1', category='Beatmap Packs', filename='lulz1.png')
-def internet_1(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            66,
-            132,
-            140,
-            235,
-            303,
-            339,
-            455,
-            664,
-            812,
-            977,
-            1018,
-            1287
-        ]
-    )
+    candidates = [
+        achievement for achievement in candidates
+        if achievement.filename not in ignore_list
+    ]
 
-@register(name='Internet! Pack vol.2', category='Beatmap Packs', filename='lulz2.png')
-def internet_2(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            203,
-            917,
-            1573,
-            1628,
-            1785,
-            2103,
-            2569,
-            3196,
-            3219,
-            3545,
-            3621,
-            4535,
-            5014
+    if budget is None:
+        new_achievements = [
+            achievement for achievement in candidates
+            if check_one(achievement, score, context)
         ]
-    )
+        log_unlocks(score, new_achievements)
+        return new_achievements, []
 
-@register(name='Internet! Pack vol.3', category='Beatmap Packs', filename='lulz3.png')
-def internet_3(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            1839,
-            3337,
-            3367,
-            3688,
-            5703,
-            5709,
-            5823,
-            6526,
-            6626,
-            7506,
-            7507,
-            8034,
-            8690
-        ]
-    )
+    # The session of the submission can't be used by other threads,
+    # so everything that the checks share is loaded beforehand
+    for attribute in inspect(DBScore).column_attrs:
+        getattr(score, attribute.key)
 
-@register(name='Internet! Pack vol.4', category='Beatmap Packs', filename='lulz4.png')
-def internet_4(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            11443,
-            12033,
-            12155,
-            13885,
-            14391,
-            14579,
-            14672,
-            15157,
-            15628,
-            15942,
-            17145,
-            17217,
-            17724
-        ]
-    )
+    for relationship in ('user', 'beatmap'):
+        getattr(score, relationship)
 
-@register(name='Rhythm Game Pack vol.1', category='Beatmap Packs', filename='rhythm1.png')
-def rhythm_game_1(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            1452,
-            1450,
-            1078,
-            1201,
-            1300,
-            1317,
-            1338,
-            210,
-            296,
-            540,
-            564,
-            74,
-            96
-        ]
-    )
-
-@register(name='Rhythm Game Pack vol.2', category='Beatmap Packs', filename='rhythm2.png')
-def rhythm_game_2(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            1207,
-            1567,
-            2534,
-            3302,
-            3435,
-            3499,
-            4887,
-            5087,
-            5177,
-            5275,
-            5321,
-            5349,
-            5577
-        ]
-    )
+    context.stats
 
-@register(name='Rhythm Game Pack vol.3', category='Beatmap Packs', filename='rhythm3.png')
-def rhythm_game_3(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            1206,
-            4357,
-            4617,
-            4772,
-            4954,
-            5180,
-            5672,
-            5696,
-            6598,
-            7094,
-            7237,
-            7612,
-            7983
-        ]
-    )
+    futures = [
+        app.session.achievement_executor.submit(check_isolated, achievement, score, context)
+        for achievement in candidates
+    ]
 
-@register(name='Rhythm Game Pack vol.4', category='Beatmap Packs', filename='rhythm4.png')
-def rhythm_game_4(score: DBScore) -> bool:
-    return check_pack(
-        score,
-        beatmapset_ids=[
-            10842,
-            11135,
-            11488,
-            12052,
-            12190,
-            12710,
-            13249,
-            14572,
-            14778,
-            15241,
-            18492,
-            19809,
-            22401
-        ]
-    )
-
-def get_by_name(name: str):
-    for achievement in achievements:
-        if achievement.name == name:
-            return achievement
-    return None
+    wait(futures, timeout=budget)
 
-def check(score: DBScore, session: Session, ignore_list: List[Achievement] = []) -> List[Achievement]:
-    app.session.logger.debug('Checking for new achievements...')
-
-    results: List[Tuple[Future, Achievement]] = []
     new_achievements: List[Achievement] = []
+    deferred_achievements: List[Achievement] = []
 
-    score.user.stats.sort(
-        key=lambda x: x.mode
-    )
-
-    for achievement in achievements:
-        if achievement.filename in ignore_list:
+    for achievement, future in zip(candidates, futures):
+        if not future.done():
+            # Checks that did not start yet are dropped from the executor
+            future.cancel()
+            deferred_achievements.append(achievement)
             continue
 
-        results.append((
-            app.session.achievement_executor.submit(
-                achievement.check,
-                score
-            ),
-            achievement
-        ))
-
-    for future, achievement in results:
-        try:
-            if not future.result(timeout=15):
-                # Achievement was not unlocked
-                continue
-
+        if future.result():
             new_achievements.append(achievement)
 
-            app.session.logger.info(f'Player {score.user} unlocked achievement: {achievement.name}')
-            app.highlights.submit(
-                score.user_id,
-                score.mode,
-                session,
-                '{}' + f' unlocked an achievement: {achievement.name}',
-                (score.user.name, f'http://osu.{config.DOMAIN_NAME}/u/{score.user_id}')
-            )
-        except TimeoutError as e:
-            app.session.logger.error(
-                f'Achievement check for "{future.__class__.__name__}" timed out: {e}',
-                exc_info=e
-            )
-            continue
+    log_unlocks(score, new_achievements)
+    return new_achievements, deferred_achievements
+
+def log_unlocks(score: DBScore, new_achievements: List[Achievement]) -> None:
+    for achievement in new_achievements:
+        app.session.logger.info(f'Player {score.user} unlocked achievement: {achievement.name}')
+
+def announce(score: DBScore, new_achievements: List[Achievement], session: Session) -> None:
+    """Post new achievements to the highlights"""
+    for achievement in new_achievements:
+        app.highlights.submit(
+            score.user_id,
+            score.mode,
+            session,
+            '{}' + f' unlocked an achievement: {achievement.name}',
+            (score.user.name, f'http://osu.{config.DOMAIN_NAME}/u/{score.user_id}')
+        )
+
+def notify(user_id: int, new_achievements: List[Achievement]) -> None:
+    """Create a notification for new achievements"""
+    if len(new_achievements) > 1:
+        names = [f'"{a.name}"' for a in new_achievements]
+        achievement_names = ', '.join(name for name in names[:-1])
+        notification_header = 'Achievements Unlocked!'
+        notification_message = (
+            'Congratulations for unlocking the '
+            f'{achievement_names} and {names[-1]} achievements!'
+        )
 
-    return new_achievements
+    else:
+        notification_header = 'Achievement Unlocked!'
+        notification_message = (
+            'Congratulations for unlocking the '
+            f'"{new_achievements[0].name}" achievement!'
+        )
+
+    notifications.create(
+        user_id,
+        NotificationType.Achievement.value,
+        notification_header,
+        notification_message,
+        link=f'https://osu.{config.DOMAIN_NAME}/u/{user_id}#achievements'
+    )
@@ -0,0 +1,140 @@
+
+from app.common.database.repositories import scores
+from app.common.database import DBScore
+from app import metrics
+
+from sqlalchemy.orm import Session
+from typing import Iterable, List
+
+import hashlib
+import config
+import math
+import app
+
+# Bloom filters are stored as a bitmap inside redis:
+#   bloom:{name}              Bitmap of the filter
+#   bloom:{name}:ready        Set, once the filter was seeded
+#   bloom:{name}:rebuilding   Bitmap, while a rebuild is in progress
+# As long as a filter is not ready or its bitmap is missing, lookups
+# are unknown and callers have to fall back to the database.
+
+class BloomFilter:
+    def __init__(self, name: str, capacity: int, error_rate: float) -> None:
+        self.name = name
+        self.key = f'bloom:{name}'
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+
+    def __repr__(self) -> str:
+        return f'<BloomFilter "{self.name}" ({self.size} bits, {self.hashes} hashes)>'
+
+    def offsets(self, value: str) -> List[int]:
+        # Double hashing, using both halves of the md5 digest
+        digest = hashlib.md5(value.encode()).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:], 'big') | 1
+
+        return [
+            (first + index * second) % self.size
+            for index in range(self.hashes)
+        ]
+
+    def contains(self, value: str) -> bool | None:
+        """Check if a value might be inside the filter. Returns None, if the filter is not ready."""
+        pipe = app.session.redis.pipeline(transaction=False)
+        # The bitmap itself could have been evicted, while the marker was not
+        pipe.exists(f'{self.key}:ready', self.key)
+
+        for offset in self.offsets(value):
+            pipe.getbit(self.key, offset)
+
+        existing, *bits = pipe.execute()
+
+        if existing < 2:
+            return None
+
+        return all(bits)
+
+    def add(self, value: str) -> None:
+        pipe = app.session.redis.pipeline(transaction=False)
+        pipe.exists(self.key)
+        pipe.exists(f'{self.key}:rebuilding')
+        exists, rebuilding = pipe.execute()
+
+        for offset in self.offsets(value):
+            if exists:
+                # A missing bitmap is not recreated with a single value
+                pipe.setbit(self.key, offset, 1)
+
+            if rebuilding:
+                # Don't lose values that were added during a rebuild
+                pipe.setbit(f'{self.key}:rebuilding', offset, 1)
+
+        pipe.execute()
+
+    def rebuild(self, values: Iterable[str], batch_size: int = 10000) -> int:
+        """Build a new filter from a list of values, and replace the current one with it"""
+        temporary_key = f'{self.key}:rebuilding'
+        app.session.redis.delete(temporary_key)
+
+        # Allocate the whole bitmap at once
+        app.session.redis.setbit(temporary_key, self.size - 1, 0)
+
+        pipe = app.session.redis.pipeline(transaction=False)
+        count = 0
+
+        for value in values:
+            for offset in self.offsets(value):
+                pipe.setbit(temporary_key, offset, 1)
+
+            count += 1
+
+            if count % batch_size == 0:
+                pipe.execute()
+
+        pipe.execute()
+
+        pipe = app.session.redis.pipeline()
+        pipe.rename(temporary_key, self.key)
+        pipe.set(f'{self.key}:ready', 1)
+        pipe.execute()
+
+        return count
+
+replays = BloomFilter(
+    'replays',
+    config.REPLAY_FILTER_CAPACITY,
+    config.REPLAY_FILTER_ERROR_RATE
+)
+
+def rebuild_replays(session: Session) -> int:
+    """Seed the replay filter with every replay checksum inside the database"""
+    checksums = session.query(DBScore.replay_md5) \
+        .filter(DBScore.replay_md5 != None) \
+        .yield_per(10000)
+
+    return replays.rebuild(
+        checksum for checksum, in checksums
+    )
+
+def fetch_duplicate_replay(replay_hash: str, session: Session) -> DBScore | None:
+    """Fetch the score of a replay checksum, if the replay filter considers it a possible duplicate"""
+    result = replays.contains(replay_hash)
+
+    if result is False:
+        metrics.increment('deck_replay_filter_lookups_total', result='miss')
+        return None
+
+    duplicate_score = scores.fetch_by_replay_checksum(replay_hash, session)
+
+    if result is None:
+        # Filter is not ready, so we had to ask the database
+        metrics.increment('deck_replay_filter_lookups_total', result='unavailable')
+        return duplicate_score
+
+    metrics.increment(
+        'deck_replay_filter_lookups_total',
+        result='hit' if duplicate_score else 'false_positive'
+    )
+
+    return duplicate_score
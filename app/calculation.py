@@ -0,0 +1,143 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import Event, Lock, Thread
+from multiprocessing import get_context
+from typing import Any, Callable, Dict
+from itertools import count
+from app import metrics
+
+import config
+import time
+import os
+
+# pp & difficulty calculations run inside a process pool, so that
+# pathological beatmaps can't stall the request threads. Every worker
+# process creates its own pool, since the pool can't be shared after
+# gunicorn forked the workers.
+# Workers report through a queue, once they have picked up a calculation.
+# The deadline only starts then, while the time inside the queue is
+# bounded separately. Calculations that exceed their deadline are not
+# stopped, they keep their worker busy until they have finished.
+
+class Pool:
+    def __init__(self) -> None:
+        context = get_context('spawn')
+        self.started = context.Queue()
+        self.waiting: Dict[int, Event] = {}
+        self.executor = ProcessPoolExecutor(
+            max_workers=config.PP_WORKERS,
+            mp_context=context,
+            initializer=initialize_worker,
+            initargs=(self.started,)
+        )
+
+        Thread(
+            target=self.listen,
+            name='calculation-start',
+            daemon=True
+        ).start()
+
+    def listen(self) -> None:
+        while (task_id := self.started.get()) is not None:
+            with lock:
+                event = self.waiting.pop(task_id, None)
+
+            if event is not None:
+                event.set()
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.started.put(None)
+
+pool: Pool | None = None
+pool_pid: int | None = None
+task_ids = count()
+lock = Lock()
+queued = 0
+
+# Queue of the current worker process
+started_queue = None
+
+def initialize_worker(queue) -> None:
+    global started_queue
+    started_queue = queue
+
+def execute(task_id: int, func: Callable, args: tuple, kwargs: dict) -> Any:
+    """Runs inside the worker process"""
+    started_queue.put(task_id)
+    return func(*args, **kwargs)
+
+def get_pool() -> Pool:
+    global pool, pool_pid
+
+    with lock:
+        if pool is None or pool_pid != os.getpid():
+            pool = Pool()
+            pool_pid = os.getpid()
+
+        return pool
+
+def reset_pool(broken: Pool) -> None:
+    global pool
+
+    with lock:
+        if pool is broken:
+            pool = None
+
+    broken.shutdown()
+
+def run(func: Callable, *args, deadline: float, **kwargs) -> Any:
+    """Run a calculation inside the process pool. Raises a `TimeoutError`, if the deadline was exceeded or the calculation was interrupted."""
+    global queued
+
+    with lock:
+        queued += 1
+        depth = queued
+
+    metrics.observe(
+        'deck_calculation_queue_depth',
+        depth,
+        buckets=metrics.COUNT_BUCKETS
+    )
+
+    current_pool = get_pool()
+    task_id = next(task_ids)
+    started = Event()
+    start = time.perf_counter()
+    result = 'ok'
+
+    with lock:
+        current_pool.waiting[task_id] = started
+
+    try:
+        future = current_pool.executor.submit(execute, task_id, func, args, kwargs)
+
+        # The time inside the queue is bounded by the same amount
+        if not started.wait(timeout=deadline):
+            future.cancel()
+            raise TimeoutError()
+
+        return future.result(timeout=deadline)
+    except TimeoutError:
+        # The calculation will keep running, but its result is ignored
+        result = 'timeout'
+        raise
+    except BrokenProcessPool as e:
+        # A worker process died, e.g. because it ran out of memory
+        result = 'error'
+        reset_pool(current_pool)
+        raise TimeoutError() from e
+    except Exception:
+        result = 'error'
+        raise
+    finally:
+        with lock:
+            current_pool.waiting.pop(task_id, None)
+            queued -= 1
+
+        metrics.observe(
+            'deck_calculation_seconds',
+            time.perf_counter() - start,
+            function=func.__name__,
+            result=result
+        )
@@ -0,0 +1,52 @@
+
+from app.common.database import DBBeatmap
+
+from sqlalchemy.orm import Session, joinedload
+from typing import Dict, Iterable
+
+import config
+import app
+
+# Checksums that don't belong to any beatmap are cached inside redis:
+#   checksums:missing:{checksum}   Set, if no beatmap has this checksum
+# Clients with large libraries of unsubmitted beatmaps send the same
+# checksums over and over again. Beatmap uploads remove the entries
+# of their new checksums, anything else is picked up after the expiry.
+
+def key(checksum: str) -> str:
+    return f'checksums:missing:{checksum}'
+
+def fetch_many(checksums: Iterable[str], session: Session) -> Dict[str, DBBeatmap]:
+    """Resolve beatmaps & their beatmapsets by their checksums in one query"""
+    checksums = list(dict.fromkeys(checksum for checksum in checksums if checksum))
+
+    if not checksums:
+        return {}
+
+    missing = app.session.redis.mget([key(checksum) for checksum in checksums])
+    unknown = [checksum for checksum, miss in zip(checksums, missing) if not miss]
+
+    if not unknown:
+        return {}
+
+    found_beatmaps = session.query(DBBeatmap) \
+        .options(joinedload(DBBeatmap.beatmapset)) \
+        .filter(DBBeatmap.md5.in_(unknown)) \
+        .all()
+
+    beatmaps = {beatmap.md5: beatmap for beatmap in found_beatmaps}
+    misses = [checksum for checksum in unknown if checksum not in beatmaps]
+
+    if misses:
+        pipe = app.session.redis.pipeline()
+
+        for checksum in misses:
+            pipe.set(key(checksum), 1, ex=config.MISSING_CHECKSUM_EXPIRY)
+
+        pipe.execute()
+
+    return beatmaps
+
+def forget(checksum: str) -> None:
+    """Remove a checksum from the known misses, once a beatmap was uploaded with it"""
+    app.session.redis.delete(key(checksum))
@@ -0,0 +1,72 @@
+
+from app.common.database import DBScore
+from datetime import timedelta
+from typing import List, Tuple
+
+import time
+import app
+
+# Rolling activity of players is counted inside redis, so that
+# time-based achievements don't need to scan the scores table:
+#   counters:plays:{user_id}:{beatmap_id}:{mode}:{hour}   Plays inside that hour
+#   counters:grades:{user_id}:{mode}                      List of the latest "beatmap_id:grade"
+#   counters:drank:{user_id}:{beatmap_id}                 Set, if a D rank was set recently
+# Every key expires on its own, once it has left its window.
+
+PLAYS_WINDOW = timedelta(days=1)
+GRADES_EXPIRY = timedelta(days=7)
+GRADES_LENGTH = 5
+DRANK_WINDOW = timedelta(days=1)
+
+def current_hour() -> int:
+    return int(time.time() // 3600)
+
+def record(score: DBScore) -> None:
+    """Count a new submission"""
+    hour = current_hour()
+    plays_key = f'counters:plays:{score.user_id}:{score.beatmap_id}:{score.mode}:{hour}'
+    grades_key = f'counters:grades:{score.user_id}:{score.mode}'
+
+    pipe = app.session.redis.pipeline()
+    pipe.incr(plays_key)
+    # Keep the bucket, until the last hour of the window has passed
+    pipe.expire(plays_key, PLAYS_WINDOW + timedelta(hours=1))
+    pipe.lpush(grades_key, f'{score.beatmap_id}:{score.grade}')
+    pipe.ltrim(grades_key, 0, GRADES_LENGTH - 1)
+    pipe.expire(grades_key, GRADES_EXPIRY)
+
+    if score.grade == 'D':
+        pipe.set(f'counters:drank:{score.user_id}:{score.beatmap_id}', 1, ex=DRANK_WINDOW)
+
+    pipe.execute()
+
+def plays(user_id: int, beatmap_id: int, mode: int) -> int:
+    """Get the amount of plays on a beatmap inside the last day"""
+    hour = current_hour()
+    hours = int(PLAYS_WINDOW.total_seconds() // 3600)
+
+    counts = app.session.redis.mget([
+        f'counters:plays:{user_id}:{beatmap_id}:{mode}:{hour - offset}'
+        for offset in range(hours)
+    ])
+
+    return sum(int(count) for count in counts if count)
+
+def recent_grades(user_id: int, mode: int) -> List[Tuple[int, str]]:
+    """Get the beatmap ids & grades of the latest submissions"""
+    entries = app.session.redis.lrange(
+        f'counters:grades:{user_id}:{mode}',
+        0, GRADES_LENGTH - 1
+    )
+
+    return [
+        (int(beatmap_id), grade)
+        for beatmap_id, grade in (
+            entry.decode().split(':')
+            for entry in entries
+        )
+    ]
+
+def has_recent_drank(user_id: int, beatmap_id: int) -> bool:
+    """Check if a D rank was set on a beatmap inside the last day"""
+    return bool(app.session.redis.exists(f'counters:drank:{user_id}:{beatmap_id}'))
@@ -0,0 +1,116 @@
+
+from titanic_pp_py import Beatmap, Calculator, DifficultyAttributes
+from app.common.database import DBScore
+from app.common.helpers import performance
+from app.common.constants import Mods
+
+from collections import OrderedDict
+from typing import Optional, Tuple
+from threading import Lock
+
+import hashlib
+import config
+import math
+import app
+
+# Difficulty attributes are cached in two tiers:
+#   1. An LRU of parsed beatmaps & their difficulty attributes, inside
+#      every process of the calculation pool
+#   2. The .osu files inside redis, keyed by their md5 checksum
+# Difficulty attributes can't be serialized, so the redis tier only
+# saves us the storage request, while the LRU saves us the parsing
+# and difficulty calculation.
+# NOTE: Every worker process has its own LRU, which is lost once the
+#       pool has to be recreated. The redis tier is shared, and both
+#       tiers are keyed by the checksum, so a changed beatmap file
+#       never reuses the entries of its previous version.
+
+# Mods that don't change the difficulty of a beatmap
+IGNORED_MODS = Mods.NoFail.value | Mods.SuddenDeath.value | Mods.Perfect.value
+
+Key = Tuple[str, int, int]
+
+attributes: "OrderedDict[Key, Tuple[Beatmap, DifficultyAttributes]]" = OrderedDict()
+lock = Lock()
+
+def cache_key(checksum: str, mode: int, mods: int) -> Key:
+    return checksum, mode, mods & ~IGNORED_MODS
+
+def fetch_file(beatmap_id: int, checksum: str) -> Optional[bytes]:
+    """Fetch the .osu file of a beatmap, using the redis cache if possible"""
+    if file := app.session.redis.get(f'beatmaps:file:{checksum}'):
+        return file
+
+    if not (file := app.session.storage.get_beatmap(beatmap_id)):
+        return None
+
+    if hashlib.md5(file).hexdigest() != checksum:
+        # Storage contains a different version of this beatmap, which
+        # must not be cached under this checksum in any of the tiers
+        return None
+
+    store_file(checksum, file)
+    return file
+
+def store_file(checksum: str, file: bytes) -> None:
+    app.session.redis.set(
+        f'beatmaps:file:{checksum}', file,
+        ex=config.DIFFICULTY_CACHE_EXPIRY
+    )
+
+def fetch(beatmap_id: int, checksum: str, mode: int, mods: int) -> Optional[Tuple[Beatmap, DifficultyAttributes]]:
+    """Fetch the parsed beatmap and its difficulty attributes for a mode & mod combination"""
+    key = cache_key(checksum, mode, mods)
+
+    with lock:
+        if key in attributes:
+            attributes.move_to_end(key)
+            return attributes[key]
+
+    if not (file := fetch_file(beatmap_id, checksum)):
+        return None
+
+    parsed_beatmap = Beatmap(bytes=file)
+    difficulty = Calculator(mode=mode, mods=mods).difficulty(parsed_beatmap)
+
+    with lock:
+        attributes[key] = (parsed_beatmap, difficulty)
+
+        while len(attributes) > config.DIFFICULTY_CACHE_SIZE:
+            attributes.popitem(last=False)
+
+    return parsed_beatmap, difficulty
+
+def calculate_ppv2(score: DBScore, checksum: str, passed: bool) -> Optional[float]:
+    """Calculate the pp of a score, reusing cached difficulty attributes for passed scores
+
+    This will be called inside the calculation pool, so the score
+    has to be a transient object, that is not bound to a session.
+    """
+    if not passed:
+        return performance.calculate_ppv2(score)
+
+    if not (result := fetch(score.beatmap_id, checksum, score.mode, score.mods)):
+        return performance.calculate_ppv2(score)
+
+    parsed_beatmap, difficulty = result
+
+    calculator = Calculator(
+        mode=score.mode,
+        mods=score.mods,
+        n300=score.n300,
+        n100=score.n100,
+        n50=score.n50,
+        n_geki=score.nGeki,
+        n_katu=score.nKatu,
+        n_misses=score.nMiss,
+        combo=score.max_combo,
+        difficulty=difficulty
+    )
+
+    pp = calculator.performance(parsed_beatmap).pp
+
+    if math.isnan(pp) or math.isinf(pp):
+        return 0.0
+
+    return pp
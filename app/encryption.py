@@ -0,0 +1,94 @@
+
+from py3rijndael.constants import shifts, Si, T5, T6, T7, T8
+from py3rijndael import Rijndael
+
+from typing import List, Tuple
+from functools import lru_cache
+
+import base64
+import struct
+
+# Score submissions are encrypted with rijndael, using 256-bit blocks in
+# cbc mode. The key schedule only depends on the key, which will be reused
+# for every submission of the same client version, so it gets cached here.
+# Blocks are decrypted with the round keys & tables of py3rijndael, but
+# without the per-byte conversions of its cbc implementation.
+
+BLOCK_SIZE = 32
+COLUMNS = BLOCK_SIZE // 4
+
+block_struct = struct.Struct(f'>{COLUMNS}I')
+
+# Row shifts for 256-bit blocks, which the unrolled rounds rely on
+assert [row[1] for row in shifts[2]] == [0, 7, 5, 4]
+
+@lru_cache(maxsize=64)
+def round_keys(key: str) -> Tuple[Tuple[int, ...], ...]:
+    """Get the decryption round keys for a key"""
+    return tuple(
+        tuple(round_key)
+        for round_key in Rijndael(key, block_size=BLOCK_SIZE).Kd
+    )
+
+def decrypt_block(block: bytes, keys: Tuple[Tuple[int, ...], ...]) -> bytes:
+    """Decrypt a single 256-bit block"""
+    # The rounds are unrolled for the 8 columns of a 256-bit block,
+    # where the rows are shifted by 0, 7, 5 and 4 columns.
+    k0, k1, k2, k3, k4, k5, k6, k7 = keys[0]
+    s0, s1, s2, s3, s4, s5, s6, s7 = block_struct.unpack(block)
+    s0, s1, s2, s3, s4, s5, s6, s7 = s0 ^ k0, s1 ^ k1, s2 ^ k2, s3 ^ k3, s4 ^ k4, s5 ^ k5, s6 ^ k6, s7 ^ k7
+
+    for k0, k1, k2, k3, k4, k5, k6, k7 in keys[1:-1]:
+        s0, s1, s2, s3, s4, s5, s6, s7 = (
+            T5[s0 >> 24] ^ T6[(s7 >> 16) & 0xFF] ^ T7[(s5 >> 8) & 0xFF] ^ T8[s4 & 0xFF] ^ k0,
+            T5[s1 >> 24] ^ T6[(s0 >> 16) & 0xFF] ^ T7[(s6 >> 8) & 0xFF] ^ T8[s5 & 0xFF] ^ k1,
+            T5[s2 >> 24] ^ T6[(s1 >> 16) & 0xFF] ^ T7[(s7 >> 8) & 0xFF] ^ T8[s6 & 0xFF] ^ k2,
+            T5[s3 >> 24] ^ T6[(s2 >> 16) & 0xFF] ^ T7[(s0 >> 8) & 0xFF] ^ T8[s7 & 0xFF] ^ k3,
+            T5[s4 >> 24] ^ T6[(s3 >> 16) & 0xFF] ^ T7[(s1 >> 8) & 0xFF] ^ T8[s0 & 0xFF] ^ k4,
+            T5[s5 >> 24] ^ T6[(s4 >> 16) & 0xFF] ^ T7[(s2 >> 8) & 0xFF] ^ T8[s1 & 0xFF] ^ k5,
+            T5[s6 >> 24] ^ T6[(s5 >> 16) & 0xFF] ^ T7[(s3 >> 8) & 0xFF] ^ T8[s2 & 0xFF] ^ k6,
+            T5[s7 >> 24] ^ T6[(s6 >> 16) & 0xFF] ^ T7[(s4 >> 8) & 0xFF] ^ T8[s3 & 0xFF] ^ k7,
+        )
+
+    # Last round is special
+    k0, k1, k2, k3, k4, k5, k6, k7 = keys[-1]
+
+    return bytes((
+        (Si[s0 >> 24] ^ (k0 >> 24)) & 0xFF, (Si[(s7 >> 16) & 0xFF] ^ (k0 >> 16)) & 0xFF, (Si[(s5 >> 8) & 0xFF] ^ (k0 >> 8)) & 0xFF, (Si[s4 & 0xFF] ^ k0) & 0xFF,
+        (Si[s1 >> 24] ^ (k1 >> 24)) & 0xFF, (Si[(s0 >> 16) & 0xFF] ^ (k1 >> 16)) & 0xFF, (Si[(s6 >> 8) & 0xFF] ^ (k1 >> 8)) & 0xFF, (Si[s5 & 0xFF] ^ k1) & 0xFF,
+        (Si[s2 >> 24] ^ (k2 >> 24)) & 0xFF, (Si[(s1 >> 16) & 0xFF] ^ (k2 >> 16)) & 0xFF, (Si[(s7 >> 8) & 0xFF] ^ (k2 >> 8)) & 0xFF, (Si[s6 & 0xFF] ^ k2) & 0xFF,
+        (Si[s3 >> 24] ^ (k3 >> 24)) & 0xFF, (Si[(s2 >> 16) & 0xFF] ^ (k3 >> 16)) & 0xFF, (Si[(s0 >> 8) & 0xFF] ^ (k3 >> 8)) & 0xFF, (Si[s7 & 0xFF] ^ k3) & 0xFF,
+        (Si[s4 >> 24] ^ (k4 >> 24)) & 0xFF, (Si[(s3 >> 16) & 0xFF] ^ (k4 >> 16)) & 0xFF, (Si[(s1 >> 8) & 0xFF] ^ (k4 >> 8)) & 0xFF, (Si[s0 & 0xFF] ^ k4) & 0xFF,
+        (Si[s5 >> 24] ^ (k5 >> 24)) & 0xFF, (Si[(s4 >> 16) & 0xFF] ^ (k5 >> 16)) & 0xFF, (Si[(s2 >> 8) & 0xFF] ^ (k5 >> 8)) & 0xFF, (Si[s1 & 0xFF] ^ k5) & 0xFF,
+        (Si[s6 >> 24] ^ (k6 >> 24)) & 0xFF, (Si[(s5 >> 16) & 0xFF] ^ (k6 >> 16)) & 0xFF, (Si[(s3 >> 8) & 0xFF] ^ (k6 >> 8)) & 0xFF, (Si[s2 & 0xFF] ^ k6) & 0xFF,
+        (Si[s7 >> 24] ^ (k7 >> 24)) & 0xFF, (Si[(s6 >> 16) & 0xFF] ^ (k7 >> 16)) & 0xFF, (Si[(s4 >> 8) & 0xFF] ^ (k7 >> 8)) & 0xFF, (Si[s3 & 0xFF] ^ k7) & 0xFF,
+    ))
+
+def decrypt(data: bytes, iv: bytes, keys: Tuple[Tuple[int, ...], ...]) -> bytes:
+    """Decrypt cbc encrypted data & remove its pkcs7 padding"""
+    if len(data) % BLOCK_SIZE or len(iv) != BLOCK_SIZE:
+        raise ValueError('Invalid block length')
+
+    previous = int.from_bytes(iv, 'big')
+    output = bytearray()
+
+    for offset in range(0, len(data), BLOCK_SIZE):
+        block = data[offset:offset + BLOCK_SIZE]
+        decrypted = int.from_bytes(decrypt_block(block, keys), 'big')
+        output += (decrypted ^ previous).to_bytes(BLOCK_SIZE, 'big')
+        previous = int.from_bytes(block, 'big')
+
+    if output:
+        del output[-output[-1]:]
+
+    return bytes(output)
+
+def decrypt_fields(fields: List[str | None], iv: bytes, key: str) -> List[str | None]:
+    """Decrypt all base64 encoded fields of a score submission, which share the same key & iv"""
+    keys = round_keys(key)
+
+    return [
+        decrypt(base64.b64decode(field), iv, keys).decode()
+        if field else None
+        for field in fields
+    ]
@@ -0,0 +1,58 @@
+
+from app.common.database.repositories import relationships
+
+from sqlalchemy.orm import Session
+from typing import List
+
+import config
+import app
+
+# Friends of a player are cached inside redis:
+#   friends:{user_id}         Set of user ids, that the player has added as a friend
+#   friends:{user_id}:ready   Set, once the friends were loaded
+# Relationships are changed through bancho, which can delete the
+# ready marker. Otherwise the friends are reloaded after the expiry,
+# or whenever the client requests its friend list.
+
+def key(user_id: int) -> str:
+    return f'friends:{user_id}'
+
+def store(user_id: int, friend_ids: List[int]) -> None:
+    cache_key = key(user_id)
+    expiry = config.FRIENDS_CACHE_EXPIRY
+
+    pipe = app.session.redis.pipeline()
+    pipe.delete(cache_key)
+
+    if friend_ids:
+        pipe.sadd(cache_key, *friend_ids)
+        pipe.expire(cache_key, expiry)
+
+    pipe.set(f'{cache_key}:ready', 1, ex=expiry)
+    pipe.execute()
+
+def rebuild(user_id: int, session: Session) -> List[int]:
+    """Reload the friends of a player from the database"""
+    friend_ids = relationships.fetch_target_ids(user_id, session=session)
+    store(user_id, friend_ids)
+    return friend_ids
+
+def ensure(user_id: int, session: Session) -> str:
+    cache_key = key(user_id)
+
+    if not app.session.redis.exists(f'{cache_key}:ready'):
+        rebuild(user_id, session)
+
+    return cache_key
+
+def fetch(user_id: int, session: Session) -> List[int]:
+    """Get the user ids of a player's friends"""
+    cache_key = ensure(user_id, session)
+
+    return [
+        int(friend_id)
+        for friend_id in app.session.redis.smembers(cache_key)
+    ]
+
+def invalidate(user_id: int) -> None:
+    app.session.redis.delete(f'{key(user_id)}:ready')
@@ -1,9 +1,9 @@
 
-from app.common.database.repositories import notifications, activities, scores, wrapper
+from app.common.database.repositories import notifications, activities, scores, users, wrapper
+from app import scoreboards, topplays, records
 from app.common.constants import Mods, NotificationType
 from app.common import officer
 from app.common.database import (
-    DBBeatmap,
     DBScore,
     DBStats,
     DBUser
@@ -163,28 +163,33 @@ def check_beatmap(
     if old_rank == beatmap_rank:
         return
 
-    top_scores = scores.fetch_range_scores(
+    top_players = scoreboards.top(
         score.beatmap_id,
         score.mode,
         limit=2,
         session=session
     )
 
-    if len(top_scores) <= 1:
+    if len(top_players) <= 1:
         return
 
-    second_place = top_scores[1]
+    second_place_id = top_players[1]
 
-    if second_place.user_id != player.id:
-        submit(
-            second_place.user_id,
-            score.mode,
-            session,
-            '{} ' + 'has lost first place on' + ' {} ' + f'<{mode_name}>',
-            (second_place.user.name, f'http://osu.{config.DOMAIN_NAME}/u/{second_place.user_id}'),
-            (score.beatmap.full_name, f'http://osu.{config.DOMAIN_NAME}/b/{score.beatmap_id}'),
-            submit_to_chat=False
-        )
+    if second_place_id == player.id:
+        return
+
+    if not (second_place := users.fetch_by_id(second_place_id, session=session)):
+        return
+
+    submit(
+        second_place.id,
+        score.mode,
+        session,
+        '{} ' + 'has lost first place on' + ' {} ' + f'<{mode_name}>',
+        (second_place.name, f'http://osu.{config.DOMAIN_NAME}/u/{second_place.id}'),
+        (score.beatmap.full_name, f'http://osu.{config.DOMAIN_NAME}/b/{score.beatmap_id}'),
+        submit_to_chat=False
+    )
 
 def check_pp(
     score: DBScore,
@@ -193,16 +198,16 @@ def check_pp(
     session: Session
 ) -> None:
     # Get current pp record for mode
-    result = scores.fetch_pp_record(
+    record_id = records.fetch_pp_record(
         score.mode,
         session=session
     )
 
-    if not result:
+    if not record_id:
         # No score has been set, yet
         return
 
-    if score.id == result.id:
+    if score.id == record_id:
         # Player has set the new pp record
         submit(
             player.id,
@@ -215,25 +220,17 @@ def check_pp(
         return
 
     # Check player's current top plays
-    query = session.query(DBScore) \
-            .filter(DBScore.mode == score.mode) \
-            .filter(DBScore.user_id == player.id) \
-            .filter(DBScore.status_pp == 3) \
-            .filter(DBScore.hidden == False)
-
-    # Exclude approved map rewards if specified in the config
-    if not config.APPROVED_MAP_REWARDS:
-        query = query.filter(DBBeatmap.status in (1, 2)) \
-                     .join(DBScore.beatmap)
-
-    result = query.order_by(DBScore.pp.desc()) \
-                  .first()
+    top_play_id = topplays.fetch_top_play(
+        player.id,
+        score.mode,
+        session=session
+    )
 
-    if not result:
+    if not top_play_id:
         # Player has no top plays
         return
 
-    if score.id == result.id:
+    if score.id == top_play_id:
         # Player got a new top play
         submit(
             player.id,
@@ -0,0 +1,243 @@
+
+from contextlib import contextmanager
+from typing import Iterator, Tuple, List
+from redis.client import Pipeline
+
+import threading
+import json
+import time
+import app
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the histogram buckets, for counts & queue sizes
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250)
+
+# NOTE: Metrics are stored inside redis, so that every
+#       worker process contributes to the same values:
+#   metrics:counter:{name}     Hash of labels -> value
+#   metrics:histogram:{name}   Hash of labels|bucket -> cumulative count
+#   metrics:buckets:{name}     Bucket bounds of a histogram
+#   metrics:exemplars:{name}   Hash of labels|bucket -> latest exemplar
+
+# Pipeline of the active batch, for every thread
+active = threading.local()
+
+def format_labels(labels: dict) -> str:
+    return ','.join(
+        f'{key}="{value}"'
+        for key, value in sorted(labels.items())
+    )
+
+def add_observation(
+    pipe: Pipeline,
+    name: str,
+    value: float,
+    buckets: Tuple[float, ...] = BUCKETS,
+    exemplar: dict | None = None,
+    **labels
+) -> None:
+    label_string = format_labels(labels)
+    key = f'metrics:histogram:{name}'
+
+    pipe.sadd('metrics:histograms', name)
+    pipe.set(f'metrics:buckets:{name}', ','.join(map(str, buckets)))
+
+    for bucket in buckets:
+        if value <= bucket:
+            pipe.hincrby(key, f'{label_string}|{bucket}', 1)
+
+    pipe.hincrby(key, f'{label_string}|+Inf', 1)
+    pipe.hincrbyfloat(key, f'{label_string}|sum', value)
+
+    if not exemplar:
+        return
+
+    # Exemplars are attached to the smallest bucket of the value
+    bucket = next((str(b) for b in buckets if value <= b), '+Inf')
+
+    pipe.hset(
+        f'metrics:exemplars:{name}',
+        f'{label_string}|{bucket}',
+        json.dumps({
+            'labels': format_labels(exemplar),
+            'value': value,
+            'timestamp': time.time()
+        })
+    )
+
+def observe(
+    name: str,
+    value: float,
+    buckets: Tuple[float, ...] = BUCKETS,
+    exemplar: dict | None = None,
+    **labels
+) -> None:
+    """Add an observation to a histogram"""
+    with pipeline() as pipe:
+        add_observation(pipe, name, value, buckets, exemplar, **labels)
+
+def increment(name: str, amount: int = 1, **labels) -> None:
+    """Increment a counter"""
+    with pipeline() as pipe:
+        pipe.sadd('metrics:counters', name)
+        pipe.hincrby(f'metrics:counter:{name}', format_labels(labels), amount)
+
+@contextmanager
+def pipeline() -> Iterator[Pipeline]:
+    """Get the pipeline of the active batch, or one that is executed right away"""
+    if (pipe := getattr(active, 'pipe', None)) is not None:
+        yield pipe
+        return
+
+    pipe = app.session.redis.pipeline(transaction=False)
+    yield pipe
+    pipe.execute()
+
+@contextmanager
+def batch() -> Iterator[None]:
+    """Collect the metrics of a block, and send them to redis in a single round trip"""
+    if getattr(active, 'pipe', None) is not None:
+        # Already inside of a batch
+        yield
+        return
+
+    active.pipe = app.session.redis.pipeline(transaction=False)
+
+    try:
+        yield
+    finally:
+        pipe, active.pipe = active.pipe, None
+
+        try:
+            pipe.execute()
+        except Exception as e:
+            app.session.logger.warning(f'Failed to record metrics: {e}')
+
+@contextmanager
+def timer(name: str, **labels) -> Iterator[None]:
+    """Measure the execution time of a block and add it to a histogram"""
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+class Trace:
+    """Measures the named spans of a request, which get recorded once it has finished"""
+
+    def __init__(self, name: str, slow_threshold: float) -> None:
+        self.name = name
+        self.slow_threshold = slow_threshold
+        self.spans: List[Tuple[str, float]] = []
+        self.start = time.perf_counter()
+        self.last_mark = self.start
+        self.finished = False
+
+    def __repr__(self) -> str:
+        return f'<Trace "{self.name}" ({len(self.spans)} spans)>'
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.last_mark = time.perf_counter()
+            self.spans.append((name, self.last_mark - start))
+
+    def mark(self, name: str) -> None:
+        """End a span, that started with the previous mark"""
+        now = time.perf_counter()
+        self.spans.append((name, now - self.last_mark))
+        self.last_mark = now
+
+    def finish(self, **exemplar) -> None:
+        """Record all spans, and attach the exemplar to them if the request was slow"""
+        if self.finished:
+            return
+
+        self.finished = True
+        duration = time.perf_counter() - self.start
+
+        if duration < self.slow_threshold:
+            exemplar = {}
+
+        with pipeline() as pipe:
+            for span, span_duration in self.spans:
+                add_observation(
+                    pipe,
+                    f'{self.name}_span_seconds',
+                    span_duration,
+                    exemplar=exemplar,
+                    span=span
+                )
+
+            add_observation(
+                pipe,
+                f'{self.name}_seconds',
+                duration,
+                exemplar=exemplar
+            )
+
+def render(openmetrics: bool = False) -> str:
+    """Render all metrics in the prometheus text format, or as openmetrics with exemplars"""
+    counters = sorted(name.decode() for name in app.session.redis.smembers('metrics:counters'))
+    histograms = sorted(name.decode() for name in app.session.redis.smembers('metrics:histograms'))
+    lines: List[str] = []
+
+    pipe = app.session.redis.pipeline(transaction=False)
+
+    for name in counters:
+        pipe.hgetall(f'metrics:counter:{name}')
+
+    for name in histograms:
+        pipe.get(f'metrics:buckets:{name}')
+        pipe.hgetall(f'metrics:histogram:{name}')
+        pipe.hgetall(f'metrics:exemplars:{name}')
+
+    results = iter(pipe.execute())
+
+    for name in counters:
+        values = next(results)
+
+        # Openmetrics doesn't include the "_total" suffix in the family name
+        family = name.removesuffix('_total') if openmetrics else name
+        lines.append(f'# TYPE {family} counter')
+
+        for labels, value in sorted(values.items()):
+            lines.append(f'{name}{{{labels.decode()}}} {int(value)}')
+
+    for name in histograms:
+        buckets = (next(results) or b'').decode().split(',')
+        values = {key.decode(): value for key, value in next(results).items()}
+        exemplars = {key.decode(): value for key, value in next(results).items()}
+
+        label_sets = sorted({key.rsplit('|', 1)[0] for key in values})
+        lines.append(f'# TYPE {name} histogram')
+
+        for labels in label_sets:
+            prefix = f'{labels},' if labels else ''
+
+            for bucket in [*filter(None, buckets), '+Inf']:
+                line = (
+                    f'{name}_bucket{{{prefix}le="{bucket}"}} '
+                    f'{int(values.get(f"{labels}|{bucket}", 0))}'
+                )
+
+                if openmetrics and (exemplar := exemplars.get(f'{labels}|{bucket}')):
+                    exemplar = json.loads(exemplar)
+                    line += f' # {{{exemplar["labels"]}}} {exemplar["value"]} {exemplar["timestamp"]}'
+
+                lines.append(line)
+
+            lines.append(f'{name}_sum{{{labels}}} {float(values.get(f"{labels}|sum", 0))}')
+            lines.append(f'{name}_count{{{labels}}} {int(values.get(f"{labels}|+Inf", 0))}')
+
+    if openmetrics:
+        lines.append('# EOF')
+
+    return '\n'.join(lines) + '\n'
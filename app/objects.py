@@ -1,9 +1,14 @@
 
-from typing import Optional
+from typing import Optional, List, Dict
 from datetime import datetime
-from app.common.database.repositories import scores
+from sqlalchemy import and_, or_, case
+from sqlalchemy.orm import Session
 from app.common.helpers import performance
 from app.common import officer
+from app.replays import ReplaySummary
+from app.metrics import Trace
+from app import difficulty, calculation
+from concurrent.futures import TimeoutError
 from app.common.database import (
     DBBeatmap,
     DBScore,
@@ -34,6 +39,18 @@ class Chart(dict):
         return "|".join(f"{str(k)}:{str(v)}" for k, v in self.items())
 
 class Score:
+    __slots__ = (
+        'file_checksum', 'username', 'score_checksum',
+        'c300', 'c100', 'c50', 'cGeki', 'cKatu', 'cMiss',
+        'total_score', 'max_combo', 'perfect', 'grade', 'enabled_mods',
+        'mode', 'flags', 'passed', 'exited', 'version', 'failtime', 'replay',
+        'status_pp', 'status_score', 'is_legacy', 'pp_pending', 'ppv1', 'pp',
+        'session', 'personal_best_score', 'personal_best_pp', 'beatmap', 'user',
+        'fun_spoiler', 'client_hash', 'processes', 'replay_summary',
+        'total_hits', 'total_objects', 'accuracy', 'database_score', 'trace',
+        'deferred_achievements'
+    )
+
     def __init__(
         self,
         file_checksum: str,
@@ -74,7 +91,6 @@ class Score:
         self.perfect = perfect
         self.grade = grade
         self.enabled_mods = enabled_mods
-        self.username = username
 
         self.mode = mode
         self.flags = flags
@@ -87,6 +103,8 @@ class Score:
         self.status_pp = ScoreStatus.Submitted
         self.status_score = ScoreStatus.Submitted
         self.is_legacy = True
+        self.pp_pending = False
+        self.deferred_achievements: List[str] = []
         self.ppv1 = 0.0
         self.pp = 0.0
 
@@ -100,12 +118,20 @@ class Score:
         self.fun_spoiler: Optional[str] = None
         self.client_hash: Optional[str] = None
         self.processes: Optional[str] = None
+        self.replay_summary: Optional[ReplaySummary] = None
+        self.database_score: Optional[DBScore] = None
+        self.trace: Optional[Trace] = None
 
         if passed:
             # "Fix" for old clients
             self.failtime = None
             self.exited = None
 
+        # The hit counts won't change after parsing
+        self.total_hits = self.calculate_total_hits()
+        self.total_objects = self.calculate_total_objects()
+        self.accuracy = self.calculate_accuracy()
+
     def __repr__(self) -> str:
         return f'<Score {self.username} ({self.score_checksum})>'
     
@@ -129,8 +155,7 @@ class Score:
 
         return self.failtime // 1000
 
-    @property
-    def total_hits(self) -> int:
+    def calculate_total_hits(self) -> int:
         """Total amount of note hits in this score"""
         if self.mode in (GameMode.OsuMania, GameMode.Taiko):
             # taiko uses geki & katu for hitting big notes with 2 keys
@@ -140,8 +165,7 @@ class Score:
         # standard and fruits
         return self.c50 + self.c100 + self.c300
 
-    @property
-    def total_objects(self) -> int:
+    def calculate_total_objects(self) -> int:
         """Total amount of passed objects in this score, used for accuracy calculation"""
         if self.mode in (GameMode.Osu, GameMode.Taiko):
             return self.c50 + self.c100 + self.c300 + self.cMiss
@@ -152,8 +176,7 @@ class Score:
         else:
             return self.c50 + self.c100 + self.c300 + self.cGeki + self.cKatu + self.cMiss
 
-    @property
-    def accuracy(self) -> float:
+    def calculate_accuracy(self) -> float:
         if self.total_objects == 0:
             return 0.0
 
@@ -210,8 +233,19 @@ class Score:
         return result
 
     def calculate_ppv2(self) -> float:
-        score = self.to_database()
-        result = performance.calculate_ppv2(score)
+        try:
+            result = calculation.run(
+                difficulty.calculate_ppv2,
+                self.to_database(),
+                self.beatmap.md5,
+                self.passed,
+                deadline=config.PP_CALCULATION_DEADLINE
+            )
+        except TimeoutError:
+            # Score will be stored without pp, and recalculated later
+            app.session.logger.warning(f'pp calculation for {self} exceeded its deadline')
+            self.pp_pending = True
+            return 0.0
 
         if result is None:
             officer.call('Failed to calculate pp: No result')
@@ -219,8 +253,8 @@ class Score:
 
         return result
 
-    def calculate_pp_status(self) -> ScoreStatus:
-        """Set the performance status of this score, and the personal best of the user
+    def resolve_personal_bests(self) -> None:
+        """Resolve the pp & score status of this score, and demote the previous personal bests
 
         The score "status" determines if a score is a
             - Personal best
@@ -229,121 +263,97 @@ class Score:
             - Failed/Exited score
             - Hidden score
         """
+        personal_bests = PersonalBests.fetch(self, self.session)
+        self.personal_best_pp = personal_bests.pp
+        self.personal_best_score = personal_bests.score
+
+        self.status_pp = self.calculate_pp_status(personal_bests)
+        self.status_score = self.calculate_score_status(personal_bests)
+        personal_bests.apply(self.session)
+
+    def calculate_pp_status(self, personal_bests: "PersonalBests") -> ScoreStatus:
+        """Get the performance status of this score, and mark the previous personal best for demotion"""
         if not config.ALLOW_RELAX and self.relaxing:
             return ScoreStatus.Hidden
 
         if not self.passed:
             return ScoreStatus.Exited if self.exited else ScoreStatus.Failed
 
-        if not self.personal_best_pp:
+        if not personal_bests.pp:
             return ScoreStatus.Best
 
-        # Use pp to determine the better score, but fallback
-        # to total score, if the pp is the same (spin to win)
-        better_score = (
-            self.pp > self.personal_best_pp.pp
-            if round(self.pp) != round(self.personal_best_pp.pp)
-            else self.total_score > self.personal_best_pp.total_score
+        better_score = PersonalBests.better_pp(
+            self.pp,
+            self.total_score,
+            personal_bests.pp
         )
 
         if not better_score:
-            if self.enabled_mods.value == self.personal_best_pp.mods:
+            if self.enabled_mods.value == personal_bests.pp.mods:
                 return ScoreStatus.Submitted
 
             # Check pb with mods
-            mods_pb = scores.fetch_personal_best(
-                self.beatmap.id,
-                self.user.id,
-                self.mode.value,
-                self.enabled_mods.value,
-                self.session
-            )
-
-            if not mods_pb:
+            if not (mods_pb := personal_bests.pp_mods):
                 return ScoreStatus.Mods
 
             if self.total_score < mods_pb.total_score:
                 return ScoreStatus.Submitted
 
             # Change status for old personal best
-            self.session.query(DBScore) \
-                .filter(DBScore.id == mods_pb.id) \
-                .update({'status_pp': ScoreStatus.Submitted.value})
-            self.session.commit()
+            personal_bests.demote(mods_pb, 'status_pp', ScoreStatus.Submitted)
             return ScoreStatus.Mods
 
         # New pb was set
-        status = {'status_pp': ScoreStatus.Submitted.value} \
-            if self.enabled_mods.value == self.personal_best_pp.mods else \
-            {'status_pp': ScoreStatus.Mods.value}
-
-        self.session.query(DBScore) \
-            .filter(DBScore.id == self.personal_best_pp.id) \
-            .update(status)
+        personal_bests.demote(
+            personal_bests.pp,
+            'status_pp',
+            ScoreStatus.Submitted
+            if self.enabled_mods.value == personal_bests.pp.mods else
+            ScoreStatus.Mods
+        )
 
-        self.session.commit()
         return ScoreStatus.Best
-    
-    def calculate_score_status(self) -> ScoreStatus:
-        """Set the score status of this score, and the personal best of the user
 
-        The score "status" determines if a score is a
-            - Personal best
-            - Personal best with mod combination
-            - Submitted score
-            - Failed/Exited score
-            - Hidden score
-        """
+    def calculate_score_status(self, personal_bests: "PersonalBests") -> ScoreStatus:
+        """Get the score status of this score, and mark the previous personal best for demotion"""
         if not config.ALLOW_RELAX and self.relaxing:
             return ScoreStatus.Hidden
 
         if not self.passed:
             return ScoreStatus.Exited if self.exited else ScoreStatus.Failed
 
-        if not self.personal_best_score:
+        if not personal_bests.score:
             return ScoreStatus.Best
 
         # Use score to determine the better score
         better_score = (
-            self.total_score > self.personal_best_score.total_score
+            self.total_score > personal_bests.score.total_score
         )
 
         if not better_score:
-            if self.enabled_mods.value == self.personal_best_score.mods:
+            if self.enabled_mods.value == personal_bests.score.mods:
                 return ScoreStatus.Submitted
 
             # Check pb with mods
-            mods_pb = scores.fetch_personal_best_score(
-                self.beatmap.id,
-                self.user.id,
-                self.mode.value,
-                self.enabled_mods.value,
-                self.session
-            )
-
-            if not mods_pb:
+            if not (mods_pb := personal_bests.score_mods):
                 return ScoreStatus.Mods
 
             if self.total_score < mods_pb.total_score:
                 return ScoreStatus.Submitted
 
             # Change status for old personal best
-            self.session.query(DBScore) \
-                .filter(DBScore.id == mods_pb.id) \
-                .update({'status_score': ScoreStatus.Submitted.value})
-            self.session.commit()
+            personal_bests.demote(mods_pb, 'status_score', ScoreStatus.Submitted)
             return ScoreStatus.Mods
 
         # New pb was set
-        status = {'status_score': ScoreStatus.Submitted.value} \
-            if self.enabled_mods.value == self.personal_best_score.mods else \
-            {'status_score': ScoreStatus.Mods.value}
-
-        self.session.query(DBScore) \
-            .filter(DBScore.id == self.personal_best_score.id) \
-            .update(status)
+        personal_bests.demote(
+            personal_bests.score,
+            'status_score',
+            ScoreStatus.Submitted
+            if self.enabled_mods.value == personal_bests.score.mods else
+            ScoreStatus.Mods
+        )
 
-        self.session.commit()
         return ScoreStatus.Best
 
     def check_invalid_mods(self) -> bool:
@@ -436,7 +446,27 @@ class Score:
         )
 
     def to_database(self) -> DBScore:
-        """Convert this object into a `DBScore` object, which can be used with sqlalchemy"""
+        """Get the `DBScore` object of this score, which can be used with sqlalchemy
+
+        The object will only be created once, and the values that
+        can change during the submission are updated on every call.
+        """
+        if self.database_score is None:
+            self.database_score = self.create_database_score()
+
+        score = self.database_score
+        score.client_version = self.version
+        # Invalid mod combinations are cleaned up during the validation
+        score.mods = self.enabled_mods.value
+        score.pp = round(self.pp, 8)
+        score.ppv1 = round(self.ppv1, 8)
+        score.total_score = self.total_score
+        score.status_pp = self.status_pp.value
+        score.status_score = self.status_score.value
+        return score
+
+    def create_database_score(self) -> DBScore:
+        """Convert this object into a new `DBScore` object"""
         return DBScore(
             beatmap_id=self.beatmap.id,
             user_id=self.user.id,
@@ -466,3 +496,117 @@ class Score:
                 if self.replay else None
             )
         )
+
+class PersonalBests:
+    """Personal bests of a player on a beatmap, for both pp and score"""
+
+    def __init__(self, candidates: List[DBScore], mods: int) -> None:
+        self.pp = self.find(candidates, 'status_pp')
+        self.score = self.find(candidates, 'status_score')
+        self.pp_mods = self.find(candidates, 'status_pp', mods)
+        self.score_mods = self.find(candidates, 'status_score', mods)
+        self.demotions: Dict[int, Dict[str, int]] = {}
+
+    @staticmethod
+    def find(candidates: List[DBScore], column: str, mods: int | None = None) -> DBScore | None:
+        if mods is None:
+            return next(
+                (s for s in candidates if getattr(s, column) == ScoreStatus.Best.value),
+                None
+            )
+
+        return next(
+            (
+                s for s in candidates
+                if s.mods == mods
+                and getattr(s, column) in (ScoreStatus.Best.value, ScoreStatus.Mods.value)
+            ),
+            None
+        )
+
+    @staticmethod
+    def better_pp(pp: float, total_score: int, personal_best: DBScore) -> bool:
+        # Use pp to determine the better score, but fallback
+        # to total score, if the pp is the same (spin to win)
+        return (
+            pp > personal_best.pp
+            if round(pp) != round(personal_best.pp)
+            else total_score > personal_best.total_score
+        )
+
+    @classmethod
+    def fetch(cls, score: Score, session: Session) -> "PersonalBests":
+        return cls.query(
+            score.beatmap.id,
+            score.user.id,
+            score.mode.value,
+            score.enabled_mods.value,
+            session
+        )
+
+    @classmethod
+    def query(
+        cls,
+        beatmap_id: int,
+        user_id: int,
+        mode: int,
+        mods: int,
+        session: Session,
+        exclude_id: int | None = None
+    ) -> "PersonalBests":
+        """Load the overall & mod-specific personal bests in a single query"""
+        best = ScoreStatus.Best.value
+        statuses = (ScoreStatus.Best.value, ScoreStatus.Mods.value)
+
+        candidates = session.query(DBScore) \
+            .filter(DBScore.beatmap_id == beatmap_id) \
+            .filter(DBScore.user_id == user_id) \
+            .filter(DBScore.mode == mode) \
+            .filter(DBScore.hidden == False) \
+            .filter(or_(
+                DBScore.status_pp == best,
+                DBScore.status_score == best,
+                and_(
+                    DBScore.mods == mods,
+                    or_(
+                        DBScore.status_pp.in_(statuses),
+                        DBScore.status_score.in_(statuses)
+                    )
+                )
+            )) \
+            .all()
+
+        if exclude_id is not None:
+            candidates = [s for s in candidates if s.id != exclude_id]
+
+        return cls(candidates, mods)
+
+    def demote(self, score: DBScore, column: str, status: ScoreStatus) -> None:
+        self.demotions.setdefault(score.id, {})[column] = status.value
+
+    def apply(self, session: Session) -> None:
+        """Write all demotions in one statement, without committing"""
+        if not self.demotions:
+            return
+
+        updates = {}
+
+        for column in ('status_pp', 'status_score'):
+            values = {
+                score_id: columns[column]
+                for score_id, columns in self.demotions.items()
+                if column in columns
+            }
+
+            if not values:
+                continue
+
+            updates[column] = case(
+                values,
+                value=DBScore.id,
+                else_=getattr(DBScore, column)
+            )
+
+        session.query(DBScore) \
+            .filter(DBScore.id.in_(list(self.demotions))) \
+            .update(updates, synchronize_session=False)
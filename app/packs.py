@@ -0,0 +1,162 @@
+
+from app.common.database import DBScore, DBBeatmap
+
+from sqlalchemy.orm import Session, Query
+from redis.client import Pipeline
+from typing import Dict, Iterable, List
+
+import hashlib
+import json
+import app
+
+# The pack progress of a player is stored as a single bitmap inside redis:
+#   packs:{layout}:{user_id}         Bitmap, where every pack has one bit per beatmapset
+#   packs:{layout}:{user_id}:ready   Set, once the bitmap was built
+# A beatmapset counts as completed, once the player has a personal best
+# on one of its beatmaps. The bitmap will be rebuilt from the database,
+# whenever it is missing. The layout is a hash of the registered packs,
+# so that adding or changing a pack never reads bitmaps of another layout.
+
+class Pack:
+    def __init__(self, name: str, beatmapset_ids: List[int], offset: int) -> None:
+        self.name = name
+        self.beatmapset_ids = beatmapset_ids
+        self.offset = offset
+        self.size = len(beatmapset_ids)
+        self.positions = {
+            set_id: offset + index
+            for index, set_id in enumerate(beatmapset_ids)
+        }
+
+    def __repr__(self) -> str:
+        return f'<Pack "{self.name}" ({self.size} beatmapsets)>'
+
+packs: List[Pack] = []
+beatmapsets: Dict[int, List[Pack]] = {}
+layout = ''
+
+def register(name: str, beatmapset_ids: List[int]) -> Pack:
+    """Register a pack, which reserves its bits inside the bitmaps"""
+    global layout
+
+    offset = sum(pack.size for pack in packs)
+    pack = Pack(name, beatmapset_ids, offset)
+    packs.append(pack)
+
+    for set_id in beatmapset_ids:
+        beatmapsets.setdefault(set_id, []).append(pack)
+
+    layout = hashlib.md5(json.dumps([
+        [pack.name, pack.beatmapset_ids]
+        for pack in packs
+    ]).encode()).hexdigest()[:8]
+
+    return pack
+
+def key(user_id: int) -> str:
+    return f'packs:{layout}:{user_id}'
+
+def offsets(set_ids: Iterable[int]) -> List[int]:
+    return [
+        pack.positions[set_id]
+        for set_id in set_ids
+        for pack in beatmapsets.get(set_id, [])
+    ]
+
+def completed_beatmapsets(session: Session) -> Query:
+    """Query the pack beatmapsets, that players have a personal best on"""
+    return session.query(DBScore.user_id, DBBeatmap.set_id) \
+        .join(DBBeatmap, DBBeatmap.id == DBScore.beatmap_id) \
+        .filter(DBBeatmap.set_id.in_(beatmapsets.keys())) \
+        .filter(DBScore.status_pp == 3) \
+        .filter(DBScore.hidden == False) \
+        .distinct()
+
+def write(pipe: Pipeline, user_id: int, set_ids: Iterable[int]) -> None:
+    cache_key = key(user_id)
+    pipe.delete(cache_key)
+
+    for offset in offsets(set_ids):
+        pipe.setbit(cache_key, offset, 1)
+
+    pipe.set(f'{cache_key}:ready', 1)
+
+def rebuild(user_id: int, session: Session) -> None:
+    """Rebuild the pack progress of a player from the database"""
+    rows = completed_beatmapsets(session) \
+        .filter(DBScore.user_id == user_id) \
+        .all()
+
+    pipe = app.session.redis.pipeline()
+    write(pipe, user_id, [set_id for _, set_id in rows])
+    pipe.execute()
+
+def backfill(session: Session, batch_size: int = 1000) -> int:
+    """Rebuild the pack progress of every player with a personal best on any pack"""
+    rows = completed_beatmapsets(session) \
+        .order_by(DBScore.user_id) \
+        .yield_per(10000)
+
+    pipe = app.session.redis.pipeline(transaction=False)
+    current_user, set_ids = None, []
+    count = 0
+
+    for user_id, set_id in rows:
+        if user_id != current_user and current_user is not None:
+            write(pipe, current_user, set_ids)
+            set_ids = []
+            count += 1
+
+            if count % batch_size == 0:
+                pipe.execute()
+
+        current_user = user_id
+        set_ids.append(set_id)
+
+    if current_user is not None:
+        write(pipe, current_user, set_ids)
+        count += 1
+
+    pipe.execute()
+    return count
+
+def update(user_id: int, set_id: int) -> None:
+    """Mark a beatmapset as completed, after a player has set a personal best on it"""
+    if set_id not in beatmapsets:
+        return
+
+    cache_key = key(user_id)
+
+    if not app.session.redis.exists(f'{cache_key}:ready'):
+        # Will be rebuilt on the next lookup
+        return
+
+    pipe = app.session.redis.pipeline()
+
+    for offset in offsets([set_id]):
+        pipe.setbit(cache_key, offset, 1)
+
+    pipe.execute()
+
+def progress(user_id: int, pack: Pack, session: Session) -> int:
+    """Get the completed beatmapsets of a pack as a bitmask"""
+    cache_key = key(user_id)
+
+    if not app.session.redis.exists(f'{cache_key}:ready'):
+        rebuild(user_id, session)
+
+    mask, = app.session.redis.bitfield(cache_key) \
+        .get(f'u{pack.size}', pack.offset) \
+        .execute()
+
+    return mask
+
+def is_completed(user_id: int, pack: Pack, session: Session, set_id: int | None = None) -> bool:
+    """Check if a player has completed every beatmapset of a pack, optionally including a new one"""
+    mask = progress(user_id, pack, session)
+
+    if set_id in pack.positions:
+        # Bitfields are read from the most significant bit
+        mask |= 1 << (pack.size - 1 - (pack.positions[set_id] - pack.offset))
+
+    return mask == (1 << pack.size) - 1
@@ -0,0 +1,476 @@
+
+from app.common.database.repositories import histories, scores, plays, stats, users, achievements
+from app.common.database import DBStats, DBScore
+from app.common.constants import ScoreStatus
+from app import metrics, calculation, difficulty, topplays, records, packs, scoreboards
+from app.restrictions import restrict_player, hide_player, pp_limit
+from app.objects import PersonalBests
+from app.common import officer
+from app import achievements as AchievementManager
+
+from redis.exceptions import ResponseError
+from sqlalchemy.orm import Session
+from sqlalchemy import inspect
+from typing import Callable, Dict, List
+from threading import Thread, Event
+
+import socket
+import uuid
+import config
+import json
+import time
+import app
+import os
+
+# The score submission will only do the work that is required for
+# the response, and hands the remaining stages to a redis stream.
+# Every worker process runs a consumer in the same consumer group.
+# Completed stages are marked per submission, so that retries and
+# messages claimed from stalled consumers don't run them twice:
+#   deck:submissions:done:{submission_id}:{stage}
+# Other services can add messages as well, e.g. to remove scores that
+# were hidden or players that were restricted from the cached leaderboards:
+#   XADD deck:submissions * stages hide_player payload {"user_id": 2}
+#   XADD deck:submissions * stages invalidate_scoreboard payload {"beatmap_id": 75, "mode": 0, "user_id": 2}
+
+STREAM = 'deck:submissions'
+DEAD_LETTERS = 'deck:submissions:dead'
+RETRIES = 'deck:submissions:retry'
+DONE = 'deck:submissions:done'
+DONE_EXPIRY = 86400
+GROUP = 'deck'
+
+stages: Dict[str, Callable[[dict, Session], None]] = {}
+shutdown = Event()
+
+def register(name: str) -> Callable:
+    """Register a pipeline stage"""
+
+    def wrapper(stage: Callable[[dict, Session], None]):
+        stages[name] = stage
+        return stage
+
+    return wrapper
+
+def enqueue(stage_names: List[str], attempts: int = 0, **payload) -> None:
+    """Hand a list of stages over to the submission workers"""
+    payload.setdefault('submission_id', uuid.uuid4().hex)
+
+    app.session.redis.xadd(
+        STREAM,
+        {
+            'stages': ','.join(stage_names),
+            'payload': json.dumps(payload),
+            'attempts': attempts
+        },
+        maxlen=config.PIPELINE_STREAM_LENGTH,
+        approximate=True
+    )
+
+def ensure_group() -> None:
+    try:
+        app.session.redis.xgroup_create(
+            STREAM, GROUP,
+            id='0',
+            mkstream=True
+        )
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def dead_letter(fields: dict, stage: str, error: Exception) -> None:
+    """Move a message into the dead letters, where it has to be inspected manually"""
+    app.session.redis.xadd(
+        DEAD_LETTERS,
+        {**fields, 'error': str(error)},
+        maxlen=config.PIPELINE_STREAM_LENGTH,
+        approximate=True
+    )
+    metrics.increment(
+        'deck_pipeline_dead_letters_total',
+        stage=stage
+    )
+
+def schedule_retry(
+    stage_names: List[str],
+    payload: dict,
+    attempts: int,
+    error: Exception
+) -> None:
+    if attempts >= config.PIPELINE_MAX_ATTEMPTS:
+        app.session.logger.error(
+            f'Pipeline stage "{stage_names[0]}" failed {attempts} times, moving to dead letters: {error}',
+            exc_info=error
+        )
+        dead_letter(
+            {
+                'stages': ','.join(stage_names),
+                'payload': json.dumps(payload),
+                'attempts': attempts
+            },
+            stage_names[0],
+            error
+        )
+        return
+
+    app.session.logger.warning(
+        f'Pipeline stage "{stage_names[0]}" failed, retrying ({attempts}): {error}'
+    )
+
+    # Retry with an exponential backoff
+    retry_at = time.time() + 2 ** attempts
+    message = json.dumps({
+        'stages': stage_names,
+        'payload': payload,
+        'attempts': attempts
+    })
+
+    app.session.redis.zadd(RETRIES, {message: retry_at})
+    metrics.increment('deck_pipeline_retries_total', stage=stage_names[0])
+
+def requeue_retries() -> None:
+    """Move all retries that are due back into the stream"""
+    due = app.session.redis.zrangebyscore(RETRIES, 0, time.time())
+
+    for message in due:
+        if not app.session.redis.zrem(RETRIES, message):
+            # Another consumer was faster
+            continue
+
+        retry = json.loads(message)
+        enqueue(retry['stages'], retry['attempts'], **retry['payload'])
+
+def process(message_id: bytes, fields: Dict[bytes, bytes], claimed: bool = False) -> None:
+    try:
+        stage_names = fields[b'stages'].decode().split(',')
+        attempts = int(fields.get(b'attempts', 0))
+        payload = json.loads(fields[b'payload'])
+    except Exception as e:
+        # Malformed messages would otherwise stay pending forever
+        app.session.logger.error(f'Invalid pipeline message "{message_id.decode()}": {e}', exc_info=e)
+        dead_letter(fields, 'unknown', e)
+        app.session.redis.xack(STREAM, GROUP, message_id)
+        return
+
+    payload.setdefault('submission_id', message_id.decode())
+
+    if claimed:
+        # The consumer of this message has died, possibly because of this
+        # message, so it's re-added with another attempt until it's given up
+        schedule_retry(
+            stage_names,
+            payload,
+            attempts + 1,
+            RuntimeError('Message was claimed from a stalled consumer')
+        )
+        app.session.redis.xack(STREAM, GROUP, message_id)
+        return
+
+    remaining = stage_names
+
+    try:
+        with metrics.batch(), app.session.database.managed_session() as session:
+            for name in stage_names:
+                done_key = f'{DONE}:{payload["submission_id"]}:{name}'
+                start = time.perf_counter()
+
+                if app.session.redis.exists(done_key):
+                    # Stage was completed before, e.g. by a stalled consumer
+                    remaining = remaining[1:]
+                    continue
+
+                try:
+                    stages[name](payload, session)
+                except Exception:
+                    session.rollback()
+                    raise
+
+                app.session.redis.set(done_key, 1, ex=DONE_EXPIRY)
+                remaining = remaining[1:]
+
+                metrics.observe(
+                    'deck_pipeline_stage_seconds',
+                    time.perf_counter() - start,
+                    stage=name
+                )
+    except Exception as e:
+        if remaining:
+            schedule_retry(remaining, payload, attempts + 1, e)
+        else:
+            app.session.logger.error(f'Failed to close pipeline session: {e}', exc_info=e)
+
+    app.session.redis.xack(STREAM, GROUP, message_id)
+
+def consume(consumer: str) -> None:
+    ensure_group()
+
+    while not shutdown.is_set():
+        try:
+            requeue_retries()
+
+            # Take over messages of consumers that have died
+            _, claimed, *_ = app.session.redis.xautoclaim(
+                STREAM, GROUP, consumer,
+                min_idle_time=config.PIPELINE_CLAIM_IDLE * 1000,
+                count=10
+            )
+
+            response = app.session.redis.xreadgroup(
+                GROUP, consumer,
+                {STREAM: '>'},
+                count=10,
+                block=2000
+            )
+        except Exception as e:
+            app.session.logger.error(f'Failed to read from pipeline: {e}', exc_info=e)
+            shutdown.wait(5)
+            continue
+
+        messages = [(message, True) for message in claimed]
+
+        for _, stream_messages in response or []:
+            messages.extend((message, False) for message in stream_messages)
+
+        for (message_id, fields), was_claimed in messages:
+            if not fields:
+                # Message was trimmed from the stream
+                if message_id:
+                    app.session.redis.xack(STREAM, GROUP, message_id)
+                continue
+
+            try:
+                process(message_id, fields, was_claimed)
+            except Exception as e:
+                # The message stays pending, and will be claimed again later
+                app.session.logger.error(f'Failed to process pipeline message: {e}', exc_info=e)
+
+def start() -> None:
+    consumer = f'{socket.gethostname()}-{os.getpid()}'
+    shutdown.clear()
+
+    Thread(
+        target=consume,
+        args=(consumer,),
+        name='pipeline',
+        daemon=True
+    ).start()
+
+def stop() -> None:
+    shutdown.set()
+
+@register('recalculate_pp')
+def recalculate_pp(payload: dict, session: Session) -> None:
+    if not (score := scores.fetch_by_id(payload['score_id'], session)):
+        return
+
+    # Scores that are sent to the calculation pool can't be bound to a session
+    transient_score = DBScore(**{
+        attribute.key: getattr(score, attribute.key)
+        for attribute in inspect(DBScore).column_attrs
+    })
+
+    pp = calculation.run(
+        difficulty.calculate_ppv2,
+        transient_score,
+        score.beatmap.md5,
+        score.status_pp not in (ScoreStatus.Failed.value, ScoreStatus.Exited.value),
+        deadline=config.PP_RECALCULATION_DEADLINE
+    ) or 0.0
+
+    updates = {'pp': round(pp, 8)}
+
+    if score.status_pp in (ScoreStatus.Submitted.value, ScoreStatus.Mods.value):
+        # The score was compared to the personal best without any pp
+        personal_bests = PersonalBests.query(
+            score.beatmap_id,
+            score.user_id,
+            score.mode,
+            score.mods,
+            session,
+            exclude_id=score.id
+        )
+
+        previous_best = personal_bests.pp
+
+        if not previous_best or PersonalBests.better_pp(pp, score.total_score, previous_best):
+            updates['status_pp'] = ScoreStatus.Best.value
+
+            if previous_best:
+                personal_bests.demote(
+                    previous_best,
+                    'status_pp',
+                    ScoreStatus.Submitted
+                    if previous_best.mods == score.mods else
+                    ScoreStatus.Mods
+                )
+                personal_bests.apply(session)
+
+    session.query(DBScore) \
+        .filter(DBScore.id == score.id) \
+        .update(updates, synchronize_session=False)
+
+    # Top plays will be rebuilt with the new pp
+    topplays.invalidate(score.user_id, score.mode)
+
+    user_stats = stats.fetch_by_mode(
+        score.user_id,
+        score.mode,
+        session
+    )
+
+    topplays.update_stats(
+        user_stats,
+        payload['country'],
+        session
+    )
+
+    session.commit()
+
+    # The pp limit could not be checked during the submission
+    if pp >= pp_limit(score.user):
+        officer.call(
+            f'"{score.user.name}" exceeded the pp limit ({pp}).'
+        )
+
+        if not score.user.is_verified:
+            restrict_player(score.user, f'Exceeded pp limit ({round(pp)})', session)
+            return
+
+    if updates.get('status_pp') == ScoreStatus.Best.value:
+        packs.update(score.user_id, score.beatmap.set_id)
+
+    # The pp of the record could have been lowered
+    records.invalidate_score(score.id, score.mode)
+
+    if ScoreStatus.Best.value in (score.status_pp, updates.get('status_pp')):
+        records.submit(score.id, score.mode, updates['pp'])
+
+@register('histories')
+def update_histories(payload: dict, session: Session) -> None:
+    histories.update_plays(
+        payload['user_id'],
+        payload['mode'],
+        session
+    )
+
+    if not payload['has_pb']:
+        return
+
+    user_stats = stats.fetch_by_mode(
+        payload['user_id'],
+        payload['mode'],
+        session
+    )
+
+    histories.update_rank(
+        user_stats,
+        payload['country']
+    )
+
+@register('plays')
+def update_plays(payload: dict, session: Session) -> None:
+    plays.update(
+        payload['beatmap_filename'],
+        payload['beatmap_id'],
+        payload['user_id'],
+        payload['beatmapset_id'],
+        session=session
+    )
+
+@register('grades')
+def update_grades(payload: dict, session: Session) -> None:
+    grades = scores.fetch_grades(
+        payload['user_id'],
+        payload['mode'],
+        session=session
+    )
+
+    stats.update(
+        payload['user_id'],
+        payload['mode'],
+        {
+            f'{grade.lower()}_count': count
+            for grade, count in grades.items()
+        },
+        session=session
+    )
+
+@register('highlights')
+def check_highlights(payload: dict, session: Session) -> None:
+    player = users.fetch_by_id(
+        payload['user_id'],
+        session=session
+    )
+
+    app.highlights.check(
+        payload['score_id'], player,
+        DBStats(**payload['new_stats']),
+        DBStats(**payload['old_stats']),
+        payload['new_rank'],
+        payload['old_rank']
+    )
+
+@register('achievements')
+def unlock_deferred_achievements(payload: dict, session: Session) -> None:
+    if not (score := scores.fetch_by_id(payload['score_id'], session)):
+        return
+
+    # Achievements could have been unlocked in the meantime, e.g. by a retry
+    unlocked = achievements.fetch_many(payload['user_id'], session)
+    ignore_list = [a.filename for a in unlocked]
+
+    candidates = [
+        achievement
+        for filename in payload['achievements']
+        if (achievement := AchievementManager.get_by_filename(filename))
+    ]
+
+    new_achievements, _ = AchievementManager.check(
+        score,
+        session,
+        ignore_list,
+        candidates=candidates
+    )
+
+    if not new_achievements:
+        return
+
+    achievements.create_many(
+        new_achievements,
+        payload['user_id'],
+        session
+    )
+    session.commit()
+
+    AchievementManager.notify(payload['user_id'], new_achievements)
+    AchievementManager.announce(score, new_achievements, session)
+
+    app.session.events.submit(
+        'user_announcement',
+        user_id=payload['user_id'],
+        message='\n'.join(
+            f'You unlocked an achievement: {achievement.name}'
+            for achievement in new_achievements
+        )
+    )
+
+@register('events')
+def submit_events(payload: dict, session: Session) -> None:
+    # Reload stats on bancho
+    app.session.events.submit(
+        'user_update',
+        user_id=payload['user_id'],
+        mode=payload['mode']
+    )
+
+@register('invalidate_scoreboard')
+def invalidate_scoreboard(payload: dict, session: Session) -> None:
+    scoreboards.invalidate(payload['beatmap_id'], payload['mode'])
+    records.invalidate(payload['mode'])
+
+    if user_id := payload.get('user_id'):
+        topplays.invalidate(user_id, payload['mode'])
+
+@register('hide_player')
+def remove_hidden_player(payload: dict, session: Session) -> None:
+    hide_player(payload['user_id'], session)
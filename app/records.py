@@ -0,0 +1,81 @@
+
+from app.common.database.repositories import scores
+from app.common.database import DBScore
+
+from sqlalchemy.orm import Session
+
+import config
+import app
+
+# The pp record of every mode is cached inside redis:
+#   records:pp:{mode}         Sorted set with the score id of the record by pp
+#   records:pp:{mode}:ready   Set, once the record was loaded
+# The database stays the source of truth, and the record will be
+# reloaded from it, whenever it is missing or has expired.
+# Hiding the record score outside of deck should drop the ready marker.
+
+def key(mode: int) -> str:
+    return f'records:pp:{mode}'
+
+def rebuild(mode: int, session: Session) -> None:
+    """Reload the pp record of a mode from the database"""
+    record = scores.fetch_pp_record(mode, session=session)
+    cache_key = key(mode)
+
+    pipe = app.session.redis.pipeline()
+    pipe.delete(cache_key)
+
+    if record:
+        pipe.zadd(cache_key, {record.id: record.pp})
+
+    pipe.set(f'{cache_key}:ready', 1, ex=config.PP_RECORD_CACHE_EXPIRY)
+    pipe.execute()
+
+def submit(score_id: int, mode: int, pp: float) -> None:
+    """Replace the cached pp record, if the score is above it"""
+    cache_key = key(mode)
+
+    if not app.session.redis.exists(f'{cache_key}:ready'):
+        # Will be reloaded on the next lookup
+        return
+
+    # Only the highest entry is kept
+    pipe = app.session.redis.pipeline()
+    pipe.zadd(cache_key, {score_id: pp})
+    pipe.zremrangebyrank(cache_key, 0, -2)
+    pipe.execute()
+
+def invalidate(mode: int) -> None:
+    app.session.redis.delete(f'{key(mode)}:ready')
+
+def invalidate_score(score_id: int, mode: int) -> None:
+    """Reload the pp record, if it is this score, e.g. after its pp were recalculated"""
+    record = app.session.redis.zrevrange(key(mode), 0, 0)
+
+    if record and int(record[0]) == score_id:
+        invalidate(mode)
+
+def remove_player(user_id: int, session: Session) -> None:
+    """Reload the pp records that were set by a player, e.g. after a restriction"""
+    for mode in range(4):
+        record = app.session.redis.zrevrange(key(mode), 0, 0)
+
+        if not record:
+            continue
+
+        record_user_id = session.query(DBScore.user_id) \
+            .filter(DBScore.id == int(record[0])) \
+            .scalar()
+
+        if record_user_id == user_id:
+            invalidate(mode)
+
+def fetch_pp_record(mode: int, session: Session) -> int | None:
+    """Get the score id of the pp record of a mode"""
+    cache_key = key(mode)
+
+    if not app.session.redis.exists(f'{cache_key}:ready'):
+        rebuild(mode, session)
+
+    record = app.session.redis.zrevrange(cache_key, 0, 0)
+    return int(record[0]) if record else None
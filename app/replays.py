@@ -0,0 +1,101 @@
+
+from app.common.constants import ButtonState
+
+from operator import methodcaller
+from typing import Iterator, List
+from array import array
+
+import lzma
+
+# Amount of compressed bytes that will be decompressed at once
+CHUNK_SIZE = 64 * 1024
+
+# Time value of the frame that contains the rng seed
+SEED_FRAME = -12345
+
+# Share of the beatmap length that the frames of a passed replay should cover
+MINIMUM_COVERAGE = 0.5
+
+class ReplayFrames:
+    """Columnar storage for replay frames"""
+
+    def __init__(self) -> None:
+        # Frame times are not validated, and can exceed 32 bits
+        self.time = array('q')
+        self.x = array('f')
+        self.y = array('f')
+        self.keys = array('q')
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def extend(self, frames: List[bytes]) -> None:
+        if not frames:
+            return
+
+        if set(map(methodcaller('count', b'|'), frames)) != {3}:
+            raise ValueError('Invalid frame data')
+
+        fields = b'|'.join(frames).split(b'|')
+        self.time.extend(map(int, fields[0::4]))
+        self.x.extend(map(float, fields[1::4]))
+        self.y.extend(map(float, fields[2::4]))
+        self.keys.extend(map(int, fields[3::4]))
+
+class ReplaySummary:
+    """Compact summary of a validated replay"""
+
+    def __init__(self, frames: ReplayFrames) -> None:
+        self.frame_count = len(frames)
+        self.seed: int | None = None
+
+        times = frames.time
+        keys = frames.keys
+
+        if SEED_FRAME in times:
+            index = times.index(SEED_FRAME)
+            self.seed = keys[index]
+            times = times[:index] + times[index + 1:]
+            keys = keys[:index] + keys[index + 1:]
+
+        # Frame times are stored as the delta to the previous frame
+        self.duration = sum(filter((0).__lt__, times))
+
+        # The first few frames are allowed to go backwards
+        self.backwards_frames = len(list(filter((0).__gt__, times[3:])))
+
+        # Every distinct key state only needs to be validated once
+        self.key_states = {ButtonState(state) for state in set(keys)}
+
+    def __repr__(self) -> str:
+        return (
+            f'<ReplaySummary frames={self.frame_count} '
+            f'duration={self.duration}ms seed={self.seed}>'
+        )
+
+def decompress(replay: bytes) -> Iterator[bytes]:
+    """Decompress the replay data in chunks"""
+    decompressor = lzma.LZMADecompressor()
+
+    for offset in range(0, len(replay), CHUNK_SIZE):
+        yield decompressor.decompress(replay[offset:offset + CHUNK_SIZE])
+
+        if decompressor.eof:
+            break
+
+    if not decompressor.eof:
+        raise lzma.LZMAError('Compressed data ended before the end-of-stream marker was reached')
+
+def parse(replay: bytes) -> ReplaySummary:
+    """Parse the frames of a compressed replay, without keeping the decompressed data in memory"""
+    frames = ReplayFrames()
+    remainder = b''
+
+    for chunk in decompress(replay):
+        *complete, remainder = (remainder + chunk).split(b',')
+        frames.extend([frame for frame in complete if frame])
+
+    if remainder:
+        frames.extend([remainder])
+
+    return ReplaySummary(frames)
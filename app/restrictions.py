@@ -0,0 +1,29 @@
+
+from app.common.database import DBUser
+from sqlalchemy.orm import Session
+from datetime import datetime
+from app import scoreboards, topplays, records
+
+import app
+
+def restrict_player(player: DBUser, reason: str, session: Session) -> None:
+    app.session.events.submit(
+        'restrict',
+        user_id=player.id,
+        autoban=True,
+        reason=reason
+    )
+
+    # Restricted players are hidden from the leaderboards
+    hide_player(player.id, session)
+
+def hide_player(user_id: int, session: Session) -> None:
+    """Remove a player from all cached leaderboards"""
+    scoreboards.remove_player(user_id, session)
+    topplays.invalidate_player(user_id)
+    records.remove_player(user_id, session)
+
+def pp_limit(player: DBUser) -> float:
+    """Get the amount of pp that a single score of a player may not exceed"""
+    account_age = (datetime.now() - player.created_at)
+    return min(1500, max(750, account_age.total_seconds() / 8))
@@ -6,6 +6,7 @@ from . import screenshot
 from . import release
 from . import rating
 from . import static
+from . import metrics
 from . import avatar
 from . import web
 
@@ -17,6 +18,7 @@ router.include_router(screenshot.router, prefix='/ss')
 router.include_router(rating.router, prefix='/rating')
 router.include_router(avatar.router, prefix='/a')
 router.include_router(web.router, prefix='/web')
+router.include_router(metrics.router)
 router.include_router(static.router)
 
 @router.get('/')
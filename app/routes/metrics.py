@@ -0,0 +1,34 @@
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from app import metrics
+
+import config
+import hmac
+
+router = APIRouter()
+
+OPENMETRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PROMETHEUS_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def is_authorized(request: Request) -> bool:
+    if not config.METRICS_TOKEN:
+        # Metrics are disabled without a token
+        return False
+
+    return hmac.compare_digest(
+        request.headers.get('authorization', '').encode(),
+        f'Bearer {config.METRICS_TOKEN}'.encode()
+    )
+
+@router.get('/metrics')
+def prometheus_metrics(request: Request) -> Response:
+    if not is_authorized(request):
+        raise HTTPException(401)
+
+    # Exemplars are only supported by the openmetrics format
+    openmetrics = 'application/openmetrics-text' in request.headers.get('accept', '')
+
+    return Response(
+        metrics.render(openmetrics),
+        media_type=OPENMETRICS_TYPE if openmetrics else PROMETHEUS_TYPE
+    )
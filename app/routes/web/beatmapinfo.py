@@ -2,7 +2,7 @@
 from fastapi import APIRouter, HTTPException, Query, Depends
 from sqlalchemy.orm import Session, selectinload
 from pydantic import BaseModel
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 from app.common.database import DBBeatmap, DBScore
 from app.common.constants import Grade
@@ -18,6 +18,23 @@ class BeatmapInfoRequestForm(BaseModel):
     Filenames: list[str]
     Ids: list[int]
 
+def fetch_grades(user_id: int, beatmap_ids: List[int], session: Session) -> Dict[Tuple[int, int], str]:
+    """Fetch the grades of a player's personal bests on these beatmaps, by beatmap id & mode"""
+    if not beatmap_ids:
+        return {}
+
+    personal_bests = session.query(DBScore.beatmap_id, DBScore.mode, DBScore.grade) \
+        .filter(DBScore.beatmap_id.in_(beatmap_ids)) \
+        .filter(DBScore.user_id == user_id) \
+        .filter(DBScore.status_pp == 3) \
+        .filter(DBScore.hidden == False) \
+        .all()
+
+    return {
+        (beatmap_id, mode): grade
+        for beatmap_id, mode, grade in personal_bests
+    }
+
 @router.post("/osu-getbeatmapinfo.php")
 def get_beatmap_info(
     info: BeatmapInfoRequestForm,
@@ -77,6 +94,13 @@ def get_beatmap_info(
             beatmap
         ))
 
+    # Personal bests of every mode for all beatmaps in one query
+    grades = fetch_grades(
+        player.id,
+        list({beatmap.id for _, beatmap in maps}),
+        session
+    )
+
     # Create beatmap response
     beatmap_infos: List[str] = []
 
@@ -93,24 +117,10 @@ def get_beatmap_info(
         }.get(beatmap.status, beatmap.status)
 
         # Get personal best in every mode for this beatmap
-        grades = {
-            0: Grade.N,
-            1: Grade.N,
-            2: Grade.N,
-            3: Grade.N
-        }
-
-        for mode in range(4):
-            grade = session.query(DBScore.grade) \
-                .filter(DBScore.beatmap_id == beatmap.id) \
-                .filter(DBScore.user_id == player.id) \
-                .filter(DBScore.mode == mode) \
-                .filter(DBScore.status_pp == 3) \
-                .filter(DBScore.hidden == False) \
-                .scalar()
-
-            if grade:
-                grades[mode] = Grade[grade]
+        beatmap_grades = [
+            Grade[grade] if (grade := grades.get((beatmap.id, mode))) else Grade.N
+            for mode in range(4)
+        ]
 
         beatmap_infos.append(
             "|".join(map(str, [
@@ -119,7 +129,7 @@ def get_beatmap_info(
                 beatmap.beatmapset.id,
                 beatmap.md5,
                 response_status,
-                *grades.values()
+                *beatmap_grades
             ]))
         )
 
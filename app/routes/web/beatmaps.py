@@ -14,6 +14,7 @@ from app.common.helpers import performance
 from app.common.streams import StreamIn
 from app.common.cache import status
 from app.common import officer
+from app import checksums
 
 from app.common.database import (
     nominations,
@@ -609,6 +610,11 @@ def update_beatmap_metadata(
         assert difficulty_attributes is not None
         assert beatmap_id is not None
 
+        checksum = hashlib.md5(files[filename]).hexdigest()
+
+        # Clients may have already asked for this beatmap, before it was uploaded
+        checksums.forget(checksum)
+
         beatmaps.update(
             beatmap_id,
             {
@@ -616,7 +622,7 @@ def update_beatmap_metadata(
                 'filename': filename,
                 'last_update': datetime.now(),
                 'total_length': round(beatmap['length'] / 1000),
-                'md5': hashlib.md5(files[filename]).hexdigest(),
+                'md5': checksum,
                 'version': beatmap['difficultyName'] or 'Normal',
                 'mode': beatmap['ruleset']['onlineID'],
                 'bpm': beatmap['bpm'],
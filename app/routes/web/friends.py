@@ -1,7 +1,8 @@
 
 from fastapi import APIRouter, HTTPException, Query, Depends
-from app.common.database import users, relationships
+from app.common.database import users
 from sqlalchemy.orm import Session
+from app import friends
 
 import utils
 import app
@@ -20,9 +21,10 @@ def get_friends(
     if not utils.check_password(password, player.bcrypt):
         raise HTTPException(401)
 
-    friends = relationships.fetch_target_ids(
+    # Refresh the cached friends, while we are at it
+    friend_ids = friends.rebuild(
         player.id,
         session=session
     )
 
-    return "\n".join(map(str, friends)).encode()
+    return "\n".join(map(str, friend_ids)).encode()
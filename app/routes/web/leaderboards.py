@@ -1,8 +1,10 @@
 
 from __future__ import annotations
-from typing import Callable
+from typing import Callable, Dict, List, Tuple
+from functools import cached_property
 
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import func, or_
 from datetime import datetime
 from fastapi import (
     HTTPException,
@@ -13,15 +15,15 @@ from fastapi import (
     Query
 )
 
-from app.common.database import DBBeatmapset, DBScore, DBUser
+from app.common.database import DBBeatmapset, DBBeatmap, DBScore, DBUser
 from app.common.database.repositories import (
-    relationships,
     beatmaps,
     scores,
     users
 )
 
 from app.common.cache import status
+from app import scoreboards, friends
 from app.common.constants import (
     SubmissionStatus,
     LegacyStatus,
@@ -146,6 +148,311 @@ def score_string_legacy(score: DBScore, seperator: str = '|') -> str:
         str(score.submitted_at)
     ])
 
+class Formatter:
+    """Renders a score of a leaderboard for a specific client generation"""
+
+    def __init__(self, name: str, render: Callable[[DBScore, int], str]) -> None:
+        self.name = name
+        self.render = render
+
+    def __repr__(self) -> str:
+        return f'<Formatter "{self.name}">'
+
+    def __call__(self, score: DBScore, index: int) -> str:
+        return self.render(score, index)
+
+def score_formatter(send_nc: bool, request_version: int = 1) -> Formatter:
+    return Formatter(
+        f'score_string:{int(send_nc)}:{request_version}',
+        lambda score, index: score_string(score, index, send_nc, request_version)
+    )
+
+def legacy_formatter(seperator: str = '|') -> Formatter:
+    return Formatter(
+        f'score_string_legacy:{seperator}',
+        lambda score, _: score_string_legacy(score, seperator)
+    )
+
+def fetch_board(
+    beatmap_id: int,
+    mode: int,
+    session: Session,
+    player_id: int | None = None,
+    mods: int | None = None,
+    limit: int = config.SCORE_RESPONSE_LIMIT
+) -> Tuple[List[DBScore], DBScore | None, int, int]:
+    """Fetch the top scores, personal best, its rank & the score count of a leaderboard in one query"""
+    board = session.query(
+        DBScore.id.label('id'),
+        DBScore.user_id.label('user_id'),
+        func.row_number().over(order_by=(DBScore.total_score.desc(), DBScore.id)).label('rank'),
+        func.count().over().label('total')
+    ) \
+        .join(DBUser, DBUser.id == DBScore.user_id) \
+        .filter(DBScore.beatmap_id == beatmap_id) \
+        .filter(DBScore.mode == mode) \
+        .filter(DBScore.hidden == False) \
+        .filter(DBUser.restricted == False)
+
+    if mods is not None:
+        # Mod leaderboards also contain the mod-specific personal bests
+        board = board.filter(DBScore.mods == mods) \
+                     .filter(DBScore.status_score.in_((3, 4)))
+    else:
+        board = board.filter(DBScore.status_score == 3)
+
+    board = board.subquery()
+
+    rows = session.query(DBScore, board.c.rank, board.c.total) \
+        .join(board, board.c.id == DBScore.id) \
+        .filter(or_(board.c.rank <= limit, board.c.user_id == player_id)) \
+        .options(joinedload(DBScore.user)) \
+        .order_by(board.c.rank) \
+        .all()
+
+    top_scores = [score for score, rank, _ in rows if rank <= limit]
+    personal_best, personal_best_rank = next(
+        ((score, rank) for score, rank, _ in rows if score.user_id == player_id),
+        (None, 0)
+    )
+    score_count = rows[0][2] if rows else 0
+
+    return top_scores, personal_best, personal_best_rank, score_count
+
+def fetch_scores_by_user(score_ids: List[int], session: Session) -> Dict[int, DBScore]:
+    if not score_ids:
+        return {}
+
+    board = session.query(DBScore) \
+        .filter(DBScore.id.in_(score_ids)) \
+        .options(joinedload(DBScore.user)) \
+        .all()
+
+    return {score.user_id: score for score in board}
+
+def fetch_country_board(
+    beatmap_id: int,
+    mode: int,
+    session: Session,
+    player_id: int,
+    country: str,
+    limit: int = config.SCORE_RESPONSE_LIMIT
+) -> Tuple[List[DBScore], DBScore | None, int, int]:
+    """Fetch a country leaderboard from the cached scoreboard of that country"""
+    user_ids = scoreboards.top(beatmap_id, mode, limit, session, country)
+    personal_best_rank = scoreboards.rank(beatmap_id, mode, player_id, session, country)
+    score_count = scoreboards.count(beatmap_id, mode, session, country)
+
+    # Only the scores that will be displayed are loaded
+    scores_by_user = fetch_scores_by_user(
+        scoreboards.fetch_score_ids(beatmap_id, mode, [*user_ids, player_id], country),
+        session
+    )
+
+    top_scores = [
+        scores_by_user[user_id]
+        for user_id in user_ids
+        if user_id in scores_by_user
+    ]
+
+    return top_scores, scores_by_user.get(player_id), personal_best_rank, score_count
+
+def fetch_friends_board(
+    beatmap_id: int,
+    mode: int,
+    session: Session,
+    player_id: int,
+    limit: int = config.SCORE_RESPONSE_LIMIT
+) -> Tuple[List[DBScore], DBScore | None, int, int]:
+    """Fetch a friend leaderboard from the cached scoreboard & the cached friends of a player"""
+    entries = scoreboards.fetch_subset(
+        beatmap_id,
+        mode,
+        player_id,
+        friends.ensure(player_id, session),
+        session
+    )
+
+    user_ids = [user_id for user_id, _ in entries]
+    personal_best_rank = (
+        user_ids.index(player_id) + 1
+        if player_id in user_ids else 0
+    )
+
+    # Only the scores that will be displayed are loaded
+    scores_by_user = fetch_scores_by_user(
+        scoreboards.fetch_score_ids(beatmap_id, mode, [*user_ids[:limit], player_id]),
+        session
+    )
+
+    top_scores = [
+        scores_by_user[user_id]
+        for user_id in user_ids[:limit]
+        if user_id in scores_by_user
+    ]
+
+    return top_scores, scores_by_user.get(player_id), personal_best_rank, len(entries)
+
+class Leaderboard:
+    """Fetches the data of a beatmap leaderboard once, for any of the getscores endpoints"""
+
+    def __init__(
+        self,
+        beatmap: DBBeatmap,
+        mode: int,
+        session: Session,
+        ranking_type: RankingType = RankingType.Top,
+        player: DBUser | None = None,
+        mods: int | None = None
+    ) -> None:
+        self.beatmap = beatmap
+        self.mode = mode
+        self.session = session
+        self.ranking_type = ranking_type
+        self.player = player
+        self.mods = mods if ranking_type == RankingType.SelectedMod else None
+        self.country = player.country if ranking_type == RankingType.Country else None
+
+        # Read the version before any scores, to not cache outdated scores
+        self.version = scoreboards.version(beatmap.id, mode)
+
+    @cached_property
+    def board(self) -> Tuple[List[DBScore], DBScore | None, int, int]:
+        if self.ranking_type == RankingType.Friends:
+            # Avoids sending the whole friend list to the database
+            return fetch_friends_board(
+                self.beatmap.id,
+                self.mode,
+                self.session,
+                self.player.id
+            )
+
+        if self.ranking_type == RankingType.Country:
+            return fetch_country_board(
+                self.beatmap.id,
+                self.mode,
+                self.session,
+                self.player.id,
+                self.country
+            )
+
+        return fetch_board(
+            self.beatmap.id,
+            self.mode,
+            self.session,
+            player_id=self.player.id if self.player else None,
+            mods=self.mods
+        )
+
+    @cached_property
+    def personal_best(self) -> DBScore | None:
+        if not self.player or not self.beatmap.is_ranked:
+            return None
+
+        if self.ranking_type != RankingType.Top:
+            _, personal_best, _, _ = self.board
+            return personal_best
+
+        return scores.fetch_personal_best_score(
+            self.beatmap.id,
+            self.player.id,
+            self.mode,
+            session=self.session
+        )
+
+    @cached_property
+    def personal_best_rank(self) -> int:
+        if not self.personal_best:
+            return 0
+
+        if self.ranking_type != RankingType.Top:
+            _, _, personal_best_rank, _ = self.board
+            return personal_best_rank
+
+        # Global ranks are served by the cached scoreboard
+        if index := scoreboards.rank(self.beatmap.id, self.mode, self.player.id, self.session):
+            return index
+
+        return scores.fetch_score_index(
+            self.player.id,
+            self.beatmap.id,
+            self.mode,
+            session=self.session
+        )
+
+    @cached_property
+    def score_count(self) -> int:
+        if not self.personal_best:
+            return 0
+
+        if self.ranking_type != RankingType.Top:
+            _, _, _, score_count = self.board
+            return score_count
+
+        return scoreboards.count(
+            self.beatmap.id,
+            self.mode,
+            self.session
+        )
+
+    def fetch_scores(self) -> List[DBScore]:
+        if self.ranking_type != RankingType.Top:
+            top_scores, _, _, _ = self.board
+            return top_scores
+
+        # Global leaderboards are mostly served by the render cache
+        return scores.fetch_range_scores(
+            self.beatmap.id,
+            mode=self.mode,
+            limit=config.SCORE_RESPONSE_LIMIT,
+            session=self.session
+        )
+
+    def render_personal_best(self, formatter: Formatter) -> str:
+        if not self.personal_best:
+            return ''
+
+        return formatter(self.personal_best, self.personal_best_rank)
+
+    def render_scores(self, formatter: Formatter) -> str:
+        """Render the top scores, which are cached until the scores of the beatmap change"""
+        # Friend leaderboards are different for every player
+        cacheable = self.ranking_type != RankingType.Friends
+
+        variant = ':'.join([
+            str(self.ranking_type.value),
+            str(self.mods or ''),
+            self.country or '',
+            formatter.name
+        ])
+
+        if cacheable:
+            rendered = scoreboards.fetch_rendered(
+                self.beatmap.id,
+                self.mode,
+                self.version,
+                variant
+            )
+
+            if rendered is not None:
+                return rendered
+
+        rendered = '\n'.join(
+            formatter(score, index + 1)
+            for index, score in enumerate(self.fetch_scores())
+        )
+
+        if cacheable:
+            scoreboards.store_rendered(
+                self.beatmap.id,
+                self.mode,
+                self.version,
+                variant,
+                rendered
+            )
+
+        return rendered
+
 @router.get('/osu-osz2-getscores.php')
 def get_scores(
     session: Session = Depends(app.session.database.yield_session),
@@ -199,44 +506,14 @@ def get_scores(
 
     send_nc: bool = client_supports_nc(status.version(player.id))
 
-    # Fetch score count
-    personal_best = None
-    score_count = 0
-    friends = None
-
-    if ranking_type == RankingType.Friends:
-        friends = relationships.fetch_target_ids(
-            player.id,
-            session=session
-        )
-
-    if beatmap.is_ranked:
-        personal_best = scores.fetch_personal_best_score(
-            beatmap.id,
-            player.id,
-            mode.value,
-            mods if ranking_type == RankingType.SelectedMod else None,
-            session
-        )
-
-        if personal_best:
-            score_count = scores.fetch_count_beatmap(
-                beatmap.id,
-                mode.value,
-                mods=mods
-                    if ranking_type == RankingType.SelectedMod
-                    else None,
-                country=player.country
-                    if ranking_type == RankingType.Country
-                    else None,
-                friends=friends
-                    if ranking_type == RankingType.Friends
-                    else None,
-                session=session
-            )
-
-            if ranking_type == RankingType.Friends:
-                score_count += 1
+    leaderboard = Leaderboard(
+        beatmap,
+        mode.value,
+        session,
+        ranking_type,
+        player,
+        mods
+    )
 
     # NOTE: In request version 3, the submission status
     #       swapped the Qualified and Ranked status
@@ -255,7 +532,7 @@ def get_scores(
             str(has_osz),
             str(beatmap.id),
             str(beatmap.set_id),
-            str(score_count)
+            str(leaderboard.score_count)
         ])
     )
 
@@ -272,64 +549,11 @@ def get_scores(
     if skip_scores or not beatmap.is_ranked:
         return Response('\n'.join(response))
 
-    if personal_best:
-        index = scores.fetch_score_index(
-            player.id,
-            beatmap.id,
-            mode.value,
-            mods           if ranking_type == RankingType.SelectedMod else None,
-            friends        if ranking_type == RankingType.Friends     else None,
-            player.country if ranking_type == RankingType.Country     else None,
-            session
-        )
-
-        response.append(
-            score_string(personal_best, index, send_nc, request_version)
-        )
-    else:
-        response.append('')
-
-    top_scores = []
-
-    if ranking_type == RankingType.Top:
-        top_scores = scores.fetch_range_scores(
-            beatmap.id,
-            mode=mode.value,
-            limit=config.SCORE_RESPONSE_LIMIT,
-            session=session
-        )
-
-    elif ranking_type == RankingType.Country:
-        top_scores = scores.fetch_range_scores_country(
-            beatmap.id,
-            mode=mode.value,
-            country=player.country,
-            limit=config.SCORE_RESPONSE_LIMIT,
-            session=session
-        )
-
-    elif ranking_type == RankingType.Friends:
-        top_scores = scores.fetch_range_scores_friends(
-            beatmap.id,
-            mode=mode.value,
-            friends=friends,
-            limit=config.SCORE_RESPONSE_LIMIT,
-            session=session
-        )
+    formatter = score_formatter(send_nc, request_version)
+    response.append(leaderboard.render_personal_best(formatter))
 
-    elif ranking_type == RankingType.SelectedMod:
-        top_scores = scores.fetch_range_scores_mods(
-            beatmap.id,
-            mode=mode.value,
-            mods=mods,
-            limit=config.SCORE_RESPONSE_LIMIT,
-            session=session
-        )
-
-    for index, score in enumerate(top_scores):
-        response.append(
-            score_string(score, index+1, send_nc, request_version)
-        )
+    if rendered := leaderboard.render_scores(formatter):
+        response.append(rendered)
 
     return Response('\n'.join(response))
 
@@ -377,38 +601,12 @@ def legacy_scores(
     if skip_scores or not beatmap.is_ranked:
         return Response('\n'.join(response))
 
-    personal_best = scores.fetch_personal_best_score(
-        beatmap.id,
-        player.id,
-        mode.value,
-        session=session
-    )
+    leaderboard = Leaderboard(beatmap, mode.value, session, player=player)
+    formatter = score_formatter(send_nc)
+    response.append(leaderboard.render_personal_best(formatter))
 
-    if personal_best:
-        index = scores.fetch_score_index(
-            player.id,
-            beatmap.id,
-            mode.value,
-            session=session
-        )
-
-        response.append(
-            score_string(personal_best, index, send_nc)
-        )
-    else:
-        response.append('')
-
-    top_scores = scores.fetch_range_scores(
-        beatmap.id,
-        mode=mode.value,
-        limit=config.SCORE_RESPONSE_LIMIT,
-        session=session
-    )
-
-    for index, score in enumerate(top_scores):
-        response.append(
-            score_string(score, index+1, send_nc)
-        )
+    if rendered := leaderboard.render_scores(formatter):
+        response.append(rendered)
 
     return Response('\n'.join(response))
 
@@ -462,38 +660,12 @@ def legacy_scores_no_ratings(
     if skip_scores or not beatmap.is_ranked:
         return Response('\n'.join(response))
 
-    personal_best = scores.fetch_personal_best_score(
-        beatmap.id,
-        player.id,
-        mode.value,
-        session=session
-    )
-
-    if personal_best:
-        index = scores.fetch_score_index(
-            player.id,
-            beatmap.id,
-            mode.value,
-            session=session
-        )
-
-        response.append(
-            score_string(personal_best, index, send_nc)
-        )
-    else:
-        response.append('')
-
-    top_scores = scores.fetch_range_scores(
-        beatmap.id,
-        mode=mode.value,
-        limit=config.SCORE_RESPONSE_LIMIT,
-        session=session
-    )
+    leaderboard = Leaderboard(beatmap, mode.value, session, player=player)
+    formatter = score_formatter(send_nc)
+    response.append(leaderboard.render_personal_best(formatter))
 
-    for index, score in enumerate(top_scores):
-        response.append(
-            score_string(score, index+1, send_nc)
-        )
+    if rendered := leaderboard.render_scores(formatter):
+        response.append(rendered)
 
     return Response('\n'.join(response))
 
@@ -544,38 +716,12 @@ def legacy_scores_no_beatmap_data(
     if skip_scores or not beatmap.is_ranked:
         return Response('\n'.join(response))
 
-    personal_best = scores.fetch_personal_best_score(
-        beatmap.id,
-        player.id,
-        mode.value,
-        session=session
-    )
+    leaderboard = Leaderboard(beatmap, mode.value, session, player=player)
+    formatter = score_formatter(send_nc)
+    response.append(leaderboard.render_personal_best(formatter))
 
-    if personal_best:
-        index = scores.fetch_score_index(
-            player.id,
-            beatmap.id,
-            mode.value,
-            session=session
-        )
-
-        response.append(
-            score_string(personal_best, index, send_nc)
-        )
-    else:
-        response.append('')
-
-    top_scores = scores.fetch_range_scores(
-        beatmap.id,
-        mode=mode.value,
-        limit=config.SCORE_RESPONSE_LIMIT,
-        session=session
-    )
-
-    for index, score in enumerate(top_scores):
-        response.append(
-            score_string(score, index+1, send_nc)
-        )
+    if rendered := leaderboard.render_scores(formatter):
+        response.append(rendered)
 
     return Response('\n'.join(response))
 
@@ -601,17 +747,10 @@ def legacy_scores_no_personal_best(
     if skip_scores or not beatmap.is_ranked:
         return Response('\n'.join(response))
 
-    top_scores = scores.fetch_range_scores(
-        beatmap.id,
-        mode=GameMode.Osu.value,
-        limit=config.SCORE_RESPONSE_LIMIT,
-        session=session
-    )
+    leaderboard = Leaderboard(beatmap, GameMode.Osu.value, session)
 
-    for score in top_scores:
-        response.append(
-            score_string_legacy(score)
-        )
+    if rendered := leaderboard.render_scores(legacy_formatter()):
+        response.append(rendered)
 
     return Response('\n'.join(response))
 
@@ -641,17 +780,10 @@ def legacy_scores_status_change(
     if skip_scores or not beatmap.is_ranked:
         return Response('\n'.join(response))
 
-    top_scores = scores.fetch_range_scores(
-        beatmap.id,
-        mode=GameMode.Osu.value,
-        limit=config.SCORE_RESPONSE_LIMIT,
-        session=session
-    )
+    leaderboard = Leaderboard(beatmap, GameMode.Osu.value, session)
 
-    for score in top_scores:
-        response.append(
-            score_string_legacy(score)
-        )
+    if rendered := leaderboard.render_scores(legacy_formatter()):
+        response.append(rendered)
 
     return Response('\n'.join(response))
 
@@ -663,14 +795,5 @@ def legacy_scores_no_status(
     if not (beatmap := beatmaps.fetch_by_checksum(beatmap_hash, session)):
         return Response('-1') # Not Submitted
 
-    top_scores = scores.fetch_range_scores(
-        beatmap.id,
-        mode=GameMode.Osu.value,
-        limit=config.SCORE_RESPONSE_LIMIT,
-        session=session
-    )
-
-    return Response('\n'.join([
-        score_string_legacy(score, seperator=':')
-        for score in top_scores
-    ]))
+    leaderboard = Leaderboard(beatmap, GameMode.Osu.value, session)
+    return Response(leaderboard.render_scores(legacy_formatter(seperator=':')))
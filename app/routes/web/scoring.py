@@ -9,62 +9,86 @@ from fastapi import (
     Form
 )
 
-from py3rijndael import RijndaelCbc, Pkcs7Padding
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 from datetime import datetime, timedelta
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Callable, Any
 from copy import copy
 
-from app.common.constants import GameMode, BadFlags, ButtonState, NotificationType, Mods
+from app.common.constants import GameMode, BadFlags, Mods
 from app.common.helpers.ip import resolve_ip_address_fastapi
 from app.common.helpers.score import calculate_rx_score
-from app.common.database import DBStats, DBScore, DBUser
+from app.common.database import DBStats, DBScore, DBUser, DBBeatmap
 from app import achievements as AchievementManager
 from app.objects import Score, ScoreStatus, Chart
+from app.restrictions import restrict_player, pp_limit
+from app.transaction import UnitOfWork
+from app.replays import ReplaySummary
 from app.common.cache import leaderboards, status
-from app.common.helpers import performance
 from app.common.constants import regexes
 from app.common import officer
+from app import (
+    scoreboards,
+    encryption,
+    topplays,
+    pipeline,
+    counters,
+    records,
+    metrics,
+    replays,
+    packs,
+    bloom
+)
 
 from app.common.database.repositories import (
-    notifications,
     achievements,
-    histories,
     beatmaps,
     scores,
-    plays,
     users,
     stats
 )
 
 import hashlib
+import asyncio
 import base64
 import config
 import utils
-import lzma
 import app
 
 router = APIRouter()
 
-def decrypt_string(
-    b64: str | None,
-    iv: bytes,
-    key: str = config.SCORE_SUBMISSION_KEY
-) -> str | None:
-    """Decrypt a rinjdael encrypted string"""
-    if not b64:
-        return
-
-    rjn = RijndaelCbc(
-        key=key,
-        iv=iv,
-        padding=Pkcs7Padding(32),
-        block_size=32
+async def run_submission(func: Callable, *args) -> Any:
+    """Run the blocking part of a score submission inside the submission executor"""
+    return await asyncio.get_running_loop().run_in_executor(
+        app.session.submission_executor,
+        batch_metrics,
+        func,
+        *args
     )
 
-    return rjn.decrypt(base64.b64decode(b64)).decode()
+def batch_metrics(func: Callable, *args) -> Any:
+    with metrics.batch():
+        return func(*args)
 
 async def parse_score_data(request: Request) -> Score:
     """Parse the score submission request and return a score object"""
+    trace = metrics.Trace('deck_submission', config.SLOW_SUBMISSION_THRESHOLD)
+
+    with trace.span('parse'):
+        score = await read_score_data(request)
+
+    score.trace = trace
+    return score
+
+def finish_trace(score: Score) -> None:
+    score_id = score.database_score.id if score.database_score else None
+
+    try:
+        score.trace.finish(**({'score_id': score_id} if score_id else {}))
+    except Exception as e:
+        app.session.logger.warning(f'Failed to record submission trace: {e}')
+
+async def read_score_data(request: Request) -> Score:
     user_agent = request.headers.get('user-agent', 'osu!')
     ip = resolve_ip_address_fastapi(request)
 
@@ -119,12 +143,13 @@ async def parse_score_data(request: Request) -> Score:
     if iv := form.get('iv'):
         # Score data is encrypted
         try:
-            iv = base64.b64decode(iv)
-            client_hash = decrypt_string(client_hash, iv, decryption_key)
-            fun_spoiler = decrypt_string(fun_spoiler, iv, decryption_key)
-            score_data = decrypt_string(score_data, iv, decryption_key)
-            processes = decrypt_string(processes, iv, decryption_key)
-        except (UnicodeDecodeError, TypeError) as e:
+            client_hash, fun_spoiler, score_data, processes = await run_submission(
+                encryption.decrypt_fields,
+                [client_hash, fun_spoiler, score_data, processes],
+                base64.b64decode(iv),
+                decryption_key
+            )
+        except (UnicodeDecodeError, TypeError, ValueError) as e:
             # Most likely an invalid score encryption key
             officer.call(
                 f'Could not decrypt score data: {e} ({ip})',
@@ -184,49 +209,27 @@ async def parse_legacy_score_data(
         )
         raise HTTPException(400)
 
-def validate_replay(replay_bytes: bytes) -> bool:
-    """Validate the replay contents"""
+def validate_replay(replay_bytes: bytes) -> ReplaySummary | None:
+    """Validate the replay contents and return a summary of its frames"""
     app.session.logger.debug('Validating replay...')
 
     try:
-        replay = lzma.decompress(replay_bytes).decode()
-        frames = replay.split(',')
-
-        if len(frames) < 100:
-            # Hopefully this doesn't lead to false-positivies
-            officer.call(
-                f'Replay validation failed: Not enough replay frames ({len(frames)})'
-            )
-            return False
-
-        for frame in frames:
-            if not frame:
-                continue
-
-            frame_data = frame.split('|')
-
-            if len(frame_data) != 4:
-                officer.call(
-                    f'Replay validation failed: Invalid frame data ({frame_data})'
-                )
-                return False
-
-            if frame_data[0] == "-12345":
-                seed = int(frame_data[3])
-                continue
-
-            time = int(frame_data[0])
-            x = float(frame_data[1])
-            y = float(frame_data[2])
-            button_state = ButtonState(int(frame_data[3]))
+        summary = replays.parse(replay_bytes)
     except Exception as e:
         officer.call(
             f'Replay validation failed: {e}',
             exc_info=e
         )
-        return False
+        return None
+
+    if summary.frame_count < 100:
+        # Hopefully this doesn't lead to false-positivies
+        officer.call(
+            f'Replay validation failed: Not enough replay frames ({summary.frame_count})'
+        )
+        return None
 
-    return True
+    return summary
 
 def perform_score_validation(score: Score, player: DBUser) -> Optional[Response]:
     """Validate the score submission requests and return an error if the validation fails"""
@@ -278,17 +281,12 @@ def perform_score_validation(score: Score, player: DBUser) -> Optional[Response]
             officer.call(
                 f'"{score.username}" submitted score without replay.'
             )
-            app.session.events.submit(
-                'restrict',
-                user_id=player.id,
-                autoban=True,
-                reason='Score submission without replay'
-            )
+            restrict_player(player, 'Score submission without replay', score.session)
             return Response('error: ban')
 
         # Check for duplicate score
         replay_hash = hashlib.md5(score.replay).hexdigest()
-        duplicate_score = scores.fetch_by_replay_checksum(replay_hash, score.session)
+        duplicate_score = bloom.fetch_duplicate_replay(replay_hash, score.session)
 
         if duplicate_score:
             if duplicate_score.user_id != player.id:
@@ -296,12 +294,7 @@ def perform_score_validation(score: Score, player: DBUser) -> Optional[Response]
                     f'"{score.username}" submitted duplicate replay in score submission '
                     f'({duplicate_score.replay_md5}).'
                 )
-                app.session.events.submit(
-                    'restrict',
-                    user_id=player.id,
-                    autoban=True,
-                    reason='Duplicate replay in score submission'
-                )
+                restrict_player(player, 'Duplicate replay in score submission', score.session)
                 return Response('error: ban')
 
             app.session.logger.warning(
@@ -317,12 +310,7 @@ def perform_score_validation(score: Score, player: DBUser) -> Optional[Response]
         )
 
         if not player.is_verified:
-            app.session.events.submit(
-                'restrict',
-                user_id=player.id,
-                autoban=True,
-                reason='Invalid mods on score submission'
-            )
+            restrict_player(player, 'Invalid mods on score submission', score.session)
             return Response('error: ban')
 
     flags = [
@@ -342,35 +330,44 @@ def perform_score_validation(score: Score, player: DBUser) -> Optional[Response]
             f'Please review this case as soon as possible. ({replay_hash})'
         )
 
-    if score.replay and not validate_replay(score.replay):
+    if score.replay and not (summary := validate_replay(score.replay)):
         officer.call(
             f'"{score.username}" submitted score with invalid replay.'
         )
 
         if not player.is_verified:
-            app.session.events.submit(
-                'restrict',
-                user_id=player.id,
-                autoban=True,
-                reason='Invalid replay'
-            )
+            restrict_player(player, 'Invalid replay', score.session)
             return Response('error: ban')
 
-    account_age = (datetime.now() - player.created_at)
-    pp_cutoff = min(1500, max(750, account_age.total_seconds() / 8))
+    if score.replay:
+        score.replay_summary = summary
 
-    if score.pp >= pp_cutoff:
+    if score.passed and score.replay_summary:
+        # Frame times are based on the song position, so the replay
+        # should roughly cover the length of the beatmap
+        minimum_duration = score.beatmap.total_length * 1000 * replays.MINIMUM_COVERAGE
+
+        if score.replay_summary.duration < minimum_duration:
+            app.session.logger.warning(
+                f'"{score.username}" submitted a replay that covers less than '
+                f'{replays.MINIMUM_COVERAGE:.0%} of the beatmap. '
+                f'({score.replay_summary.duration}ms / {score.beatmap.total_length}s)'
+            )
+
+        if score.replay_summary.backwards_frames > 0:
+            app.session.logger.warning(
+                f'"{score.username}" submitted a replay with '
+                f'{score.replay_summary.backwards_frames} backwards frames.'
+            )
+
+    # Scores with a pending pp calculation are checked by the pipeline
+    if score.pp >= pp_limit(player):
         officer.call(
             f'"{score.username}" exceeded the pp limit ({score.pp}).'
         )
 
         if not player.is_verified:
-            app.session.events.submit(
-                'restrict',
-                user_id=player.id,
-                autoban=True,
-                reason=f'Exceeded pp limit ({round(score.pp)})'
-            )
+            restrict_player(player, f'Exceeded pp limit ({round(score.pp)})', score.session)
             return Response('error: ban')
 
     multiaccounting_lock = app.session.redis.get(f'multiaccounting:{player.id}')
@@ -381,12 +378,7 @@ def perform_score_validation(score: Score, player: DBUser) -> Optional[Response]
         )
 
         if not player.is_verified:
-            app.session.events.submit(
-                'restrict',
-                user_id=player.id,
-                autoban=True,
-                reason='Multiaccounting'
-            )
+            restrict_player(player, 'Multiaccounting', score.session)
             return Response('error: ban')
 
 def upload_replay(score: Score, score_id: int) -> None:
@@ -431,32 +423,42 @@ def upload_replay(score: Score, score_id: int) -> None:
         time=timedelta(minutes=30)
     )
 
-def calculate_weighted_pp(scores: List[DBScore]) -> float:
-    """Calculate the weighted pp for a list of scores"""
-    if not scores:
-        return 0
-
-    weighted_pp = sum(score.pp * 0.95**index for index, score in enumerate(scores))
-    bonus_pp = 416.6667 * (1 - 0.9994 ** len(scores))
-    return weighted_pp + bonus_pp
-
-def calculate_weighted_acc(scores: List[DBScore]) -> float:
-    """Calculate the weighted acc for a list of scores"""
-    if not scores:
-        return 0
+def submit_replay_upload(score: Score, score_id: int) -> None:
+    app.session.executor.submit(
+        upload_replay,
+        score,
+        score_id
+    ).add_done_callback(
+        utils.thread_callback
+    )
 
-    weighted_acc = sum(score.acc * 0.95**index for index, score in enumerate(scores))
-    bonus_acc = 100.0 / (20 * (1 - 0.95 ** len(scores)))
-    return (weighted_acc * bonus_acc) / 100
+def update_beatmap_stats(score: Score) -> None:
+    """Increment the beatmap counters in a single statement, to keep the row lock short"""
+    score.session.query(DBBeatmap) \
+        .filter(DBBeatmap.id == score.beatmap.id) \
+        .update(
+            {
+                'playcount': DBBeatmap.playcount + 1,
+                'passcount': DBBeatmap.passcount + int(score.passed)
+            },
+            synchronize_session=False
+        )
 
-def update_stats(score: Score, player: DBUser) -> Tuple[DBStats, DBStats]:
+def update_stats(
+    score: Score,
+    player: DBUser,
+    transaction: UnitOfWork,
+    score_object: DBScore | None = None
+) -> Tuple[DBStats, DBStats]:
     """Update the users and beatmaps stats. It will return the old & new stats for the user"""
     app.session.logger.debug('Updating user stats...')
 
-    # Update beatmap stats
-    score.beatmap.playcount += 1
-    score.beatmap.passcount += 1 if score.passed else 0
-    score.session.commit()
+    # Update beatmap stats right before the commit
+    transaction.before_commit(update_beatmap_stats, score)
+
+    # Keep the loaded values in sync, without marking them as changed
+    set_committed_value(score.beatmap, 'playcount', score.beatmap.playcount + 1)
+    set_committed_value(score.beatmap, 'passcount', score.beatmap.passcount + int(score.passed))
 
     # Update user stats
     user_stats = stats.fetch_by_mode(
@@ -472,96 +474,29 @@ def update_stats(score: Score, player: DBUser) -> Tuple[DBStats, DBStats]:
     user_stats.tscore += score.total_score
     user_stats.total_hits += score.total_hits
 
-    score.session.commit()
-
-    histories.update_plays(
-        user_stats.user_id,
-        user_stats.mode,
-        score.session
-    )
-
-    plays.update(
-        score.beatmap.filename,
-        score.beatmap.id,
-        score.user.id,
-        score.beatmap.set_id,
-        session=score.session
-    )
-
-    best_scores_by_score = scores.fetch_best_by_score(
-        user_id=score.user.id,
-        mode=score.mode.value,
-        session=score.session
-    )
-
-    best_scores = scores.fetch_best(
-        user_id=score.user.id,
-        mode=score.mode.value,
-        exclude_approved=(not config.APPROVED_MAP_REWARDS),
-        session=score.session
-    )
-
-    rx_scores = [score for score in best_scores if (score.mods & 128) != 0]
-    ap_scores = [score for score in best_scores if (score.mods & 8192) != 0]
-    vn_scores = [score for score in best_scores if (score.mods & 128) == 0 and (score.mods & 8192) == 0]
+    if score_object:
+        # Cached top plays are updated, once the score was committed
+        transaction.after_commit(topplays.insert, score_object, score.beatmap)
+        transaction.on_rollback(topplays.invalidate, player.id, score.mode.value)
 
     if score.beatmap.is_ranked and score.has_pb:
         if score.max_combo > user_stats.max_combo:
             # Update max combo, if higher
             user_stats.max_combo = score.max_combo
 
-    if best_scores:
-        # Update pp
-        user_stats.pp = calculate_weighted_pp(best_scores)
-        user_stats.pp_vn = calculate_weighted_pp(vn_scores)
-        user_stats.pp_rx = calculate_weighted_pp(rx_scores)
-        user_stats.pp_ap = calculate_weighted_pp(ap_scores)
-
-        # Update acc
-        user_stats.acc = calculate_weighted_acc(best_scores)
-
-        # Update rscore
-        user_stats.rscore = sum(
-            score.total_score
-            for score in best_scores_by_score
-        )
-
-        # Update ppv1
-        user_stats.ppv1 = performance.calculate_weighted_ppv1(best_scores)
-
-        leaderboards.update(
-            user_stats,
-            player.country.lower()
-        )
-
-        user_stats.rank = leaderboards.global_rank(
-            user_stats.user_id,
-            user_stats.mode
-        )
-
-        histories.update_rank(
-            user_stats,
-            player.country
-        )
-
-        score.session.commit()
-
-        # Update score grades
-        grades = scores.fetch_grades(
-            user_stats.user_id,
-            user_stats.mode,
-            session=score.session
-        )
+    updated = topplays.update_stats(
+        user_stats,
+        player.country,
+        score.session,
+        pending=score_object,
+        beatmap=score.beatmap
+    )
 
-        stats.update(
-            user_stats.user_id,
-            user_stats.mode,
-            {
-                f'{grade.lower()}_count': count
-                for grade, count in grades.items()
-            },
-            session=score.session
-        )
+    if updated:
+        # The new rank is required for the response, so the
+        # global leaderboards are restored on a rollback instead
+        transaction.on_rollback(leaderboards.update, old_stats, player.country.lower())
+        score.session.flush()
 
     # Update preferred mode
     if player.preferred_mode != score.mode.value:
@@ -580,10 +515,72 @@ def update_stats(score: Score, player: DBUser) -> Tuple[DBStats, DBStats]:
 
     return user_stats, old_stats
 
+def stats_payload(user_stats: DBStats) -> dict:
+    return {
+        'user_id': user_stats.user_id,
+        'mode': user_stats.mode,
+        'rank': user_stats.rank,
+        'playcount': user_stats.playcount,
+        'rscore': user_stats.rscore,
+        'pp': user_stats.pp
+    }
+
+def enqueue_stages(
+    score: Score,
+    player: DBUser,
+    new_stats: DBStats,
+    old_stats: DBStats,
+    score_id: int | None = None,
+    new_rank: int = 0,
+    old_rank: int = 0,
+    check_highlights: bool = False
+) -> None:
+    """Hand the stages that are not required for the response over to the pipeline"""
+    stage_names = ['histories', 'plays']
+
+    if score.pp_pending and score_id:
+        # pp calculation exceeded its deadline
+        stage_names.insert(0, 'recalculate_pp')
+
+    if score.has_pb:
+        stage_names.append('grades')
+
+    if check_highlights and score.has_pb:
+        stage_names.append('highlights')
+
+    if score.deferred_achievements and score_id:
+        # Achievement checks exceeded their time budget
+        stage_names.append('achievements')
+
+    # Bancho's stats should not wait for the retries of other stages
+    pipeline.enqueue(
+        ['events'],
+        user_id=player.id,
+        mode=score.mode.value
+    )
+
+    pipeline.enqueue(
+        stage_names,
+        score_id=score_id,
+        user_id=player.id,
+        mode=score.mode.value,
+        country=player.country,
+        has_pb=score.has_pb,
+        beatmap_id=score.beatmap.id,
+        beatmapset_id=score.beatmap.set_id,
+        beatmap_filename=score.beatmap.filename,
+        new_stats=stats_payload(new_stats),
+        old_stats=stats_payload(old_stats),
+        new_rank=new_rank,
+        old_rank=old_rank,
+        achievements=score.deferred_achievements
+    )
+
 def unlock_achievements(
     score: Score,
     score_object: DBScore,
     player: DBUser,
+    transaction: UnitOfWork,
     request: Request
 ) -> List[str]:
     app.session.logger.debug('Checking achievements...')
@@ -591,8 +588,25 @@ def unlock_achievements(
     unlocked_achievements = achievements.fetch_many(player.id, score.session)
     ignore_list = [a.filename for a in unlocked_achievements]
 
-    new_achievements = AchievementManager.check(score_object, score.session, ignore_list)
+    new_achievements, deferred_achievements = AchievementManager.check(
+        score_object,
+        score.session,
+        ignore_list,
+        budget=config.ACHIEVEMENT_TIME_BUDGET,
+        counted=False
+    )
+
     achievement_response = [a.filename for a in new_achievements]
+    score.deferred_achievements = [a.filename for a in deferred_achievements]
+
+    if deferred_achievements:
+        app.session.logger.warning(
+            f'Achievement checks exceeded their time budget, deferring {len(deferred_achievements)} checks'
+        )
+        metrics.increment(
+            'deck_achievement_deferrals_total',
+            amount=len(deferred_achievements)
+        )
 
     if new_achievements:
         achievements.create_many(
@@ -602,28 +616,13 @@ def unlock_achievements(
         )
 
         # Send notification
-        if len(new_achievements) > 1:
-            names = [f'"{a.name}"' for a in new_achievements]
-            achievement_names = ', '.join(name for name in names[:-1])
-            notification_header = 'Achievements Unlocked!'
-            notification_message = (
-                'Congratulations for unlocking the '
-                f'{achievement_names} and {names[-1]} achievements!'
-            )
+        AchievementManager.notify(player.id, new_achievements)
 
-        else:
-            notification_header = 'Achievement Unlocked!'
-            notification_message = (
-                'Congratulations for unlocking the '
-                f'"{new_achievements[0].name}" achievement!'
-            )
-
-        notifications.create(
-            player.id,
-            NotificationType.Achievement.value,
-            notification_header,
-            notification_message,
-            link=f'https://osu.{config.DOMAIN_NAME}/u/{player.id}#achievements'
+        transaction.after_commit(
+            AchievementManager.announce,
+            score_object,
+            new_achievements,
+            score.session
         )
 
     return achievement_response
@@ -716,7 +715,7 @@ def response_charts(
 
 @router.post("/osu-submit-modular-selector.php")
 @router.post('/osu-submit-modular.php')
-def score_submission(
+async def score_submission(
     request: Request,
     # This will get sent when the "FlashLightImageHack" flag is triggered
     # We don't need to use it, since the flag will already restrict them
@@ -725,7 +724,24 @@ def score_submission(
     password: Optional[str] = Form(None, alias='pass'),
     score: Score = Depends(parse_score_data),
 ) -> Response:
-    password = legacy_password or password
+    try:
+        return await run_submission(
+            process_score_submission,
+            request,
+            legacy_password or password,
+            score
+        )
+    finally:
+        # Recording the trace talks to redis, which would block the event loop
+        await run_submission(finish_trace, score)
+
+def process_score_submission(
+    request: Request,
+    password: Optional[str],
+    score: Score
+) -> Response:
+    # Time spent waiting for the submission executor
+    score.trace.mark('queue')
 
     score.user = users.fetch_by_name(
         score.username,
@@ -781,8 +797,10 @@ def score_submission(
         score.session
     )
 
+    score.trace.mark('auth')
     score.pp = score.calculate_ppv2()
     score.ppv1 = score.calculate_ppv1()
+    score.trace.mark('pp')
 
     if (error := perform_score_validation(score, player)) != None:
         return error
@@ -799,135 +817,158 @@ def score_submission(
         # Try to get it from bancho instead
         score.version = status.version(player.id) or 0
 
-    if score.beatmap.is_ranked:
-        score.personal_best_pp = scores.fetch_personal_best(
-            score.beatmap.id,
-            score.user.id,
-            score.mode.value,
-            session=score.session
-        )
+    score.trace.mark('validation')
 
-        score.personal_best_score = scores.fetch_personal_best_score(
-            score.beatmap.id,
-            score.user.id,
-            score.mode.value,
-            session=score.session
-        )
+    with UnitOfWork(score.session) as transaction:
+        score_object: DBScore | None = None
 
-        score.status_pp = score.calculate_pp_status()
-        score.status_score = score.calculate_score_status()
+        if score.beatmap.is_ranked:
+            # Get old rank before the previous personal best is
+            # replaced, which also makes sure that the scoreboard was built
+            old_rank = scoreboards.rank(
+                score.beatmap.id,
+                score.mode.value,
+                player.id,
+                score.session
+            )
 
-        # Get old rank before submitting score
-        old_rank = scores.fetch_score_index_by_id(
-                    score.personal_best_pp.id,
-                    score.beatmap.id,
-                    mode=score.mode.value,
-                    session=score.session
-                ) \
-                if score.personal_best_score else 0
+            score.resolve_personal_bests()
+            score.trace.mark('pb')
 
-        # Submit to database
-        score_object = score.to_database()
-        score_object.client_hash = score.client_hash
+            # Submit to database
+            score_object = score.to_database()
+            score_object.client_hash = score.client_hash
 
-        if not config.ALLOW_RELAX and score.relaxing:
-            score_object.status_pp = -1
+            if not config.ALLOW_RELAX and score.relaxing:
+                score_object.status_pp = -1
 
-        score.session.add(score_object)
-        score.session.flush()
+            # Flush to get the score id
+            score.session.add(score_object)
+            score.session.flush()
 
-        # Try to upload replay
-        app.session.executor.submit(
-            upload_replay,
-            score,
-            score_object.id
-        ).add_done_callback(
-            utils.thread_callback
-        )
+            # Count the play for time-based achievements
+            transaction.after_commit(counters.record, score_object)
 
-        score.session.commit()
+            # Try to upload replay, once the score is visible
+            transaction.after_commit(
+                submit_replay_upload,
+                score,
+                score_object.id
+            )
 
-    new_stats, old_stats = update_stats(score, player)
+            if score_object.replay_md5:
+                transaction.after_commit(
+                    bloom.replays.add,
+                    score_object.replay_md5
+                )
 
-    if not score.beatmap.is_ranked:
-        score.session.close()
-        app.session.events.submit(
-            'user_update',
-            user_id=player.id,
-            mode=score.mode.value
-        )
-        return Response('error: beatmap')
+            if score_object.status_score in (ScoreStatus.Best, ScoreStatus.Mods):
+                transaction.after_commit(
+                    scoreboards.submit,
+                    score_object,
+                    player.country
+                )
 
-    if not config.ALLOW_RELAX and score.relaxing:
-        score.session.close()
-        app.session.events.submit(
-            'user_update',
-            user_id=player.id,
-            mode=score.mode.value
-        )
-        return Response('error: no')
+            if score_object.status_pp == ScoreStatus.Best:
+                transaction.after_commit(
+                    packs.update,
+                    player.id,
+                    score.beatmap.set_id
+                )
+                transaction.after_commit(
+                    records.submit,
+                    score_object.id,
+                    score_object.mode,
+                    score_object.pp
+                )
 
-    achievement_response: List[str] = []
+            score.trace.mark('insert')
 
-    # TODO: Enable achievements for relax?
-    if score.passed and not score.relaxing:
-        achievement_response = unlock_achievements(
-            score,
-            score_object,
-            player,
-            request
-        )
+        new_stats, old_stats = update_stats(score, player, transaction, score_object)
+        score.trace.mark('stats')
 
-    new_rank = scores.fetch_score_index_by_tscore(
-        score_object.total_score,
-        score.beatmap.id,
-        mode=score.mode.value,
-        session=score.session
-    )
+        if not score.beatmap.is_ranked:
+            transaction.after_commit(enqueue_stages, score, player, new_stats, old_stats)
+            return Response('error: beatmap')
 
-    response = response_charts(
-        score,
-        score_object.id,
-        old_stats,
-        new_stats,
-        old_rank,
-        new_rank,
-        achievement_response
-    )
+        if not config.ALLOW_RELAX and score.relaxing:
+            transaction.after_commit(enqueue_stages, score, player, new_stats, old_stats, score_object.id)
+            return Response('error: no')
 
-    app.session.logger.info(
-        f'"{score.username}" submitted {"failed " if score.failtime else ""}score on {score.beatmap.full_name}'
-    )
+        achievement_response: List[str] = []
 
-    score.session.close()
+        # TODO: Enable achievements for relax?
+        if score.passed and not score.relaxing:
+            achievement_response = unlock_achievements(
+                score,
+                score_object,
+                player,
+                transaction,
+                request
+            )
 
-    # Send highlights on #announce
-    if score.has_pb:
-        app.session.executor.submit(
-            app.highlights.check,
-            score_object.id, score.user,
-            new_stats, old_stats,
-            new_rank, old_rank
-        ).add_done_callback(
-            utils.thread_callback
+        score.trace.mark('achievements')
+
+        new_rank = scoreboards.rank_by_total_score(
+            score.beatmap.id,
+            score.mode.value,
+            score_object.total_score,
+            score.session
         )
 
-    # Reload stats on bancho
-    app.session.events.submit(
-        'user_update',
-        user_id=player.id,
-        mode=score.mode.value
-    )
+        response = response_charts(
+            score,
+            score_object.id,
+            old_stats,
+            new_stats,
+            old_rank,
+            new_rank,
+            achievement_response
+        )
+
+        score.trace.mark('charts')
+
+        app.session.logger.info(
+            f'"{score.username}" submitted {"failed " if score.failtime else ""}score on {score.beatmap.full_name}'
+        )
+
+        transaction.after_commit(
+            enqueue_stages,
+            score, player,
+            new_stats, old_stats,
+            score_object.id,
+            new_rank, old_rank,
+            check_highlights=True
+        )
 
-    return Response('\n'.join([chart.get() for chart in response]))
+        return Response('\n'.join([chart.get() for chart in response]))
 
 @router.post('/osu-submit.php')
 @router.post('/osu-submit-new.php')
-def legacy_score_submission(
+async def legacy_score_submission(
     request: Request,
     password: Optional[str] = Query(None, alias='pass'),
     score: Score = Depends(parse_score_data)
 ) -> Response:
+    try:
+        return await run_submission(
+            process_legacy_score_submission,
+            request,
+            password,
+            score
+        )
+    finally:
+        # Recording the trace talks to redis, which would block the event loop
+        await run_submission(finish_trace, score)
+
+def process_legacy_score_submission(
+    request: Request,
+    password: Optional[str],
+    score: Score
+) -> Response:
+    # Time spent waiting for the submission executor
+    score.trace.mark('queue')
+
     score.user = users.fetch_by_name(
         score.username,
         score.session
@@ -977,8 +1018,10 @@ def legacy_score_submission(
         score.session
     )
 
+    score.trace.mark('auth')
     score.pp = score.calculate_ppv2()
     score.ppv1 = score.calculate_ppv1()
+    score.trace.mark('pp')
 
     if (error := perform_score_validation(score, player)) != None:
         raise HTTPException(400, detail=error.body.decode())
@@ -995,140 +1038,138 @@ def legacy_score_submission(
         # Try to get it from bancho instead
         score.version = status.version(player.id) or 0
 
+    score.trace.mark('validation')
+
     if score.version < 452 and Mods.Nightcore in score.enabled_mods:
         # Prevent "Taiko" mod plays from being submitted
         raise HTTPException(400)
 
-    if score.beatmap.is_ranked:
-        score.personal_best_pp = scores.fetch_personal_best(
-            score.beatmap.id,
-            score.user.id,
-            score.mode.value,
-            session=score.session
-        )
+    with UnitOfWork(score.session) as transaction:
+        score_object: DBScore | None = None
 
-        score.personal_best_score = scores.fetch_personal_best_score(
-            score.beatmap.id,
-            score.user.id,
-            score.mode.value,
-            session=score.session
-        )
+        if score.beatmap.is_ranked:
+            # Get old rank before the previous personal best is
+            # replaced, which also makes sure that the scoreboard was built
+            old_rank = scoreboards.rank(
+                score.beatmap.id,
+                score.mode.value,
+                player.id,
+                score.session
+            )
 
-        score.status_pp = score.calculate_pp_status()
-        score.status_score = score.calculate_score_status()
+            score.resolve_personal_bests()
+            score.trace.mark('pb')
 
-        # Get old rank before submitting score
-        old_rank = scores.fetch_score_index_by_id(
-                    score.personal_best_pp.id,
-                    score.beatmap.id,
-                    mode=score.mode.value,
-                    session=score.session
-                ) \
-                if score.personal_best_score else 0
+            # Submit to database
+            score_object = score.to_database()
+            score_object.client_hash = ''
 
-        # Submit to database
-        score_object = score.to_database()
-        score_object.client_hash = ''
+            if not config.ALLOW_RELAX and score.relaxing:
+                score_object.status_pp = -1
 
-        if not config.ALLOW_RELAX and score.relaxing:
-            score_object.status_pp = -1
+            # Flush to get the score id
+            score.session.add(score_object)
+            score.session.flush()
 
-        score.session.add(score_object)
-        score.session.flush()
+            # Count the play for time-based achievements
+            transaction.after_commit(counters.record, score_object)
 
-        # Try to upload replay
-        app.session.executor.submit(
-            upload_replay,
-            score,
-            score_object.id
-        ).add_done_callback(
-            utils.thread_callback
-        )
+            # Try to upload replay, once the score is visible
+            transaction.after_commit(
+                submit_replay_upload,
+                score,
+                score_object.id
+            )
 
-        score.session.commit()
+            if score_object.replay_md5:
+                transaction.after_commit(
+                    bloom.replays.add,
+                    score_object.replay_md5
+                )
 
-    new_stats, old_stats = update_stats(score, player)
+            if score_object.status_score in (ScoreStatus.Best, ScoreStatus.Mods):
+                transaction.after_commit(
+                    scoreboards.submit,
+                    score_object,
+                    player.country
+                )
 
-    if not score.beatmap.is_ranked:
-        app.session.events.submit(
-            'user_update',
-            user_id=player.id,
-            mode=score.mode.value
-        )
-        score.session.close()
-        return
-
-    if not config.ALLOW_RELAX and score.relaxing:
-        app.session.events.submit(
-            'user_update',
-            user_id=player.id,
-            mode=score.mode.value
-        )
-        score.session.close()
-        return
+            if score_object.status_pp == ScoreStatus.Best:
+                transaction.after_commit(
+                    packs.update,
+                    player.id,
+                    score.beatmap.set_id
+                )
+                transaction.after_commit(
+                    records.submit,
+                    score_object.id,
+                    score_object.mode,
+                    score_object.pp
+                )
 
-    app.session.logger.info(
-        f'"{score.username}" submitted {"failed " if score.failtime else ""}score on {score.beatmap.full_name}'
-    )
+            score.trace.mark('insert')
 
-    if not score.passed:
-        app.session.events.submit(
-            'user_update',
-            user_id=player.id,
-            mode=score.mode.value
-        )
-        score.session.close()
-        return
+        new_stats, old_stats = update_stats(score, player, transaction, score_object)
+        score.trace.mark('stats')
 
-    achievement_response: List[str] = []
-    response: List[Chart] = []
+        if not score.beatmap.is_ranked:
+            transaction.after_commit(enqueue_stages, score, player, new_stats, old_stats)
+            return
 
-    if not score.relaxing:
-        achievement_response = unlock_achievements(
-            score,
-            score_object,
-            player,
-            request
+        if not config.ALLOW_RELAX and score.relaxing:
+            transaction.after_commit(enqueue_stages, score, player, new_stats, old_stats, score_object.id)
+            return
+
+        app.session.logger.info(
+            f'"{score.username}" submitted {"failed " if score.failtime else ""}score on {score.beatmap.full_name}'
         )
 
-    beatmap_rank = scores.fetch_score_index_by_id(
-        score_object.id,
-        score.beatmap.id,
-        mode=score.mode.value,
-        session=score.session
-    )
+        if not score.passed:
+            transaction.after_commit(enqueue_stages, score, player, new_stats, old_stats, score_object.id)
+            return
 
-    # Reload stats on bancho
-    app.session.events.submit(
-        'user_update',
-        user_id=player.id,
-        mode=score.mode.value
-    )
+        achievement_response: List[str] = []
+        response: List[Chart] = []
 
-    if score.is_performance_pb:
-        response.append(str(beatmap_rank))
-    else:
-        response.append('0')
+        if not score.relaxing:
+            achievement_response = unlock_achievements(
+                score,
+                score_object,
+                player,
+                transaction,
+                request
+            )
 
-    difference, next_user = leaderboards.player_above(
-        player.id,
-        score.mode.value
-    )
+        score.trace.mark('achievements')
+
+        beatmap_rank = scoreboards.rank_by_total_score(
+            score.beatmap.id,
+            score.mode.value,
+            score_object.total_score,
+            score.session
+        )
 
-    response.append(str(round(difference)))
-    response.append(' '.join(achievement_response))
+        if score.is_performance_pb:
+            response.append(str(beatmap_rank))
+        else:
+            response.append('0')
 
-    score.session.close()
+        difference, next_user = leaderboards.player_above(
+            player.id,
+            score.mode.value
+        )
 
-    # Send highlights on #announce
-    if score.has_pb:
-        app.session.executor.submit(
-            app.highlights.check,
-            score_object.id, score.user,
+        response.append(str(round(difference)))
+        response.append(' '.join(achievement_response))
+        score.trace.mark('charts')
+
+        transaction.after_commit(
+            enqueue_stages,
+            score, player,
             new_stats, old_stats,
-            beatmap_rank, old_rank
-        ).add_done_callback(
-            utils.thread_callback
+            score_object.id,
+            beatmap_rank, old_rank,
+            check_highlights=True
         )
 
-    return '\n'.join(response)
+        return '\n'.join(response)
@@ -1,6 +1,6 @@
 
-from app.common.database import beatmaps
 from sqlalchemy.orm import Session
+from app import checksums as checksum_cache
 from fastapi import (
     HTTPException,
     APIRouter,
@@ -29,9 +29,10 @@ def get_beatmaps(
     app.session.logger.info(f"Got beatmap status request for {len(checksums)} beatmaps.")
 
     response = []
+    beatmaps = checksum_cache.fetch_many(checksums, session)
 
     for checksum in checksums:
-        if not (beatmap := beatmaps.fetch_by_checksum(checksum, session)):
+        if not (beatmap := beatmaps.get(checksum)):
             continue
 
         status = 1 if beatmap.status > 0 else 0
@@ -0,0 +1,246 @@
+
+from app.common.database import DBScore, DBUser
+
+from sqlalchemy.orm import Session
+from typing import List, Tuple
+
+import config
+import app
+
+# Best scores of every beatmap are cached per mode inside redis:
+#   scoreboards:{beatmap_id}:{mode}          Sorted set of user ids by total score
+#   scoreboards:{beatmap_id}:{mode}:scores   Hash of user id -> score id
+#   scoreboards:{beatmap_id}:{mode}:ready    Set, once the scoreboard was built
+#   scoreboards:{beatmap_id}:{mode}:version  Incremented, whenever the scores of a beatmap change
+#   scoreboards:{beatmap_id}:{mode}:rendered:{version}:{variant}
+#                                            Rendered top scores of a leaderboard response
+#   scoreboards:{beatmap_id}:{mode}:country:{country}
+#                                            Same layout (without versions) for the players of a country
+# The database stays the source of truth, and a scoreboard will be
+# rebuilt from it, whenever it is missing or has expired.
+# Scores that are hidden & players that are restricted outside of deck
+# are removed through the "invalidate_scoreboard" & "hide_player"
+# stages of the submission pipeline (see app/pipeline.py).
+# NOTE: Scores with the same total score share the same rank.
+
+def key(beatmap_id: int, mode: int, country: str | None = None) -> str:
+    if country:
+        return f'scoreboards:{beatmap_id}:{mode}:country:{country.lower()}'
+
+    return f'scoreboards:{beatmap_id}:{mode}'
+
+def rebuild(beatmap_id: int, mode: int, session: Session, country: str | None = None) -> None:
+    """Rebuild the scoreboard of a beatmap from the committed scores"""
+    # A separate session never sees the uncommitted scores of a submission
+    with Session(bind=session.get_bind()) as snapshot:
+        best_scores = snapshot.query(DBScore.user_id, DBScore.id, DBScore.total_score) \
+            .join(DBUser, DBUser.id == DBScore.user_id) \
+            .filter(DBScore.beatmap_id == beatmap_id) \
+            .filter(DBScore.mode == mode) \
+            .filter(DBScore.status_score == 3) \
+            .filter(DBScore.hidden == False) \
+            .filter(DBUser.restricted == False)
+
+        if country:
+            best_scores = best_scores.filter(DBUser.country == country.lower())
+
+        best_scores = best_scores.all()
+
+    cache_key = key(beatmap_id, mode, country)
+    expiry = config.SCOREBOARD_CACHE_EXPIRY
+
+    pipe = app.session.redis.pipeline()
+    pipe.delete(cache_key, f'{cache_key}:scores')
+
+    if best_scores:
+        pipe.zadd(cache_key, {user_id: total_score for user_id, _, total_score in best_scores})
+        pipe.hset(f'{cache_key}:scores', mapping={user_id: score_id for user_id, score_id, _ in best_scores})
+        pipe.expire(cache_key, expiry)
+        pipe.expire(f'{cache_key}:scores', expiry)
+
+    pipe.set(f'{cache_key}:ready', 1, ex=expiry)
+    pipe.execute()
+
+def ensure(beatmap_id: int, mode: int, session: Session, country: str | None = None) -> str:
+    cache_key = key(beatmap_id, mode, country)
+
+    if not app.session.redis.exists(f'{cache_key}:ready'):
+        rebuild(beatmap_id, mode, session, country)
+
+    return cache_key
+
+def submit(score: DBScore, country: str | None = None) -> None:
+    """Insert a new personal best into the cached scoreboards, if they exist"""
+    # Mod-specific personal bests only change the rendered leaderboards
+    bump(score.beatmap_id, score.mode)
+
+    if score.status_score != 3:
+        return
+
+    cache_keys = [key(score.beatmap_id, score.mode)]
+
+    if country:
+        cache_keys.append(key(score.beatmap_id, score.mode, country))
+
+    for cache_key in cache_keys:
+        if not app.session.redis.exists(f'{cache_key}:ready'):
+            # Will be rebuilt on the next lookup
+            continue
+
+        # Replaces the previous personal best of this player
+        pipe = app.session.redis.pipeline()
+        pipe.zadd(cache_key, {score.user_id: score.total_score})
+        pipe.hset(f'{cache_key}:scores', score.user_id, score.id)
+        pipe.execute()
+
+def remove_player(user_id: int, session: Session, country: str | None = None) -> None:
+    """Remove all scores of a player from the cached scoreboards, e.g. after a restriction"""
+    beatmaps = session.query(DBScore.beatmap_id, DBScore.mode) \
+        .filter(DBScore.user_id == user_id) \
+        .filter(DBScore.status_score.in_((3, 4))) \
+        .distinct() \
+        .all()
+
+    if not country:
+        country = session.query(DBUser.country) \
+            .filter(DBUser.id == user_id) \
+            .scalar()
+
+    pipe = app.session.redis.pipeline()
+
+    for beatmap_id, mode in beatmaps:
+        for cache_key in (key(beatmap_id, mode), key(beatmap_id, mode, country)):
+            pipe.zrem(cache_key, user_id)
+            pipe.hdel(f'{cache_key}:scores', user_id)
+
+        pipe.incr(f'{key(beatmap_id, mode)}:version')
+
+    pipe.execute()
+
+def move_player(user_id: int, previous_country: str, session: Session) -> None:
+    """Move the scores of a player into the country scoreboards of their new country"""
+    beatmaps = session.query(DBScore.beatmap_id, DBScore.mode) \
+        .filter(DBScore.user_id == user_id) \
+        .filter(DBScore.status_score == 3) \
+        .all()
+
+    country = session.query(DBUser.country) \
+        .filter(DBUser.id == user_id) \
+        .scalar()
+
+    pipe = app.session.redis.pipeline()
+
+    for beatmap_id, mode in beatmaps:
+        previous_key = key(beatmap_id, mode, previous_country)
+        pipe.zrem(previous_key, user_id)
+        pipe.hdel(f'{previous_key}:scores', user_id)
+
+        # The scoreboard of the new country will be rebuilt on the next lookup
+        pipe.delete(f'{key(beatmap_id, mode, country)}:ready')
+        pipe.incr(f'{key(beatmap_id, mode)}:version')
+
+    pipe.execute()
+
+def invalidate(beatmap_id: int, mode: int) -> None:
+    """Rebuild all scoreboards of a beatmap on their next lookup, e.g. after a score was hidden"""
+    cache_key = key(beatmap_id, mode)
+    ready_keys = [f'{cache_key}:ready']
+    ready_keys.extend(app.session.redis.scan_iter(f'{cache_key}:country:*:ready', count=1000))
+
+    app.session.redis.delete(*ready_keys)
+    bump(beatmap_id, mode)
+
+def bump(beatmap_id: int, mode: int) -> None:
+    """Mark all rendered leaderboards of a beatmap as outdated"""
+    app.session.redis.incr(f'{key(beatmap_id, mode)}:version')
+
+def version(beatmap_id: int, mode: int) -> int:
+    return int(app.session.redis.get(f'{key(beatmap_id, mode)}:version') or 0)
+
+def fetch_rendered(beatmap_id: int, mode: int, version: int, variant: str) -> str | None:
+    """Get the rendered top scores of a leaderboard, if they are still up to date"""
+    rendered = app.session.redis.get(
+        f'{key(beatmap_id, mode)}:rendered:{version}:{variant}'
+    )
+
+    return rendered.decode() if rendered is not None else None
+
+def store_rendered(beatmap_id: int, mode: int, version: int, variant: str, rendered: str) -> None:
+    # NOTE: The version has to be read before the scores were queried,
+    #       so that a concurrent submission can't be hidden by this entry
+    app.session.redis.set(
+        f'{key(beatmap_id, mode)}:rendered:{version}:{variant}',
+        rendered,
+        ex=config.LEADERBOARD_RESPONSE_EXPIRY
+    )
+
+def rank(beatmap_id: int, mode: int, user_id: int, session: Session, country: str | None = None) -> int:
+    """Get the rank of a player's best score on a beatmap, or 0 if there is none"""
+    cache_key = ensure(beatmap_id, mode, session, country)
+    total_score = app.session.redis.zscore(cache_key, user_id)
+
+    if total_score is None:
+        return 0
+
+    return rank_by_total_score(beatmap_id, mode, total_score, session, country)
+
+def rank_by_total_score(beatmap_id: int, mode: int, total_score: int, session: Session, country: str | None = None) -> int:
+    """Get the rank that a score with this total score would have on a beatmap"""
+    cache_key = ensure(beatmap_id, mode, session, country)
+    return app.session.redis.zcount(cache_key, f'({total_score}', '+inf') + 1
+
+def top(beatmap_id: int, mode: int, limit: int, session: Session, country: str | None = None) -> List[int]:
+    """Get the user ids of the best scores on a beatmap"""
+    cache_key = ensure(beatmap_id, mode, session, country)
+
+    return [
+        int(user_id)
+        for user_id in app.session.redis.zrevrange(cache_key, 0, limit - 1)
+    ]
+
+def fetch_subset(beatmap_id: int, mode: int, user_id: int, members_key: str, session: Session) -> List[Tuple[int, float]]:
+    """Get the entries of a scoreboard for a set of user ids, e.g. friends, including the player itself"""
+    cache_key = ensure(beatmap_id, mode, session)
+
+    # The set only acts as a filter, without changing the total scores
+    pipe = app.session.redis.pipeline()
+    pipe.zinter({cache_key: 1, members_key: 0}, withscores=True)
+    pipe.zscore(cache_key, user_id)
+    entries, player_score = pipe.execute()
+
+    entries = {int(member): total_score for member, total_score in entries}
+
+    if player_score is not None:
+        entries[user_id] = player_score
+
+    return sorted(
+        entries.items(),
+        key=lambda entry: entry[1],
+        reverse=True
+    )
+
+def fetch_score_ids(beatmap_id: int, mode: int, user_ids: List[int], country: str | None = None) -> List[int]:
+    """Get the ids of the best scores of these players"""
+    if not user_ids:
+        return []
+
+    score_ids = app.session.redis.hmget(
+        f'{key(beatmap_id, mode, country)}:scores',
+        user_ids
+    )
+
+    return [int(score_id) for score_id in score_ids if score_id]
+
+def count(beatmap_id: int, mode: int, session: Session, country: str | None = None) -> int:
+    """Get the amount of best scores on a beatmap"""
+    cache_key = ensure(beatmap_id, mode, session, country)
+    return app.session.redis.zcard(cache_key)
+
+def clear() -> int:
+    """Remove all cached scoreboards, which will be rebuilt on their next lookup"""
+    keys = list(app.session.redis.scan_iter('scoreboards:*:ready', count=1000))
+
+    if keys:
+        app.session.redis.delete(*keys)
+
+    return len(keys)
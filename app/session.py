@@ -34,10 +34,19 @@ database = Postgres(
     config.POSTGRES_PORT
 )
 
-# Used for achievements checks
-achievement_executor = ThreadPoolExecutor(max_workers=15)
-
 # Used for uploading replays, and checking hightlights
 executor = ThreadPoolExecutor(max_workers=10)
 
+# Used for score submissions, so that they don't block the default threadpool
+submission_executor = ThreadPoolExecutor(
+    max_workers=config.SUBMISSION_WORKERS,
+    thread_name_prefix='submission'
+)
+
+# Used for achievement checks, so that a slow check can't block a submission
+achievement_executor = ThreadPoolExecutor(
+    max_workers=config.ACHIEVEMENT_WORKERS,
+    thread_name_prefix='achievements'
+)
+
 storage = Storage()
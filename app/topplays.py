@@ -0,0 +1,264 @@
+
+from app.common.database.repositories import scores
+from app.common.database import DBBeatmap, DBScore, DBStats
+from app.common.cache import leaderboards
+from app.common.helpers import performance
+from app.common.constants import Mods
+
+from sqlalchemy.orm import Session
+from typing import List, Tuple
+
+import config
+import json
+import app
+
+# Top plays of a player are cached per mode inside redis:
+#   topplays:{user_id}:{mode}          Hash of beatmap id -> score entry
+#   topplays:{user_id}:{mode}:pp       Sorted set of beatmap ids by pp
+#   topplays:{user_id}:{mode}:rscore   Hash of beatmap id -> total score
+#   topplays:{user_id}:{mode}:ready    Set, once the cache was built
+# The database stays the source of truth, and the cache will be
+# rebuilt from it, whenever it is missing or has expired.
+# Scores that get hidden outside of deck should drop the ready marker.
+
+def key(user_id: int, mode: int) -> str:
+    return f'topplays:{user_id}:{mode}'
+
+def awards_pp(beatmap: DBBeatmap) -> bool:
+    if config.APPROVED_MAP_REWARDS:
+        return beatmap.is_ranked
+
+    return beatmap.status in (1, 2)
+
+def serialize(score: DBScore) -> str:
+    return json.dumps({
+        'id': score.id,
+        'beatmap_id': score.beatmap_id,
+        'pp': score.pp,
+        'ppv1': score.ppv1,
+        'acc': score.acc,
+        'mods': score.mods,
+        'total_score': score.total_score
+    })
+
+def rebuild(user_id: int, mode: int, session: Session) -> None:
+    """Rebuild the top plays of a player from the committed scores"""
+    # A separate session never sees the uncommitted scores of a submission
+    with Session(bind=session.get_bind()) as snapshot:
+        best_scores = scores.fetch_best(
+            user_id=user_id,
+            mode=mode,
+            exclude_approved=(not config.APPROVED_MAP_REWARDS),
+            session=snapshot
+        )
+
+        best_scores_by_score = scores.fetch_best_by_score(
+            user_id=user_id,
+            mode=mode,
+            session=snapshot
+        )
+
+        entries = {s.beatmap_id: serialize(s) for s in best_scores}
+        pp_values = {s.beatmap_id: s.pp for s in best_scores}
+        total_scores = {s.beatmap_id: s.total_score for s in best_scores_by_score}
+
+    cache_key = key(user_id, mode)
+    expiry = config.TOPPLAYS_CACHE_EXPIRY
+
+    pipe = app.session.redis.pipeline()
+    pipe.delete(cache_key, f'{cache_key}:pp', f'{cache_key}:rscore')
+
+    if entries:
+        pipe.hset(cache_key, mapping=entries)
+        pipe.zadd(f'{cache_key}:pp', pp_values)
+        pipe.expire(cache_key, expiry)
+        pipe.expire(f'{cache_key}:pp', expiry)
+
+    if total_scores:
+        pipe.hset(f'{cache_key}:rscore', mapping=total_scores)
+        pipe.expire(f'{cache_key}:rscore', expiry)
+
+    pipe.set(f'{cache_key}:ready', 1, ex=expiry)
+    pipe.execute()
+
+def insert(score: DBScore, beatmap: DBBeatmap) -> None:
+    """Insert a new personal best into the cached top plays, if they exist"""
+    cache_key = key(score.user_id, score.mode)
+
+    if not app.session.redis.exists(f'{cache_key}:ready'):
+        # Will be rebuilt on the next fetch
+        return
+
+    pipe = app.session.redis.pipeline()
+
+    if score.status_pp == 3 and awards_pp(beatmap):
+        # Replaces the previous personal best on this beatmap
+        pipe.hset(cache_key, score.beatmap_id, serialize(score))
+        pipe.zadd(f'{cache_key}:pp', {score.beatmap_id: score.pp})
+
+    if score.status_score == 3 and beatmap.is_ranked:
+        pipe.hset(f'{cache_key}:rscore', score.beatmap_id, score.total_score)
+
+    pipe.execute()
+
+def invalidate(user_id: int, mode: int) -> None:
+    app.session.redis.delete(f'{key(user_id, mode)}:ready')
+
+def invalidate_player(user_id: int) -> None:
+    """Rebuild the top plays of every mode on their next fetch, e.g. after a restriction"""
+    app.session.redis.delete(*(
+        f'{key(user_id, mode)}:ready'
+        for mode in range(4)
+    ))
+
+def fetch(
+    user_id: int,
+    mode: int,
+    session: Session,
+    pending: DBScore | None = None,
+    beatmap: DBBeatmap | None = None
+) -> Tuple[List[DBScore], int]:
+    """Fetch the top plays of a player sorted by pp, as well as their ranked score
+
+    A `pending` score, that was not committed yet, will be taken into account
+    without being written into the cache.
+    """
+    cache_key = key(user_id, mode)
+
+    if not app.session.redis.exists(f'{cache_key}:ready'):
+        rebuild(user_id, mode, session)
+
+    pipe = app.session.redis.pipeline()
+    pipe.zrevrange(f'{cache_key}:pp', 0, -1)
+    pipe.hgetall(cache_key)
+    pipe.hgetall(f'{cache_key}:rscore')
+    beatmap_ids, entries, total_scores = pipe.execute()
+
+    # NOTE: These objects are never added to a session, and
+    #       only contain the columns required for the stats
+    top_plays = [
+        DBScore(**json.loads(entries[beatmap_id]))
+        for beatmap_id in beatmap_ids
+        if beatmap_id in entries
+    ]
+
+    if pending is not None:
+        pending_id = str(pending.beatmap_id).encode()
+
+        if pending.status_pp == 3 and awards_pp(beatmap):
+            # Replaces the previous personal best on this beatmap
+            top_plays = [play for play in top_plays if play.beatmap_id != pending.beatmap_id]
+            top_plays.append(DBScore(**json.loads(serialize(pending))))
+            top_plays.sort(key=lambda play: play.pp, reverse=True)
+
+        if pending.status_score == 3 and beatmap.is_ranked:
+            total_scores[pending_id] = pending.total_score
+
+    ranked_score = sum(int(value) for value in total_scores.values())
+    return top_plays, ranked_score
+
+def fetch_top_play(user_id: int, mode: int, session: Session) -> int | None:
+    """Get the score id of the highest pp play of a player"""
+    cache_key = key(user_id, mode)
+
+    if not app.session.redis.exists(f'{cache_key}:ready'):
+        rebuild(user_id, mode, session)
+
+    beatmap_ids = app.session.redis.zrevrange(f'{cache_key}:pp', 0, 0)
+
+    if not beatmap_ids:
+        return None
+
+    entry = app.session.redis.hget(cache_key, beatmap_ids[0])
+    return json.loads(entry)['id'] if entry else None
+
+def calculate_weighted_pp(scores: List[DBScore]) -> float:
+    """Calculate the weighted pp for a list of scores"""
+    if not scores:
+        return 0
+
+    weighted_pp = sum(score.pp * 0.95**index for index, score in enumerate(scores))
+    bonus_pp = 416.6667 * (1 - 0.9994 ** len(scores))
+    return weighted_pp + bonus_pp
+
+def calculate_weighted_acc(scores: List[DBScore]) -> float:
+    """Calculate the weighted acc for a list of scores"""
+    if not scores:
+        return 0
+
+    weighted_acc = sum(score.acc * 0.95**index for index, score in enumerate(scores))
+    bonus_acc = 100.0 / (20 * (1 - 0.95 ** len(scores)))
+    return (weighted_acc * bonus_acc) / 100
+
+def calculate(top_plays: List[DBScore]) -> dict:
+    """Calculate the pp & accuracy values of a player's stats in a single pass"""
+    vn_scores: List[DBScore] = []
+    rx_scores: List[DBScore] = []
+    ap_scores: List[DBScore] = []
+
+    for score in top_plays:
+        if score.mods & Mods.Relax.value:
+            rx_scores.append(score)
+
+        if score.mods & Mods.Autopilot.value:
+            ap_scores.append(score)
+
+        if not score.mods & (Mods.Relax.value | Mods.Autopilot.value):
+            vn_scores.append(score)
+
+    return {
+        'pp': calculate_weighted_pp(top_plays),
+        'pp_vn': calculate_weighted_pp(vn_scores),
+        'pp_rx': calculate_weighted_pp(rx_scores),
+        'pp_ap': calculate_weighted_pp(ap_scores),
+        'acc': calculate_weighted_acc(top_plays),
+        'ppv1': performance.calculate_weighted_ppv1(top_plays)
+    }
+
+def update_stats(
+    user_stats: DBStats,
+    country: str,
+    session: Session,
+    pending: DBScore | None = None,
+    beatmap: DBBeatmap | None = None
+) -> bool:
+    """Update the pp, accuracy, ranked score & rank of a player from their top plays"""
+    top_plays, ranked_score = fetch(
+        user_stats.user_id,
+        user_stats.mode,
+        session,
+        pending,
+        beatmap
+    )
+
+    if not top_plays:
+        return False
+
+    values = calculate(top_plays)
+
+    # Update pp
+    user_stats.pp = values['pp']
+    user_stats.pp_vn = values['pp_vn']
+    user_stats.pp_rx = values['pp_rx']
+    user_stats.pp_ap = values['pp_ap']
+
+    # Update acc
+    user_stats.acc = values['acc']
+
+    # Update rscore
+    user_stats.rscore = ranked_score
+
+    # Update ppv1
+    user_stats.ppv1 = values['ppv1']
+
+    leaderboards.update(
+        user_stats,
+        country.lower()
+    )
+
+    user_stats.rank = leaderboards.global_rank(
+        user_stats.user_id,
+        user_stats.mode
+    )
+
+    return True
@@ -0,0 +1,121 @@
+
+from sqlalchemy.orm import Session
+from sqlalchemy.engine import Engine
+from sqlalchemy import event
+
+from typing import Callable, List
+from functools import partial
+from app import metrics
+
+import threading
+import app
+
+active = threading.local()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(*args, **kwargs) -> None:
+    if unit := getattr(active, 'unit', None):
+        unit.statements += 1
+
+class UnitOfWork:
+    """Groups all writes of a session into a single transaction
+
+    While the unit of work is active, commits of the repository helpers
+    are turned into flushes, so that ids are still assigned. The session
+    will be committed once, when the unit of work exits without an error.
+    """
+
+    def __init__(self, session: Session, name: str = 'submission') -> None:
+        self.name = name
+        self.session = session
+        self.statements = 0
+        self.flushes = 0
+        self.pre_commit: List[Callable] = []
+        self.post_commit: List[Callable] = []
+        self.post_rollback: List[Callable] = []
+
+    def __enter__(self) -> "UnitOfWork":
+        self.session.commit = self.flush
+        active.unit = self
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        del self.session.commit
+
+        committed = False
+
+        try:
+            if exc_type is None:
+                for hook in self.pre_commit:
+                    hook()
+
+                self.session.commit()
+                committed = True
+        finally:
+            active.unit = None
+
+            if not committed:
+                self.session.rollback()
+                self.run_hooks(self.post_rollback)
+            else:
+                # Hooks can still load the instances of this session
+                self.run_hooks(self.post_commit)
+
+            self.session.close()
+            self.record()
+
+    def run_hooks(self, hooks: List[Callable]) -> None:
+        for hook in hooks:
+            try:
+                hook()
+            except Exception as e:
+                app.session.logger.error(
+                    f'Failed to run transaction hook: {e}',
+                    exc_info=e
+                )
+
+    def flush(self) -> None:
+        self.flushes += 1
+        self.session.flush()
+
+    def before_commit(self, func: Callable, *args, **kwargs) -> None:
+        """Run a function right before the transaction gets committed"""
+        self.pre_commit.append(partial(func, *args, **kwargs))
+
+    def after_commit(self, func: Callable, *args, **kwargs) -> None:
+        """Run a function after the transaction was committed successfully"""
+        self.post_commit.append(partial(func, *args, **kwargs))
+
+    def on_rollback(self, func: Callable, *args, **kwargs) -> None:
+        """Undo a change outside of the database, if the transaction was rolled back"""
+        self.post_rollback.append(partial(func, *args, **kwargs))
+
+    def record(self) -> None:
+        try:
+            self.observe()
+        except Exception as e:
+            # Metrics should never prevent the post-commit hooks from running
+            app.session.logger.error(
+                f'Failed to record unit of work: {e}',
+                exc_info=e
+            )
+
+    def observe(self) -> None:
+        app.session.logger.debug(
+            f'Unit of work "{self.name}" completed with '
+            f'{self.statements} statements and {self.flushes} flushes'
+        )
+
+        metrics.observe(
+            'deck_transaction_statements',
+            self.statements,
+            buckets=metrics.COUNT_BUCKETS,
+            transaction=self.name
+        )
+
+        metrics.observe(
+            'deck_transaction_flushes',
+            self.flushes,
+            buckets=metrics.COUNT_BUCKETS,
+            transaction=self.name
+        )
@@ -0,0 +1,59 @@
+
+"""Compare the per-mode grade queries of osu-getbeatmapinfo against the grouped query for 100 beatmaps
+
+Usage: python -m benchmarks.beatmapinfo <user_id> [iterations]
+"""
+
+from app.routes.web.beatmapinfo import fetch_grades
+from app.common.database import DBScore
+from sqlalchemy.orm import Session
+from typing import List
+
+import timeit
+import sys
+import app
+
+def fetch_separately(session: Session, user_id: int, beatmap_ids: List[int]) -> None:
+    # Previous implementation, which sends one query per beatmap & mode
+    for beatmap_id in beatmap_ids:
+        for mode in range(4):
+            session.query(DBScore.grade) \
+                .filter(DBScore.beatmap_id == beatmap_id) \
+                .filter(DBScore.user_id == user_id) \
+                .filter(DBScore.mode == mode) \
+                .filter(DBScore.status_pp == 3) \
+                .filter(DBScore.hidden == False) \
+                .scalar()
+
+def fetch_grouped(session: Session, user_id: int, beatmap_ids: List[int]) -> None:
+    fetch_grades(user_id, beatmap_ids, session)
+
+def main() -> None:
+    user_id = int(sys.argv[1])
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    with app.session.database.managed_session() as session:
+        # A song folder scan sends up to 100 beatmaps per request
+        beatmap_ids = [
+            beatmap_id for beatmap_id, in session.query(DBScore.beatmap_id)
+                .filter(DBScore.user_id == user_id)
+                .distinct()
+                .limit(100)
+                .all()
+        ]
+
+        print(f'Requesting grades for {len(beatmap_ids)} beatmaps')
+
+        for name, fetch in (('separate', fetch_separately), ('grouped', fetch_grouped)):
+            # Warm up the connection & query caches
+            fetch(session, user_id, beatmap_ids)
+
+            total = timeit.timeit(
+                lambda: fetch(session, user_id, beatmap_ids),
+                number=iterations
+            )
+
+            print(f'{name:<10} {total / iterations * 1000:.3f}ms per request')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+
+"""Compare the score decryption of app.encryption against py3rijndael's cbc mode
+
+Usage: python -m benchmarks.encryption [iterations]
+"""
+
+from py3rijndael import RijndaelCbc, Pkcs7Padding
+from app import encryption
+
+import base64
+import timeit
+import sys
+import os
+
+KEY = 'osu!-scoreburgr---------20240101'
+
+def encrypt(data: str, iv: bytes) -> str:
+    cipher = RijndaelCbc(
+        key=KEY,
+        iv=iv,
+        padding=Pkcs7Padding(32),
+        block_size=32
+    )
+    return base64.b64encode(cipher.encrypt(data.encode())).decode()
+
+def decrypt_per_field(fields: list, iv: bytes) -> list:
+    # Previous implementation, which creates a new cipher for every field
+    return [
+        RijndaelCbc(
+            key=KEY,
+            iv=iv,
+            padding=Pkcs7Padding(32),
+            block_size=32
+        ).decrypt(base64.b64decode(field)).decode()
+        if field else None
+        for field in fields
+    ]
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    iv = os.urandom(32)
+
+    # Roughly the size of the fields of a real submission
+    fields = [
+        encrypt(os.urandom(16).hex(), iv),
+        encrypt('', iv),
+        encrypt(
+            'e0a2a2ab26d4cb0a1d9d8ab4fe0ad7e1:peppy:3f9d1c3a2f3c0ec1a7a19c1ee96a7b2a:'
+            '401:12:0:54:8:1:6152114:512:False:A:72:True:0:240101',
+            iv
+        ),
+        encrypt('osu!.exe|' + 'explorer.exe|' * 40, iv)
+    ]
+
+    assert decrypt_per_field(fields, iv) == encryption.decrypt_fields(fields, iv, KEY)
+
+    results = {
+        'per field (py3rijndael)': timeit.timeit(
+            lambda: decrypt_per_field(fields, iv),
+            number=iterations
+        ),
+        'single pass (app.encryption)': timeit.timeit(
+            lambda: encryption.decrypt_fields(fields, iv, KEY),
+            number=iterations
+        )
+    }
+
+    for name, total in results.items():
+        print(f'{name:<30} {total / iterations * 1000:.3f}ms per submission')
+
+if __name__ == '__main__':
+    main()
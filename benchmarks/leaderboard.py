@@ -0,0 +1,45 @@
+
+"""Compare the four leaderboard queries of a player against the combined window function query
+
+Usage: python -m benchmarks.leaderboard <beatmap_id> <user_id> [mode] [iterations]
+"""
+
+from app.common.database.repositories import scores
+from app.routes.web.leaderboards import fetch_board
+from sqlalchemy.orm import Session
+
+import timeit
+import config
+import sys
+import app
+
+def fetch_separately(session: Session, beatmap_id: int, user_id: int, mode: int) -> None:
+    # Previous implementation, which scans the scores of the beatmap four times
+    scores.fetch_personal_best_score(beatmap_id, user_id, mode, None, session)
+    scores.fetch_count_beatmap(beatmap_id, mode, session=session)
+    scores.fetch_score_index(user_id, beatmap_id, mode, session=session)
+    scores.fetch_range_scores(beatmap_id, mode=mode, limit=config.SCORE_RESPONSE_LIMIT, session=session)
+
+def fetch_combined(session: Session, beatmap_id: int, user_id: int, mode: int) -> None:
+    fetch_board(beatmap_id, mode, session, player_id=user_id)
+
+def main() -> None:
+    beatmap_id, user_id = int(sys.argv[1]), int(sys.argv[2])
+    mode = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    iterations = int(sys.argv[4]) if len(sys.argv) > 4 else 100
+
+    with app.session.database.managed_session() as session:
+        for name, fetch in (('separate', fetch_separately), ('combined', fetch_combined)):
+            # Warm up the connection & query caches
+            fetch(session, beatmap_id, user_id, mode)
+
+            total = timeit.timeit(
+                lambda: fetch(session, beatmap_id, user_id, mode),
+                number=iterations
+            )
+
+            session.expunge_all()
+            print(f'{name:<10} {total / iterations * 1000:.3f}ms per leaderboard view')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+
+"""Measure the allocations of a score object during a submission
+
+Usage: python -m benchmarks.score [iterations]
+"""
+
+from app.common.database import DBBeatmap, DBUser
+from app.objects import Score
+
+import tracemalloc
+import sys
+
+SCORE_DATA = (
+    'e0a2a2ab26d4cb0a1d9d8ab4fe0ad7e1:peppy:3f9d1c3a2f3c0ec1a7a19c1ee96a7b2a:'
+    '401:12:0:54:8:1:6152114:512:False:A:72:True:0:240101'
+)
+
+def parse() -> Score:
+    score = Score.parse(SCORE_DATA, b'\x00' * 50000, None, None)
+    score.beatmap = DBBeatmap(id=1, md5='e0a2a2ab26d4cb0a1d9d8ab4fe0ad7e1', total_length=120)
+    score.user = DBUser(id=2)
+    return score
+
+def submission_before(score: Score) -> None:
+    # Previously, every call created a new database object, and
+    # every access to the accuracy recalculated the hit counts
+    for _ in range(5):
+        score.create_database_score()
+        score.calculate_total_hits()
+        score.calculate_accuracy()
+
+def submission_after(score: Score) -> None:
+    for _ in range(5):
+        score.to_database()
+        score.total_hits
+        score.accuracy
+
+def measure(submission, iterations: int) -> tuple:
+    scores = []
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start, _ = tracemalloc.get_traced_memory()
+
+    for _ in range(iterations):
+        score = parse()
+        submission(score)
+        scores.append(score)
+
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    allocations = sum(stat.count for stat in snapshot.statistics('filename'))
+    return (current - start) / iterations, (peak - start) / iterations, allocations / iterations
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    for name, submission in (('before', submission_before), ('after', submission_after)):
+        retained, peak, allocations = measure(submission, iterations)
+        print(
+            f'{name:<8} {retained / 1024:.1f}KiB retained, '
+            f'{peak / 1024:.1f}KiB peak, '
+            f'{allocations:.0f} live blocks per submission'
+        )
+
+if __name__ == '__main__':
+    main()
@@ -46,6 +46,34 @@ DEBUG = eval(os.environ.get('DEBUG', 'False').capitalize())
 SCORE_RESPONSE_LIMIT = int(os.environ.get('SCORE_RESPONSE_LIMIT', 50))
 SCORE_SUBMISSION_KEY = os.environ.get('SCORE_SUBMISSION_KEY')
 
+PIPELINE_MAX_ATTEMPTS = int(os.environ.get('PIPELINE_MAX_ATTEMPTS', 5))
+PIPELINE_STREAM_LENGTH = int(os.environ.get('PIPELINE_STREAM_LENGTH', 100000))
+PIPELINE_CLAIM_IDLE = int(os.environ.get('PIPELINE_CLAIM_IDLE', 60))
+
+TOPPLAYS_CACHE_EXPIRY = int(os.environ.get('TOPPLAYS_CACHE_EXPIRY', 86400))
+
+SUBMISSION_WORKERS = int(os.environ.get('SUBMISSION_WORKERS', 20))
+SLOW_SUBMISSION_THRESHOLD = float(os.environ.get('SLOW_SUBMISSION_THRESHOLD', 1.0))
+ACHIEVEMENT_TIME_BUDGET = float(os.environ.get('ACHIEVEMENT_TIME_BUDGET', 0.5))
+ACHIEVEMENT_WORKERS = int(os.environ.get('ACHIEVEMENT_WORKERS', 20))
+
+PP_WORKERS = int(os.environ.get('PP_WORKERS', 2))
+PP_CALCULATION_DEADLINE = float(os.environ.get('PP_CALCULATION_DEADLINE', 5))
+PP_RECALCULATION_DEADLINE = float(os.environ.get('PP_RECALCULATION_DEADLINE', 120))
+
+DIFFICULTY_CACHE_SIZE = int(os.environ.get('DIFFICULTY_CACHE_SIZE', 256))
+DIFFICULTY_CACHE_EXPIRY = int(os.environ.get('DIFFICULTY_CACHE_EXPIRY', 86400))
+
+REPLAY_FILTER_CAPACITY = int(os.environ.get('REPLAY_FILTER_CAPACITY', 10000000))
+REPLAY_FILTER_ERROR_RATE = float(os.environ.get('REPLAY_FILTER_ERROR_RATE', 0.001))
+
+SCOREBOARD_CACHE_EXPIRY = int(os.environ.get('SCOREBOARD_CACHE_EXPIRY', 600))
+LEADERBOARD_RESPONSE_EXPIRY = int(os.environ.get('LEADERBOARD_RESPONSE_EXPIRY', 600))
+PP_RECORD_CACHE_EXPIRY = int(os.environ.get('PP_RECORD_CACHE_EXPIRY', 3600))
+FRIENDS_CACHE_EXPIRY = int(os.environ.get('FRIENDS_CACHE_EXPIRY', 300))
+MISSING_CHECKSUM_EXPIRY = int(os.environ.get('MISSING_CHECKSUM_EXPIRY', 3600))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
 MENUICON_IMAGE = os.environ.get('MENUICON_IMAGE')
 MENUICON_URL = os.environ.get('MENUICON_URL')
 
@@ -1,8 +1,37 @@
 
+from argparse import ArgumentParser
+from app import bloom, scoreboards, packs
+
 import app
 
+def rebuild_replay_filter() -> None:
+    with app.session.database.managed_session() as session:
+        count = bloom.rebuild_replays(session)
+
+    app.session.logger.info(f'Rebuilt replay filter with {count} replays ({bloom.replays})')
+
+def clear_scoreboards() -> None:
+    count = scoreboards.clear()
+    app.session.logger.info(f'Cleared {count} scoreboards')
+
+def backfill_packs() -> None:
+    with app.session.database.managed_session() as session:
+        count = packs.backfill(session)
+
+    app.session.logger.info(f'Built pack progress of {count} players')
+
+commands = {
+    'serve': app.run,
+    'rebuild-replay-filter': rebuild_replay_filter,
+    'clear-scoreboards': clear_scoreboards,
+    'backfill-packs': backfill_packs
+}
+
 def main():
-    app.run()
+    parser = ArgumentParser(description='Deck')
+    parser.add_argument('command', nargs='?', default='serve', choices=commands)
+    args = parser.parse_args()
+    commands[args.command]()
 
 if __name__ == "__main__":
     main()